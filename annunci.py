@@ -0,0 +1,203 @@
+"""
+Annunci vocali per chi chiama e per il visitatore.
+
+I file WAV della cartella degli annunci vengono decodificati una sola
+volta e normalizzati nel formato della chiamata (PCM 16 bit mono alla
+frequenza del codec, 8 kHz con G.711), poi tenuti su tmpfs, cioe' in RAM: Baresip li
+riproduce con il modulo aufile (nella chiamata) o con /play (sul
+citofono) senza leggere la SD ne' decodificare a ogni riproduzione.
+La memoria occupata e' limitata: oltre il limite gli annunci usati meno
+di recente vengono tolti e, se servono di nuovo, ridecodificati dal
+file originale.
+
+Annunci previsti (<nome>.wav, tutti facoltativi):
+
+    attendere        al visitatore, quando parte la chiamata
+    porta_aperta     nella chiamata, quando il rele' si attiva
+    codice_errato    nella chiamata, codice DTMF errato
+    codici_bloccati  nella chiamata, troppi codici errati
+
+La cartella su tmpfs fa anche da audio_path di Baresip: i suoni di
+Baresip (ringback, busy...) vi sono collegati, cosi' restano disponibili.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import array
+import logging
+import os
+import sys
+import wave
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+ATTENDERE = 'attendere'
+PORTA_APERTA = 'porta_aperta'
+CODICE_ERRATO = 'codice_errato'
+CODICI_BLOCCATI = 'codici_bloccati'
+ANNUNCI = (ATTENDERE, PORTA_APERTA, CODICE_ERRATO, CODICI_BLOCCATI)
+
+# Frequenza della chiamata con G.711, il codec predefinito
+FREQUENZA = 8000
+
+# Suoni standard di Baresip, collegati nella cartella su tmpfs
+SUONI_BARESIP = '/usr/share/baresip'
+
+# durata in secondi, byte = dimensione del PCM in memoria
+Annuncio = namedtuple('Annuncio', 'nome percorso durata byte')
+
+
+def cartella_tmpfs(nome='annunci'):
+    """Cartella in RAM del citofono (fissa: e' un percorso della config di Baresip)."""
+    if os.access('/run', os.W_OK):
+        return os.path.join('/run/citofono-voip', nome)
+    return os.path.join('/dev/shm', f'citofono-voip-{os.getuid()}', nome)
+
+
+def _campioni_16bit(dati, larghezza):
+    """Frame PCM little-endian di qualsiasi larghezza -> array di campioni a 16 bit."""
+    if larghezza == 2:
+        campioni = array.array('h', dati)
+        if sys.byteorder == 'big':
+            campioni.byteswap()
+        return campioni
+    if larghezza == 1:
+        # 8 bit senza segno
+        return array.array('h', ((b - 128) << 8 for b in dati))
+    # 24 e 32 bit: bastano i due byte piu' significativi
+    return array.array('h', (int.from_bytes(dati[i + larghezza - 2:i + larghezza], 'little',
+                                            signed=True)
+                             for i in range(0, len(dati), larghezza)))
+
+
+def decodifica(percorso, frequenza=FREQUENZA):
+    """Legge un WAV PCM e ritorna i byte PCM 16 bit mono alla frequenza data."""
+    with wave.open(percorso, 'rb') as f:
+        canali = f.getnchannels()
+        larghezza = f.getsampwidth()
+        sorgente = f.getframerate()
+        dati = f.readframes(f.getnframes())
+    campioni = _campioni_16bit(dati, larghezza)
+    if canali > 1:
+        campioni = array.array('h', (sum(campioni[i:i + canali]) // canali
+                                     for i in range(0, len(campioni) - canali + 1, canali)))
+    if sorgente != frequenza and len(campioni) > 1:
+        # Interpolazione lineare: gli annunci sono brevi e si decodificano una volta
+        n = len(campioni) * frequenza // sorgente
+        passo = (len(campioni) - 1) / max(n - 1, 1)
+        uscita = array.array('h', bytes(2 * n))
+        for j in range(n):
+            pos = j * passo
+            i = int(pos)
+            if i + 1 < len(campioni):
+                uscita[j] = int(campioni[i] + (campioni[i + 1] - campioni[i]) * (pos - i))
+            else:
+                uscita[j] = campioni[i]
+        campioni = uscita
+    if sys.byteorder == 'big':
+        campioni.byteswap()
+    return campioni.tobytes()
+
+
+class CacheAnnunci:
+    """Annunci decodificati su tmpfs, con limite LRU sulla memoria occupata.
+
+    sorgente: cartella dei WAV originali; cartella: destinazione su
+    tmpfs; max_byte: memoria massima degli annunci decodificati;
+    frequenza: quella della sorgente audio di Baresip, che non ricampiona
+    gli annunci.
+    """
+
+    def __init__(self, sorgente, cartella, max_byte, frequenza=FREQUENZA):
+        self.sorgente = sorgente
+        self.cartella = cartella
+        self.max_byte = max_byte
+        self.frequenza = frequenza
+        self.occupati = 0
+        self.decodifiche = 0  # comprese quelle dopo un'uscita dalla cache
+        self._annunci = OrderedDict()  # nome -> Annuncio, dal meno recente
+
+    def avvia(self):
+        """Prepara la cartella e decodifica gli annunci presenti; ritorna quanti."""
+        os.makedirs(self.cartella, exist_ok=True)
+        self._collega_suoni_baresip()
+        for nome in ANNUNCI:
+            if os.path.isfile(self._originale(nome)):
+                self._carica(nome)
+        return len(self._annunci)
+
+    def _originale(self, nome):
+        return os.path.join(self.sorgente, nome + '.wav')
+
+    def _collega_suoni_baresip(self):
+        if not os.path.isdir(SUONI_BARESIP):
+            return
+        for file in os.listdir(SUONI_BARESIP):
+            nome = os.path.splitext(file)[0]
+            destinazione = os.path.join(self.cartella, file)
+            if nome not in ANNUNCI and not os.path.lexists(destinazione):
+                os.symlink(os.path.join(SUONI_BARESIP, file), destinazione)
+
+    def in_memoria(self, nome):
+        return nome in self._annunci
+
+    def prepara(self, nome):
+        """Annuncio pronto da riprodurre, o None se non c'e' il file.
+
+        Un annuncio uscito dalla cache viene ridecodificato: e' l'unico
+        caso che legge la SD.
+        """
+        annuncio = self._annunci.get(nome)
+        if annuncio is not None:
+            self._annunci.move_to_end(nome)
+            return annuncio
+        if not os.path.isfile(self._originale(nome)):
+            return None
+        return self._carica(nome)
+
+    def _carica(self, nome):
+        try:
+            pcm = decodifica(self._originale(nome), self.frequenza)
+        except (OSError, EOFError, wave.Error) as e:
+            logger.warning("Annuncio %s non valido: %s", nome, e)
+            return None
+        if len(pcm) > self.max_byte:
+            logger.warning("Annuncio %s troppo grande (%d kB) per la cache", nome, len(pcm) // 1024)
+            return None
+        while self._annunci and self.occupati + len(pcm) > self.max_byte:
+            self._togli(next(iter(self._annunci)))
+        percorso = os.path.join(self.cartella, nome + '.wav')
+        with wave.open(percorso, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(self.frequenza)
+            f.writeframes(pcm)
+        annuncio = Annuncio(nome, percorso, len(pcm) / (2 * self.frequenza), len(pcm))
+        self._annunci[nome] = annuncio
+        self.occupati += annuncio.byte
+        self.decodifiche += 1
+        logger.debug("Annuncio %s decodificato: %.2fs, %d kB", nome, annuncio.durata,
+                     annuncio.byte // 1024)
+        return annuncio
+
+    def _togli(self, nome):
+        annuncio = self._annunci.pop(nome)
+        self.occupati -= annuncio.byte
+        try:
+            os.unlink(annuncio.percorso)
+        except OSError:
+            pass
+        logger.debug("Annuncio %s tolto dalla cache", nome)
+
+    def cambia_frequenza(self, frequenza):
+        """Nuova frequenza della chiamata: butta gli annunci decodificati e
+        li ridecodifica; ritorna quanti."""
+        self.termina()
+        self.frequenza = frequenza
+        return self.avvia()
+
+    def termina(self):
+        """Libera la memoria: toglie gli annunci decodificati."""
+        for nome in list(self._annunci):
+            self._togli(nome)
@@ -0,0 +1,237 @@
+"""
+API locale del citofono: stato, apertura del portone ed eventi in tempo reale.
+
+HTTP/1.1 sullo stesso loop asyncio di CitofonoVoIP, come l'endpoint
+delle metriche; risposte JSON:
+
+    GET  /stato              postazioni, chiamate in corso, Baresip
+    GET  /chiamate           solo le postazioni impegnate in una chiamata
+    GET  /eventi?n=50&tipo=  ultimi eventi (al massimo STORIA)
+    GET  /eventi/flusso      eventi in tempo reale (Server-Sent Events)
+    POST /apri?postazione=portone&rele=secondario
+                             apre il portone (default: prima postazione,
+                             rele' principale)
+
+Ogni evento e' un oggetto {id, ts, tipo, ...}; nel flusso SSE id e tipo
+sono anche i campi id ed event. Chi si riconnette con Last-Event-ID
+riceve prima gli eventi persi ancora in storia.
+
+Ogni client del flusso ha una coda limitata: pubblica() non attende
+mai, e un client che non legge abbastanza in fretta viene disconnesso
+quando la sua coda e' piena, senza rallentare gli altri ne' la gestione
+delle chiamate. Con un token ogni richiesta deve avere l'intestazione
+'Authorization: Bearer <token>'. Senza token /apri risponde sempre 401:
+qualsiasi processo della macchina potrebbe aprire il portone.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import asyncio
+import hmac
+import itertools
+import json
+import logging
+import time
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Eventi tenuti per /eventi e per chi si riconnette al flusso
+STORIA = 200
+
+# Commento SSE inviato ai client del flusso in assenza di eventi (secondi)
+INTERVALLO_KEEPALIVE = 15
+
+# Attesa massima della richiesta HTTP (secondi)
+TIMEOUT_RICHIESTA = 5
+
+TIPO_JSON = 'application/json; charset=utf-8'
+
+_STATI_HTTP = {
+    200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+    405: 'Method Not Allowed', 409: 'Conflict',
+}
+
+
+class ErroreAPI(Exception):
+    """Richiesta rifiutata: codice HTTP e messaggio per il client."""
+
+    def __init__(self, codice, messaggio):
+        super().__init__(messaggio)
+        self.codice = codice
+
+
+class _Cliente:
+    """Client del flusso: coda degli eventi e connessione."""
+
+    def __init__(self, writer, coda_max):
+        self.writer = writer
+        self.coda = asyncio.Queue(coda_max)
+
+
+class Eventi:
+    """Storia degli eventi e diffusione ai client del flusso."""
+
+    def __init__(self, storia=STORIA):
+        self.storia = deque(maxlen=storia)
+        self.clienti = set()
+        self.on_lento = None  # callback() per ogni client disconnesso perche' lento
+        self._id = itertools.count(1)
+
+    def pubblica(self, tipo, **dati):
+        """Registra un evento e lo mette nella coda di ogni client; non attende mai."""
+        evento = {'id': next(self._id), 'ts': round(time.time(), 3), 'tipo': tipo, **dati}
+        self.storia.append(evento)
+        for cliente in list(self.clienti):
+            try:
+                cliente.coda.put_nowait(evento)
+            except asyncio.QueueFull:
+                self.clienti.discard(cliente)
+                if self.on_lento is not None:
+                    self.on_lento()
+                logger.warning("Client del flusso eventi troppo lento, disconnesso")
+                # abort() non attende il buffer: sblocca anche un drain() in corso
+                cliente.writer.transport.abort()
+
+    def ultimi(self, n, tipo=None):
+        eventi = [e for e in self.storia if tipo is None or e['tipo'] == tipo]
+        return eventi[-n:] if n > 0 else []
+
+    def dopo(self, id_evento):
+        return [e for e in self.storia if e['id'] > id_evento]
+
+
+class ServerAPI:
+    """Server HTTP dell'API.
+
+    stato(): dizionario dello stato del sistema; apri(postazione, rele):
+    apre il portone, o solleva ErroreAPI; coda_max(): lunghezza massima
+    della coda di un nuovo client del flusso.
+    """
+
+    def __init__(self, eventi, stato, apri, coda_max, token=''):
+        self.eventi = eventi
+        self.stato = stato
+        self.apri = apri
+        self.coda_max = coda_max
+        self.token = token
+        self.server = None
+        self._flussi = set()  # writer dei client del flusso, chiusi da chiudi()
+
+    async def avvia(self, host, porta):
+        self.server = await asyncio.start_server(self._servi, host, porta)
+        logger.info("API locale su http://%s:%d", host, porta)
+
+    async def chiudi(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self._flussi):
+            writer.transport.abort()
+        await self.server.wait_closed()
+        self.server = None
+
+    async def _servi(self, reader, writer):
+        try:
+            richiesta = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), TIMEOUT_RICHIESTA)
+            righe = richiesta.decode('latin-1').split('\r\n')
+            metodo, destinazione, _ = righe[0].split(' ', 2)
+            intestazioni = {}
+            for riga in righe[1:]:
+                nome, _, valore = riga.partition(':')
+                intestazioni[nome.strip().lower()] = valore.strip()
+            url = urlsplit(destinazione)
+            parametri = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                self._autorizza(intestazioni)
+                if url.path == '/eventi/flusso':
+                    if metodo != 'GET':
+                        raise ErroreAPI(405, "usare GET")
+                    await self._flusso(writer, intestazioni, parametri)
+                    return
+                corpo = self._gestisci(metodo, url.path, parametri)
+                codice = 200
+            except ErroreAPI as e:
+                codice, corpo = e.codice, {'errore': str(e)}
+            await self._rispondi(writer, codice, corpo)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError, OSError):
+            logger.debug("Richiesta API non valida o interrotta", exc_info=True)
+        finally:
+            writer.close()
+
+    def _autorizza(self, intestazioni):
+        if not self.token:
+            return
+        schema, _, token = intestazioni.get('authorization', '').partition(' ')
+        if schema.lower() != 'bearer' or not hmac.compare_digest(token.encode(),
+                                                                 self.token.encode()):
+            raise ErroreAPI(401, "token mancante o errato")
+
+    def _gestisci(self, metodo, percorso, parametri):
+        if percorso == '/apri':
+            if not self.token:
+                raise ErroreAPI(401, "apertura disattivata senza API_TOKEN")
+            if metodo != 'POST':
+                raise ErroreAPI(405, "usare POST")
+            return self.apri(parametri.get('postazione'), parametri.get('rele', 'principale'))
+        if metodo != 'GET':
+            raise ErroreAPI(405, "usare GET")
+        if percorso in ('/', '/stato'):
+            return self.stato()
+        if percorso == '/chiamate':
+            return [p for p in self.stato()['postazioni'] if p['stato'] != 'libero']
+        if percorso == '/eventi':
+            try:
+                n = int(parametri.get('n', 50))
+            except ValueError:
+                raise ErroreAPI(400, "n deve essere un numero") from None
+            return self.eventi.ultimi(n, parametri.get('tipo'))
+        raise ErroreAPI(404, "non trovato")
+
+    async def _rispondi(self, writer, codice, corpo):
+        dati = (json.dumps(corpo, ensure_ascii=False) + '\n').encode()
+        writer.write((f'HTTP/1.1 {codice} {_STATI_HTTP[codice]}\r\n'
+                      f'Content-Type: {TIPO_JSON}\r\nContent-Length: {len(dati)}\r\n'
+                      f'Cache-Control: no-store\r\nConnection: close\r\n\r\n').encode() + dati)
+        await writer.drain()
+
+    async def _flusso(self, writer, intestazioni, parametri):
+        cliente = _Cliente(writer, self.coda_max())
+        # Da qui in poi gli eventi si accodano: la storia si invia prima di leggere la coda
+        self.eventi.clienti.add(cliente)
+        self._flussi.add(writer)
+        try:
+            ultimo = intestazioni.get('last-event-id', parametri.get('da'))
+            try:
+                ultimo = int(ultimo) if ultimo is not None else None
+            except ValueError:
+                ultimo = None
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                         b'Cache-Control: no-store\r\nConnection: keep-alive\r\n\r\n'
+                         b'retry: 1000\n\n')
+            inviati = 0
+            if ultimo is not None:
+                for evento in self.eventi.dopo(ultimo):
+                    writer.write(_sse(evento))
+                    inviati = evento['id']
+            await writer.drain()
+            while True:
+                try:
+                    evento = await asyncio.wait_for(cliente.coda.get(), INTERVALLO_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+                else:
+                    if evento['id'] <= inviati:
+                        continue  # gia' inviato dalla storia
+                    writer.write(_sse(evento))
+                await writer.drain()
+        finally:
+            self.eventi.clienti.discard(cliente)
+            self._flussi.discard(writer)
+
+
+def _sse(evento):
+    return (f"id: {evento['id']}\nevent: {evento['tipo']}\n"
+            f"data: {json.dumps(evento, ensure_ascii=False)}\n\n").encode()
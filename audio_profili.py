@@ -0,0 +1,99 @@
+"""
+Profili audio della configurazione di Baresip.
+
+Il ritardo tra il microfono del chiamato e l'altoparlante del portone
+dipende soprattutto dai buffer: quanto audio va in ogni pacchetto RTP
+(ptime), quanto ne trattiene il jitter buffer prima di decodificarlo e
+quanto ne tiene il buffer di riproduzione davanti alla scheda audio.
+Buffer piccoli danno meno ritardo ma piu' interruzioni se la rete o il
+Raspberry Pi hanno dei ritardi; buffer grandi il contrario.
+
+    bassa_latenza  pacchetti da 10 ms, jitter buffer 10-60 ms, buffer
+                   di riproduzione 10-60 ms: rete locale cablata
+    bilanciato     pacchetti da 20 ms, jitter buffer 40-160 ms, buffer
+                   di riproduzione 20-100 ms
+    robusto        pacchetti da 20 ms, jitter buffer 80-400 ms, buffer
+                   di riproduzione 40-200 ms e FEC di Opus: Wi-Fi o
+                   centralino remoto
+
+Il modulo alsa di Baresip non ha opzioni per periodo e buffer ALSA: il
+periodo e' un pacchetto (ptime) e il buffer qualche periodo, quindi il
+ptime del profilo li fissa entrambi.
+
+Sorgente e riproduzione lavorano alla frequenza del codec (8 kHz con
+G.711, 16 kHz con G.722, 48 kHz con Opus), cosi' Baresip non ricampiona.
+G.711 resta sempre tra i codec offerti: il telefono chiamato potrebbe
+non avere gli altri.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+from collections import namedtuple
+
+BASSA_LATENZA = 'bassa_latenza'
+BILANCIATO = 'bilanciato'
+ROBUSTO = 'robusto'
+
+# ptime: ms di audio per pacchetto RTP; jitter: pacchetti (min, max) del
+# jitter buffer adattivo; buffer: ms (min, max) del buffer di
+# riproduzione; fec: correzione degli errori in banda (solo Opus)
+Profilo = namedtuple('Profilo', 'nome ptime jitter buffer fec')
+
+PROFILI = {p.nome: p for p in (
+    Profilo(BASSA_LATENZA, 10, (1, 6), (10, 60), False),
+    Profilo(BILANCIATO, 20, (2, 8), (20, 100), False),
+    Profilo(ROBUSTO, 20, (4, 20), (40, 200), True),
+)}
+
+# modulo: modulo di Baresip; frequenza: campionamento di sorgente e
+# riproduzione; sdp: nomi per audio_codecs dell'account
+Codec = namedtuple('Codec', 'nome modulo frequenza sdp')
+
+G711 = Codec('g711', 'g711', 8000, ('PCMU', 'PCMA'))
+CODEC = {c.nome: c for c in (
+    G711,
+    Codec('g722', 'g722', 16000, ('G722',)),
+    Codec('opus', 'opus', 48000, ('opus',)),
+)}
+
+
+def moduli(codec):
+    """Moduli di Baresip necessari al codec, G.711 compreso."""
+    return [G711.modulo] if codec is G711 else [codec.modulo, G711.modulo]
+
+
+def parametri_account(profilo, codec):
+    """Parametri da aggiungere a ogni riga del file accounts."""
+    sdp = codec.sdp if codec is G711 else codec.sdp + G711.sdp
+    return f";ptime={profilo.ptime};audio_codecs={','.join(sdp)}"
+
+
+def config(profilo, codec):
+    """Righe del file config di Baresip per il profilo e il codec."""
+    righe = [
+        f"ausrc_srate {codec.frequenza}",
+        f"auplay_srate {codec.frequenza}",
+        "ausrc_channels 1",
+        "auplay_channels 1",
+        "audio_buffer {}-{}".format(*profilo.buffer),
+        "jitter_buffer_type adaptive",
+        "jitter_buffer_delay {}-{}".format(*profilo.jitter),
+    ]
+    if codec.modulo == 'opus':
+        righe += [
+            "opus_stereo no",
+            "opus_sprop_stereo no",
+            f"opus_inbandfec {'yes' if profilo.fec else 'no'}",
+        ]
+        if profilo.fec:
+            # La FEC si attiva solo se il codificatore si aspetta perdite
+            righe.append("opus_packet_loss 10")
+    return ''.join(riga + '\n' for riga in righe)
+
+
+def descrivi(profilo, codec):
+    """Riassunto del profilo per il log."""
+    return (f"{profilo.nome}, {codec.nome} a {codec.frequenza} Hz, pacchetti da "
+            f"{profilo.ptime} ms, jitter buffer {profilo.jitter[0] * profilo.ptime}-"
+            f"{profilo.jitter[1] * profilo.ptime} ms, buffer di riproduzione "
+            f"{profilo.buffer[0]}-{profilo.buffer[1]} ms")
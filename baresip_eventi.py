@@ -0,0 +1,151 @@
+"""
+Classificazione dell'output testuale di Baresip.
+
+Ogni riga viene esaminata una sola volta: prima un controllo economico
+su prefisso/parola chiave, poi la regex precompilata solo per le righe
+candidate. Il risultato e' un Evento tipizzato oppure None.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import re
+from collections import namedtuple
+
+# Tipi di evento
+DTMF = 'dtmf'
+CHIAMATA_IN_INGRESSO = 'chiamata_in_ingresso'
+CHIAMATA_SQUILLO = 'chiamata_squillo'
+CHIAMATA_STABILITA = 'chiamata_stabilita'
+CHIAMATA_TERMINATA = 'chiamata_terminata'
+REGISTRAZIONE_OK = 'registrazione_ok'
+REGISTRAZIONE_FALLITA = 'registrazione_fallita'
+BARESIP_PRONTO = 'baresip_pronto'
+
+# tipo: uno dei tipi sopra; valore: tono DTMF, numero chiamante,
+# motivo di chiusura o codice SIP, a seconda del tipo; aor: account
+# della registrazione (None per gli altri eventi)
+Evento = namedtuple('Evento', 'tipo valore aor', defaults=(None,))
+
+_RE_ANSI = re.compile(r'\x1b\[[0-9;]*[a-zA-Z]')
+
+# Righe frequenti che non portano mai eventi utili (jitter buffer,
+# statistiche RTP, codec, moduli): scartate senza altre verifiche
+_PREFISSI_RUMORE = (
+    'jbuf', 'rtp', 'rtcp', 'aubuf', 'auresamp', 'audio: ', 'video: ',
+    'stream: ', 'medianat', 'alsa: ', 'aufile', 'g711', 'module: ',
+    'Populated', 'Local network', 'net: ', 'dns: ', 'mcsend',
+)
+
+# src/call.c
+#   RFC 4733: "call: received in-band DTMF event: '5' (end=0)"
+#   SIP INFO: "call: received SIP INFO DTMF: '*' (duration=100)"
+# Con RFC 4733 ogni tono compare due volte: end=0 alla pressione e end=1
+# al rilascio (KEYCODE_REL per baresip); solo la pressione e' un tono.
+_RE_DTMF = re.compile(r"received (?:in-band DTMF event: '([0-9A-D*#])' \(end=0\)"
+                      r"|SIP INFO DTMF: '([0-9A-D*#])')")
+# modules/menu: "sip:2000@pbx: Incoming call from: Nome sip:100@pbx - (press 'a' to accept)"
+_RE_INCOMING = re.compile(r'(?:^|: )(?:Incoming call from|call: incoming call from)[:\s]',
+                          re.IGNORECASE)
+_RE_SIP_USER = re.compile(r'sip:([^@>\s]+)')
+# src/call.c: "call: SIP Progress: 180 Ringing (/)"
+_RE_PROGRESS = re.compile(r'^call: SIP Progress: (18[03]) ')
+# modules/menu: "sip:2000@pbx: Call established: sip:6400@pbx"
+_RE_ESTABLISHED = re.compile(r': Call established: ')
+# modules/menu: "sip:2000@pbx: Call with sip:6400@pbx terminated (duration: 12 secs, reason: ...)"
+# src/call.c:   "call: session closed: 486 Busy Here"
+_RE_TERMINATED = re.compile(
+    r': Call with \S+ terminated(?: \(duration: [^,)]*(?:, reason: ([^)]*))?\))?'
+    r'|^call: session closed: (.*)$'
+)
+# src/reg.c: "sip:2000@pbx: {0/UDP/v4} 200 OK (Grandstream UCM) [1 binding]"
+_RE_REGISTER = re.compile(r'^(\S+): \{\d+/\w+/v[46]\} (\d{3}) ([^(\[]*)')
+# src/reg.c:   "reg: sip:2000@pbx: 403 Forbidden (Grandstream UCM)"
+_RE_REGISTER_FAIL = re.compile(r'^reg: (\S+): (?!2\d\d )(.*)$'
+                               r'|(?:^(sips?:\S+))?: register failed: (.*)$')
+# reginfo: "> sip:2000@pbx  OK  sip:pbx" (zzz = non registrato, ERR = errore)
+_RE_REGINFO = re.compile(r'(sip:\S+)\s+(.*)$')
+
+
+def pulisci(testo):
+    """Rimuove i codici ANSI, evitando la regex se non ce ne sono."""
+    if '\x1b' in testo:
+        return _RE_ANSI.sub('', testo)
+    return testo
+
+
+def numero_da_uri(testo):
+    """Estrae la parte utente del primo URI SIP nel testo."""
+    m = _RE_SIP_USER.search(testo)
+    return m.group(1) if m else "Sconosciuto"
+
+
+def registrazioni(reginfo):
+    """Stato per account dalla risposta di reginfo: dizionario aor -> registrato.
+
+    Vuoto se la risposta non elenca account riconoscibili.
+    """
+    stato = {}
+    for riga in pulisci(reginfo).splitlines():
+        m = _RE_REGINFO.search(riga)
+        if m:
+            esito = m.group(2).split()
+            stato[m.group(1)] = 'OK' in esito and 'ERR' not in esito and 'zzz' not in esito
+    return stato
+
+
+def classifica(testo):
+    """Classifica una riga gia' ripulita dai codici ANSI.
+
+    Ritorna un Evento oppure None per le righe senza eventi.
+    """
+    if not testo or testo.startswith(_PREFISSI_RUMORE):
+        return None
+
+    if 'DTMF' in testo:
+        m = _RE_DTMF.search(testo)
+        if m:
+            return Evento(DTMF, m.group(1) or m.group(2))
+        return None
+
+    if 'ncoming call' in testo:
+        if _RE_INCOMING.search(testo):
+            return Evento(CHIAMATA_IN_INGRESSO, numero_da_uri(testo.split('call from', 1)[-1]))
+        return None
+
+    if 'terminated' in testo or 'session closed' in testo:
+        m = _RE_TERMINATED.search(testo)
+        if m:
+            return Evento(CHIAMATA_TERMINATA, m.group(1) or m.group(2) or '')
+        return None
+
+    if 'Call established' in testo:
+        if _RE_ESTABLISHED.search(testo):
+            return Evento(CHIAMATA_STABILITA, numero_da_uri(testo.split('established', 1)[-1]))
+        return None
+
+    if 'SIP Progress' in testo:
+        m = _RE_PROGRESS.match(testo)
+        if m:
+            return Evento(CHIAMATA_SQUILLO, m.group(1))
+        return None
+
+    if '} ' in testo:
+        m = _RE_REGISTER.match(testo)
+        if m:
+            aor, codice = m.group(1), m.group(2)
+            if codice.startswith('2'):
+                return Evento(REGISTRAZIONE_OK, codice, aor)
+            return Evento(REGISTRAZIONE_FALLITA, f"{codice} {m.group(3).strip()}", aor)
+        return None
+
+    if testo.startswith('reg: ') or 'register failed' in testo:
+        m = _RE_REGISTER_FAIL.search(testo)
+        if m:
+            return Evento(REGISTRAZIONE_FALLITA, m.group(2) or m.group(4),
+                          m.group(1) or m.group(3) or None)
+        return None
+
+    if testo.startswith('baresip is ready'):
+        return Evento(BARESIP_PRONTO, '')
+
+    return None
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Verifica e benchmark del rivelatore DTMF in banda.
+
+    python3 bench_dtmf.py                      # verifica su segnali sintetici
+    python3 bench_dtmf.py dump-*-dec.wav       # tasti e velocita' su registrazioni
+
+Senza argomenti genera sequenze di toni a livelli, twist e rapporti
+segnale/rumore diversi, rumore bianco e un segnale simile alla voce, e
+controlla che il rivelatore riconosca tutti e soli i tasti inviati; esce
+con errore altrimenti. Poi misura il fattore di tempo reale (secondi di
+calcolo per secondo di audio) su un minuto di segnale. Con dei file WAV
+(per esempio i dump di Baresip di DTMF_AUDIO) riporta i tasti trovati e
+il fattore di tempo reale di ciascuno: va misurato sul Raspberry Pi.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import argparse
+import sys
+import time
+import wave
+
+import dtmf_audio
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FREQUENZA = 8000
+
+
+def tono(tasto, durata, livello_dbfs=-10.0, twist_db=0.0, frequenza=FREQUENZA):
+    """Campioni float di un tasto; twist_db > 0 attenua la frequenza alta."""
+    for riga, tasti in enumerate(dtmf_audio.TASTI):
+        if tasto in tasti:
+            bassa, alta = dtmf_audio.BASSE[riga], dtmf_audio.ALTE[tasti.index(tasto)]
+            break
+    else:
+        raise ValueError(f"tasto non DTMF: {tasto}")
+    t = np.arange(int(durata * frequenza)) / frequenza
+    ampiezza = 32768 * 10 ** (livello_dbfs / 20)
+    return ampiezza * (np.sin(2 * np.pi * bassa * t)
+                       + 10 ** (-twist_db / 20) * np.sin(2 * np.pi * alta * t))
+
+
+def sequenza(tasti, durata=0.07, pausa=0.07, snr_db=None, seme=0, **opzioni):
+    """Tasti separati da silenzio, con rumore bianco facoltativo; int16."""
+    pezzi = [np.zeros(int(pausa * FREQUENZA))]
+    for tasto in tasti:
+        pezzi += [tono(tasto, durata, **opzioni), np.zeros(int(pausa * FREQUENZA))]
+    segnale = np.concatenate(pezzi)
+    if snr_db is not None:
+        potenza = np.mean(np.concatenate(pezzi[1::2]) ** 2)
+        rumore = np.random.default_rng(seme).normal(0, 1, len(segnale))
+        segnale = segnale + rumore * np.sqrt(potenza / 10 ** (snr_db / 10))
+    return np.clip(segnale, -32768, 32767).astype(np.int16)
+
+
+def voce(secondi, seme=0):
+    """Segnale simile alla voce: armoniche di una fondamentale che varia."""
+    rng = np.random.default_rng(seme)
+    n = int(secondi * FREQUENZA)
+    fondamentale = np.repeat(rng.uniform(90, 260, n // 400 + 1), 400)[:n]
+    fase = 2 * np.pi * np.cumsum(fondamentale) / FREQUENZA
+    segnale = sum(rng.uniform(0.2, 1) / k * np.sin(k * fase) for k in range(1, 20))
+    return (segnale / np.abs(segnale).max() * 12000).astype(np.int16)
+
+
+def rileva(campioni, blocco=160):
+    """Tasti riconosciuti passando i campioni a blocchi, come dal file."""
+    rivelatore = dtmf_audio.RivelatoreDTMF(FREQUENZA)
+    tasti = []
+    for i in range(0, len(campioni), blocco):
+        tasti += [t for _, t in rivelatore.analizza(campioni[i:i + blocco])]
+    return ''.join(tasti)
+
+
+def verifica():
+    tutti = '123A456B789C*0#D'
+    casi = [
+        ("tutti i tasti", sequenza(tutti), tutti),
+        ("tasti ripetuti", sequenza('1199##'), '1199##'),
+        ("toni da 50 ms, pause da 40 ms", sequenza('2580', durata=0.05, pausa=0.04), '2580'),
+        ("livello -25 dBFS", sequenza('91', livello_dbfs=-25), '91'),
+        ("twist normale 6 dB", sequenza('147', twist_db=6), '147'),
+        ("twist inverso 3 dB", sequenza('369', twist_db=-3), '369'),
+        ("rumore a 20 dB SNR", sequenza(tutti, snr_db=20), tutti),
+        ("rumore a 12 dB SNR", sequenza('0591', snr_db=12, seme=1), '0591'),
+        ("livello -40 dBFS", sequenza('5', livello_dbfs=-40), ''),
+        ("twist 12 dB", sequenza('5', twist_db=12), ''),
+        ("toni da 20 ms", sequenza('5', durata=0.02), ''),
+        ("rumore bianco", (np.random.default_rng(2).normal(0, 6000, 10 * FREQUENZA))
+         .astype(np.int16), ''),
+        ("voce", voce(10), ''),
+        ("tono singolo 697 Hz", (10000 * np.sin(2 * np.pi * 697 * np.arange(FREQUENZA)
+                                                / FREQUENZA)).astype(np.int16), ''),
+    ]
+    errori = 0
+    for nome, campioni, atteso in casi:
+        trovato = rileva(campioni)
+        esito = 'ok' if trovato == atteso else 'ERRORE'
+        errori += trovato != atteso
+        print(f"  {nome:32} atteso {atteso or '-':17} trovato {trovato or '-':17} {esito}")
+    return errori
+
+
+def fattore_tempo_reale(campioni, frequenza, blocco):
+    rivelatore = dtmf_audio.RivelatoreDTMF(frequenza)
+    tasti = []
+    inizio = time.perf_counter()
+    for i in range(0, len(campioni), blocco):
+        tasti += rivelatore.analizza(campioni[i:i + blocco])
+    return (time.perf_counter() - inizio) / (len(campioni) / frequenza), tasti
+
+
+def leggi_wav(percorso):
+    with wave.open(percorso, 'rb') as f:
+        if f.getsampwidth() != 2:
+            raise ValueError("serve PCM a 16 bit")
+        canali, frequenza = f.getnchannels(), f.getframerate()
+        campioni = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+    return campioni[::canali], frequenza
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('file', nargs='*', help="registrazioni WAV PCM 16 bit")
+    parser.add_argument('--blocco-ms', type=float, default=20,
+                        help="audio passato al rivelatore per lettura (default 20 ms)")
+    args = parser.parse_args()
+    if np is None:
+        sys.exit("NumPy non installato: pip3 install numpy")
+
+    if args.file:
+        for percorso in args.file:
+            try:
+                campioni, frequenza = leggi_wav(percorso)
+            except (OSError, EOFError, ValueError, wave.Error) as e:
+                print(f"{percorso}: {e}")
+                continue
+            rtf, tasti = fattore_tempo_reale(campioni, frequenza,
+                                             int(frequenza * args.blocco_ms / 1000))
+            print(f"{percorso}: {len(campioni) / frequenza:.1f}s a {frequenza} Hz, "
+                  f"tempo reale x{rtf:.4f}")
+            for secondi, tasto in tasti:
+                print(f"  {secondi:8.3f}s  {tasto}")
+        return
+
+    print("Verifica su segnali sintetici:")
+    errori = verifica()
+    campioni = np.concatenate([sequenza('0123456789*#', snr_db=20, seme=s) for s in range(20)]
+                              + [voce(20)])[:60 * FREQUENZA]
+    rtf, _ = fattore_tempo_reale(campioni, FREQUENZA, int(FREQUENZA * args.blocco_ms / 1000))
+    print(f"\nFattore di tempo reale su 60s di audio a blocchi di {args.blocco_ms:g} ms: "
+          f"x{rtf:.4f} ({rtf * 100:.2f}% di un core)")
+    if errori:
+        sys.exit(f"{errori} casi falliti")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark del classificatore di eventi Baresip.
+
+Riproduce le trascrizioni in corpus/ (o i file passati come argomento)
+attraverso baresip_eventi e attraverso la vecchia catena di regex di
+_drain_stdout, e riporta righe/secondo, latenza per evento ed eventi
+riconosciuti da ciascuno.
+
+    python3 bench_eventi.py                     # corpus incluso
+    python3 bench_eventi.py -n 200000 cattura.log
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import argparse
+import glob
+import os
+import re
+import time
+from collections import Counter
+
+import baresip_eventi
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+# Catena originale di _drain_stdout (versione 1.1), per confronto
+_OLD_DTMF = re.compile(r"received (?:in-band DTMF event|SIP INFO DTMF): '([0-9A-D*#])'")
+_OLD_ANSI = re.compile(r'\x1b\[[0-9;]*[a-zA-Z]')
+_OLD_CALL_END = re.compile(
+    r'(?:call.*(?:closed|terminated|rejected|busy)|'
+    r'BYE|'
+    r'487 Request Terminated|'
+    r'486 Busy)',
+    re.IGNORECASE
+)
+
+
+def classifica_vecchio(text):
+    eventi = []
+    clean = _OLD_ANSI.sub('', text)
+    text = clean
+    m = _OLD_DTMF.search(text)
+    if m:
+        eventi.append(('dtmf', m.group(1)))
+    if re.search(r'(?:Incoming call from|call: incoming call from)[:\s]+', text, re.IGNORECASE):
+        m_inc = re.search(r"sip:([^@>]+)", text)
+        eventi.append(('chiamata_in_ingresso', m_inc.group(1) if m_inc else "Sconosciuto"))
+    if _OLD_CALL_END.search(text):
+        eventi.append(('chiamata_terminata', ''))
+    return eventi
+
+
+def classifica_nuovo(text):
+    evento = baresip_eventi.classifica(baresip_eventi.pulisci(text))
+    return [evento] if evento else []
+
+
+def carica(percorsi):
+    righe = []
+    for percorso in percorsi:
+        with open(percorso, encoding='utf-8', errors='replace') as f:
+            righe.extend(line.rstrip('\n') for line in f)
+    return righe
+
+
+def percentile(valori, p):
+    if not valori:
+        return 0.0
+    valori = sorted(valori)
+    return valori[min(len(valori) - 1, int(len(valori) * p / 100))]
+
+
+def misura(nome, funzione, righe):
+    # Passata di throughput senza strumentazione per riga
+    inizio = time.perf_counter()
+    for riga in righe:
+        funzione(riga)
+    durata = time.perf_counter() - inizio
+
+    # Passata con timer per riga, per la latenza delle righe con eventi
+    latenze = []
+    conteggio = Counter()
+    clock = time.perf_counter_ns
+    for riga in righe:
+        t0 = clock()
+        eventi = funzione(riga)
+        t1 = clock()
+        if eventi:
+            latenze.append((t1 - t0) / 1000.0)
+            for evento in eventi:
+                conteggio[evento[0]] += 1
+
+    print(f"{nome}:")
+    print(f"  righe/s:          {len(righe) / durata:,.0f}")
+    print(f"  tempo per riga:   {durata / len(righe) * 1e6:.2f} us")
+    print(f"  latenza evento:   p50={percentile(latenze, 50):.2f} us  "
+          f"p90={percentile(latenze, 90):.2f} us  p99={percentile(latenze, 99):.2f} us")
+    print(f"  eventi:           {dict(sorted(conteggio.items()))}")
+    return conteggio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('file', nargs='*', help="trascrizioni baresip (default: corpus/*.log)")
+    parser.add_argument('-n', '--righe', type=int, default=100000,
+                        help="righe totali da classificare (il corpus viene ripetuto)")
+    args = parser.parse_args()
+
+    percorsi = args.file or sorted(glob.glob(os.path.join(CORPUS_DIR, '*.log')))
+    base = carica(percorsi)
+    if not base:
+        parser.error("nessuna riga da classificare")
+    ripetizioni = max(1, args.righe // len(base))
+    righe = base * ripetizioni
+
+    print(f"Corpus: {len(percorsi)} file, {len(base)} righe, ripetuto {ripetizioni} volte "
+          f"({len(righe)} righe)")
+    print()
+    vecchio = misura("Catena regex originale", classifica_vecchio, righe)
+    print()
+    nuovo = misura("baresip_eventi.classifica", classifica_nuovo, righe)
+    print()
+
+    falsi = vecchio['chiamata_terminata'] - nuovo['chiamata_terminata']
+    print(f"Fine chiamata in piu' rilevate dalla catena originale: {falsi // ripetizioni} per passata")
+    doppi = vecchio['dtmf'] - nuovo['dtmf']
+    print(f"Toni DTMF in piu' rilevati dalla catena originale:     {doppi // ripetizioni} per passata")
+
+
+if __name__ == "__main__":
+    main()
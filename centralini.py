@@ -0,0 +1,206 @@
+"""
+Centralini SIP: account in ordine di preferenza, sonda OPTIONS e scelta
+dell'account per le chiamate in uscita.
+
+Baresip registra l'account di SIP_DOMAIN e quelli di SIP_RISERVA, ma
+rinnova la REGISTER solo ogni regint secondi: se il centralino smette
+di rispondere, Baresip se ne accorge al rinnovo successivo, anche
+cinque minuti dopo. La sonda invia invece una SIP OPTIONS a ogni
+centralino ogni pochi secondi e ne misura il tempo di risposta.
+Qualsiasi risposta SIP dice che il centralino e' vivo, anche un 403 o
+un 405: la OPTIONS non e' autenticata. Dopo `fallimenti_max` sonde
+consecutive senza risposta il centralino e' considerato giu'.
+
+Centralini.scegli() ritorna il primo account sano, cioe' registrato e
+raggiungibile dalla sonda; se nessuno lo e', il primo registrato e in
+ultima istanza il primo della lista.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import asyncio
+import secrets
+import time
+from collections import namedtuple
+
+PORTA_SIP = 5060
+
+# Ritrasmissione della OPTIONS su UDP (RFC 3261, timer T1 e T2)
+T1 = 0.5
+T2 = 4.0
+
+# Cambi di stato riportati da Centralini.sonda()
+GIU = 'giu'
+SU = 'su'
+
+# aor: 'sip:utente@dominio' come nel file accounts di Baresip; host e
+# porta: destinazione della sonda
+Account = namedtuple('Account', 'utente password dominio host porta aor')
+
+# rtt in secondi e codice SIP della risposta, None se la sonda e' fallita;
+# cambio: GIU, SU o None
+Esito = namedtuple('Esito', 'account codice rtt errore cambio')
+
+
+def account(utente, password, dominio, porta=PORTA_SIP):
+    """Account per il dominio 'host[:porta]'; porta vale se il dominio non ne ha una."""
+    host, separatore, numero = dominio.rpartition(':')
+    if separatore and numero.isdigit() and ':' not in host:
+        porta = int(numero)
+    else:
+        host = dominio
+    return Account(utente, password, dominio, host, porta, f'sip:{utente}@{dominio}')
+
+
+# ============================================================
+# Sonda SIP OPTIONS
+# ============================================================
+
+class _RispostaSIP(asyncio.DatagramProtocol):
+    """Attende la risposta finale alla OPTIONS con il Call-ID dato."""
+
+    def __init__(self, call_id, loop):
+        self.call_id = call_id
+        self.risposta = loop.create_future()
+
+    def datagram_received(self, dati, indirizzo):
+        righe = dati.decode('utf-8', 'replace').split('\r\n')
+        parti = righe[0].split(' ', 2)
+        if len(parti) < 2 or parti[0] != 'SIP/2.0' or not parti[1].isdigit():
+            return
+        codice = int(parti[1])
+        if codice < 200:
+            return  # provvisoria: si attende la finale
+        for riga in righe[1:]:
+            nome, _, valore = riga.partition(':')
+            if nome.strip().lower() in ('call-id', 'i') and valore.strip() == self.call_id:
+                if not self.risposta.done():
+                    self.risposta.set_result(codice)
+                return
+
+    def error_received(self, exc):
+        # ICMP port unreachable: sull'host non c'e' nessun centralino
+        if not self.risposta.done():
+            self.risposta.set_exception(exc)
+
+
+def _richiesta(account, ip, porta_locale, call_id):
+    destinazione = (account.host if account.porta == PORTA_SIP
+                    else f'{account.host}:{account.porta}')
+    if ':' in ip:
+        ip = f'[{ip}]'
+    return (f'OPTIONS sip:{destinazione} SIP/2.0\r\n'
+            f'Via: SIP/2.0/UDP {ip}:{porta_locale};branch=z9hG4bK{secrets.token_hex(8)};rport\r\n'
+            f'Max-Forwards: 70\r\n'
+            f'From: <sip:{account.utente}@{destinazione}>;tag={secrets.token_hex(4)}\r\n'
+            f'To: <sip:{destinazione}>\r\n'
+            f'Call-ID: {call_id}\r\n'
+            f'CSeq: 1 OPTIONS\r\n'
+            f'Contact: <sip:{account.utente}@{ip}:{porta_locale}>\r\n'
+            f'Accept: application/sdp\r\n'
+            f'User-Agent: citofono-voip\r\n'
+            f'Content-Length: 0\r\n\r\n').encode()
+
+
+async def options(account):
+    """Invia una SIP OPTIONS al centralino dell'account; ritorna (codice, rtt).
+
+    rtt e' in secondi dal primo invio. Senza risposta la richiesta viene
+    ritrasmessa come da RFC 3261 e l'attesa non finisce: va limitata dal
+    chiamante (asyncio.wait_for). Solleva OSError se l'host non si
+    risolve o la rete rifiuta il pacchetto.
+    """
+    loop = asyncio.get_running_loop()
+    call_id = secrets.token_hex(12)
+    trasporto, protocollo = await loop.create_datagram_endpoint(
+        lambda: _RispostaSIP(call_id, loop), remote_addr=(account.host, account.porta))
+    try:
+        ip, porta_locale = trasporto.get_extra_info('sockname')[:2]
+        richiesta = _richiesta(account, ip, porta_locale, call_id)
+        t_invio = time.monotonic()
+        intervallo = T1
+        while not protocollo.risposta.done():
+            trasporto.sendto(richiesta)
+            await asyncio.wait((protocollo.risposta,), timeout=intervallo)
+            intervallo = min(2 * intervallo, T2)
+        return protocollo.risposta.result(), time.monotonic() - t_invio
+    finally:
+        trasporto.close()
+
+
+# ============================================================
+# Stato dei centralini
+# ============================================================
+
+class StatoCentralino:
+    """Esito delle sonde di un centralino."""
+
+    def __init__(self):
+        self.fallimenti = 0  # sonde consecutive senza risposta
+        self.rtt = None  # secondi, ultima sonda riuscita
+        self.codice = None
+        self.errore = None
+
+
+class Centralini:
+    """Account in ordine di preferenza, con l'esito delle sonde.
+
+    attivo: account scelto per le chiamate in uscita, aggiornato da chi
+    usa scegli().
+    """
+
+    def __init__(self):
+        self.account = ()
+        self.stato = {}  # aor -> StatoCentralino
+        self.attivo = None
+
+    def imposta(self, account):
+        """Nuova lista di account; le sonde restano valide per quelli che c'erano."""
+        self.account = tuple(account)
+        self.stato = {a.aor: self.stato.get(a.aor) or StatoCentralino() for a in self.account}
+        if self.attivo not in self.account:
+            self.attivo = None
+
+    def raggiungibile(self, account, fallimenti_max):
+        return self.stato[account.aor].fallimenti < fallimenti_max
+
+    def scegli(self, registrazioni, fallimenti_max):
+        """Account per le prossime chiamate; None senza account.
+
+        registrazioni: aor -> True/False dalle REGISTER di Baresip.
+        """
+        registrati = [a for a in self.account if registrazioni.get(a.aor)]
+        sani = [a for a in registrati if self.raggiungibile(a, fallimenti_max)]
+        scelti = sani or registrati or self.account
+        return scelti[0] if scelti else None
+
+    def indice_attivo(self):
+        """Posizione dell'account attivo: 0 = principale, 1 = prima riserva..."""
+        return self.account.index(self.attivo) if self.attivo in self.account else 0
+
+    async def sonda(self, timeout, fallimenti_max):
+        """Sonda tutti i centralini insieme; ritorna un Esito per account."""
+        return await asyncio.gather(*(self._sonda(a, timeout, fallimenti_max)
+                                      for a in self.account))
+
+    async def _sonda(self, account, timeout, fallimenti_max):
+        stato = self.stato[account.aor]
+        prima = stato.fallimenti < fallimenti_max
+        try:
+            codice, rtt = await asyncio.wait_for(options(account), timeout)
+        except asyncio.TimeoutError:
+            codice, rtt, errore = None, None, f"nessuna risposta in {timeout:g}s"
+        except OSError as e:
+            codice, rtt, errore = None, None, str(e)
+        else:
+            errore = None
+        if rtt is None:
+            stato.fallimenti += 1
+        else:
+            stato.fallimenti = 0
+            stato.rtt = rtt
+        stato.codice = codice
+        stato.errore = errore
+        dopo = stato.fallimenti < fallimenti_max
+        cambio = None if prima == dopo else SU if dopo else GIU
+        return Esito(account, codice, rtt, errore, cambio)
@@ -22,74 +22,75 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 Versione: 1.1
 """
 
-import RPi.GPIO as GPIO
+import asyncio
+import atexit
+import contextvars
+import enum
+import functools
+import glob
 import time
-import subprocess
 import signal
 import sys
 import os
-import re
-from threading import Thread, Event, Lock
+import json
+import ipaddress
+import itertools
+import threading
 import logging
 
+import annunci
+import api_locale
+import audio_profili
+import baresip_eventi
+import centralini
+import coda_chiamate
+import codici_dtmf
+import configurazione
+import dtmf_audio
+import giornale
+import gpio_backend
+import log_asincrono
+import metriche
+import suoneria
+import tracce
+
 # ============================================================
 # CONFIGURAZIONE
 # ============================================================
 
-def _load_config():
-    """Carica la configurazione da config.env se presente."""
-    config_paths = [
-        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.env'),
-        '/etc/citofono-voip/config.env',
-    ]
-    for path in config_paths:
-        if os.path.isfile(path):
-            with open(path) as f:
-                for line in f:
-                    line = line.strip()
-                    if not line or line.startswith('#'):
-                        continue
-                    if '=' in line:
-                        key, _, value = line.partition('=')
-                        os.environ[key.strip()] = value.strip()
-            break
-
-_load_config()
-
-def _env(key, default, cast=str):
-    """Legge un valore dall'ambiente con fallback al default."""
-    val = os.environ.get(key, default)
-    return cast(val)
-
-# GPIO Pins (BCM numbering)
-PIN_SUONERIA = _env('PIN_SUONERIA', '17', int)
-PIN_RELE_PORTONE = _env('PIN_RELE_PORTONE', '27', int)
-PIN_LED_STATO = _env('PIN_LED_STATO', '22', int)
-
-# Configurazione SIP
-SIP_USERNAME = _env('SIP_USERNAME', '2000')
-SIP_PASSWORD = _env('SIP_PASSWORD', '')
-SIP_DOMAIN = _env('SIP_DOMAIN', 'centralino.ponsacco.local')
-SIP_PORT = _env('SIP_PORT', '5060', int)
-
-# Numero da chiamare quando suona il citofono
-NUMERO_DA_CHIAMARE = _env('NUMERO_DA_CHIAMARE', '6400')
-
-# Codice DTMF per aprire il portone
-DTMF_APRI_PORTONE = _env('DTMF_APRI_PORTONE', '91')
-
-# Timing
-DEBOUNCE_SUONERIA_MS = _env('DEBOUNCE_SUONERIA_MS', '300', int)
-DURATA_APERTURA_SEC = _env('DURATA_APERTURA', '2', int)
-TIMEOUT_CHIAMATA_SEC = _env('TIMEOUT_CHIAMATA', '60', int)
-RITARDO_POST_SUONERIA_SEC = 0.5
-
-# Audio - Verifica con 'aplay -l' e 'arecord -l'
-AUDIO_PLAY_DEVICE = _env('AUDIO_PLAY_DEVICE', 'plughw:1,0')
-AUDIO_REC_DEVICE = _env('AUDIO_REC_DEVICE', 'plughw:1,0')
-
-# Logging
-LOG_FILE = _env('LOG_FILE', '/var/log/citofono-voip.log')
+# I valori sono letti e validati da configurazione.py nell'oggetto CONFIG;
+# una ricarica a caldo (SIGHUP o modifica di config.env) lo sostituisce,
+# quindi il codice va scritto leggendo CONFIG.<NOME> al momento dell'uso,
+# senza copiarne i valori. Vedi configurazione.CAMPI per nomi, tipi e
+# default.
+
+def _locale(indirizzo):
+    """True se l'indirizzo di ascolto e' raggiungibile solo da questa macchina."""
+    try:
+        return ipaddress.ip_address(indirizzo).is_loopback
+    except ValueError:
+        return indirizzo == 'localhost'
+
+
+def _account_sip():
+    """Account SIP in ordine di preferenza: SIP_DOMAIN, poi SIP_RISERVA."""
+    principale = centralini.account(CONFIG.SIP_USERNAME, CONFIG.SIP_PASSWORD,
+                                    CONFIG.SIP_DOMAIN, CONFIG.SIP_PORT)
+    return [principale] + [
+        centralini.account(utente or CONFIG.SIP_USERNAME,
+                           CONFIG.SIP_PASSWORD if password is None else password, dominio)
+        for utente, password, dominio in CONFIG.SIP_RISERVA]
+
+
+def _valori_config(effetto):
+    """Valori attuali delle costanti con quell'effetto (vedi configurazione.CAMPI)."""
+    return tuple(getattr(CONFIG, campo.nome) for campo in configurazione.CAMPI
+                 if campo.effetto == effetto)
+
+
+CONFIG = configurazione.carica()
+
+RITARDO_RISPOSTA_SEC = 0.5
 LOG_LEVEL = logging.INFO
 
 # ============================================================
@@ -97,255 +98,1109 @@ LOG_LEVEL = logging.INFO
 # ============================================================
 
 def _setup_logging():
-    """Configura il logging evitando handler duplicati."""
-    handlers = [logging.StreamHandler()]
-    log_dir = os.path.dirname(LOG_FILE) or '/var/log'
-    if os.path.isdir(log_dir) and os.access(log_dir, os.W_OK):
-        handlers.append(logging.FileHandler(LOG_FILE))
-    logging.basicConfig(
-        level=LOG_LEVEL,
-        format='%(asctime)s [%(levelname)s] %(message)s',
-        handlers=handlers,
+    """Configura il logging asincrono evitando handler duplicati.
+
+    I messaggi vengono solo messi in coda; la scrittura su console e
+    file avviene nel thread di log_asincrono.
+    """
+    if logging.getLogger().handlers:
+        return None
+    log_dir = os.path.dirname(CONFIG.LOG_FILE) or '/var/log'
+    scrivibile = os.path.isdir(log_dir) and os.access(log_dir, os.W_OK)
+    scrittore = log_asincrono.configura(
+        LOG_LEVEL,
+        file=CONFIG.LOG_FILE if scrivibile else None,
+        formato=CONFIG.LOG_FORMATO,
+        max_byte=int(CONFIG.LOG_MAX_MB * 1024 * 1024),
+        backup=CONFIG.LOG_BACKUP,
+        logger_righe='baresip',
+        righe_max=CONFIG.LOG_BARESIP_MAX,
+        righe_finestra=CONFIG.LOG_BARESIP_FINESTRA_SEC,
+        filtro=tracce.FiltroChiamata(),
     )
+    atexit.register(scrittore.ferma)
+    return scrittore
 
-_setup_logging()
+scrittore_log = _setup_logging()
 logger = logging.getLogger(__name__)
+logger_baresip = logging.getLogger('baresip')
+
+# Giornale persistente degli eventi, scritto a lotti dal proprio thread
+GIORNALE = giornale.Giornale(CONFIG.GIORNALE_FILE, CONFIG.GIORNALE_MAX_MB)
+
+# Tracce delle chiamate (id e fasi), scritte dal proprio thread
+TRACCE = tracce.ScrittoreTracce(CONFIG.TRACCE_FILE, CONFIG.TRACCE_FORMATO, CONFIG.TRACCE_MAX_MB)
+
+# Eventi in tempo reale per l'API locale (storia e flusso SSE)
+EVENTI = api_locale.Eventi()
+
+# Suonerie e chiamate in ingresso in attesa di una postazione libera
+CODA = coda_chiamate.CodaChiamate()
+
+# Account SIP in ordine di preferenza e stato dei loro centralini
+CENTRALINI = centralini.Centralini()
+
+# ============================================================
+# METRICHE
+# ============================================================
+
+METRICHE = metriche.Registro()
+M_SUONERIE = METRICHE.contatore(
+    'citofono_suonerie_total', "Suonerie rilevate dopo il debounce")
+M_SUONERIE_SCARTATE = METRICHE.contatore(
+    'citofono_suonerie_scartate_total', "Treni di fronti troppo corti per essere una suoneria")
+M_SUONERIA_DECISIONE = METRICHE.istogramma(
+    'citofono_suoneria_decisione_secondi', "Dal primo fronte al riconoscimento della suoneria")
+M_SUONERIE_IGNORATE = METRICHE.contatore(
+    'citofono_suonerie_ignorate_total', "Suonerie ignorate perche' una chiamata era in corso")
+M_SUONERIE_UNITE = METRICHE.contatore(
+    'citofono_suonerie_unite_total', "Suonerie unite a una della stessa postazione gia' in coda")
+M_CODA_SERVITE = METRICHE.contatore(
+    'citofono_coda_servite_total',
+    "Suonerie e chiamate in ingresso in coda servite appena una postazione si e' liberata")
+M_CODA_SCARTATE = METRICHE.contatore(
+    'citofono_coda_scartate_total',
+    "Suonerie e chiamate in ingresso non servite: coda piena, attesa scaduta o chiamante andato")
+M_CODA_ATTESA = METRICHE.istogramma(
+    'citofono_coda_attesa_secondi', "Attesa in coda delle richieste servite",
+    metriche.BUCKET_CHIAMATA)
+M_SPECULATIVE_CONFERMATE = METRICHE.contatore(
+    'citofono_chiamate_speculative_confermate_total',
+    "Chiamate partite al primo fronte e confermate come suoneria")
+M_SPECULATIVE_ANNULLATE = METRICHE.contatore(
+    'citofono_chiamate_speculative_annullate_total',
+    "Chiamate partite al primo fronte e annullate perche' il treno e' stato scartato")
+M_ANNUNCI = METRICHE.contatore(
+    'citofono_annunci_total', "Annunci vocali riprodotti")
+M_ANNUNCI_DECODIFICATI = METRICHE.contatore(
+    'citofono_annunci_decodificati_total',
+    "Annunci decodificati dal file originale (all'avvio o dopo l'uscita dalla cache)")
+M_TIMEOUT = METRICHE.contatore(
+    'citofono_timeout_chiamata_total', "Chiamate chiuse per TIMEOUT_CHIAMATA")
+M_RIAVVII = METRICHE.contatore(
+    'citofono_riavvii_baresip_total', "Riavvii di Baresip riusciti dopo un guasto")
+M_RIGHE_BARESIP = METRICHE.contatore(
+    'citofono_righe_baresip_total', "Righe lette dall'output di Baresip")
+M_APERTURE = METRICHE.contatore(
+    'citofono_aperture_portone_total', "Attivazioni del rele' del portone")
+M_PROLUNGAMENTI = METRICHE.contatore(
+    'citofono_prolungamenti_portone_total', "Aperture prolungate con il rele' gia' attivo")
+M_SUONERIA_DIAL = METRICHE.istogramma(
+    'citofono_suoneria_dial_secondi', "Dal fronte della suoneria alla conferma di /dial")
+M_DIAL_RISPOSTA = METRICHE.istogramma(
+    'citofono_dial_risposta_secondi', "Dall'invio di /dial alla risposta",
+    metriche.BUCKET_CHIAMATA)
+M_DTMF_RELE = METRICHE.istogramma(
+    'citofono_dtmf_rele_secondi', "Dall'ultimo tono DTMF del codice all'attivazione del rele'")
+M_DTMF_ERRATI = METRICHE.contatore(
+    'citofono_dtmf_errati_total', "Tentativi di codice DTMF errati")
+M_DTMF_BLOCCHI = METRICHE.contatore(
+    'citofono_dtmf_blocchi_total', "Blocchi dei codici DTMF dopo troppi tentativi errati")
+M_DTMF_IN_BANDA = METRICHE.contatore(
+    'citofono_dtmf_in_banda_total', "Toni DTMF riconosciuti nell'audio della chiamata")
+M_RELE_ATTIVO = METRICHE.istogramma(
+    'citofono_rele_attivo_secondi', "Tempo effettivo di rele' attivo per apertura")
+M_DURATA_CHIAMATA = METRICHE.istogramma(
+    'citofono_durata_chiamata_secondi', "Durata delle chiamate stabilite",
+    metriche.BUCKET_CHIAMATA)
+M_GAMBE = METRICHE.contatore(
+    'citofono_gambe_chiamate_total', "Numeri chiamati, contando ogni destinatario di un'ondata")
+M_GAMBE_ANNULLATE = METRICHE.contatore(
+    'citofono_gambe_annullate_total', "Chiamate in uscita chiuse perche' un altro ha risposto")
+M_SONDA_SIP = METRICHE.istogramma(
+    'citofono_sonda_sip_secondi', "Tempo di risposta dei centralini alla sonda SIP OPTIONS")
+M_SONDA_SIP_FALLITE = METRICHE.contatore(
+    'citofono_sonda_sip_fallite_total', "Sonde SIP OPTIONS senza risposta dal centralino")
+M_CAMBI_CENTRALINO = METRICHE.contatore(
+    'citofono_cambi_centralino_total', "Cambi dell'account usato per le chiamate in uscita")
+METRICHE.gauge('citofono_centralino_attivo',
+               "Account delle chiamate in uscita: 0 = SIP_DOMAIN, 1 = prima riserva...",
+               CENTRALINI.indice_attivo)
+M_RICARICHE = METRICHE.contatore(
+    'citofono_ricariche_config_total', "Ricariche della configurazione applicate")
+M_RICARICHE_FALLITE = METRICHE.contatore(
+    'citofono_ricariche_config_fallite_total', "Ricariche scartate per configurazione non valida")
+METRICHE.gauge('citofono_thread', "Thread attivi nel processo", threading.active_count)
+METRICHE.gauge('citofono_api_clienti', "Client collegati al flusso eventi dell'API",
+               lambda: len(EVENTI.clienti))
+METRICHE.gauge('citofono_coda', "Suonerie e chiamate in ingresso in attesa di una postazione",
+               lambda: len(CODA))
+M_API_LENTI = METRICHE.contatore(
+    'citofono_api_clienti_lenti_total', "Client del flusso eventi disconnessi perche' troppo lenti")
+EVENTI.on_lento = M_API_LENTI.inc
 
 
 # ============================================================
 # CLASSI
 # ============================================================
 
+class CtrlTcpClient:
+    """Client del modulo ctrl_tcp di Baresip (JSON su netstring).
+
+    Ogni comando porta un token che Baresip ripete nella risposta, cosi'
+    le risposte vengono correlate al comando che le ha generate. Gli
+    eventi (chiamate, DTMF, registrazione) arrivano sullo stesso socket
+    e vengono passati a on_evento. La lettura e' un task del loop asyncio.
+    """
+
+    def __init__(self, host, port, on_evento=None):
+        self.host = host
+        self.port = port
+        self.on_evento = on_evento  # callback(evento: dict)
+        self.on_chiuso = None  # callback() se la connessione cade
+        self.reader = None
+        self.writer = None
+        self._pendenti = {}  # token -> Future della risposta
+        self._token = itertools.count(1)
+        self._lettore = None
+
+    async def connetti(self, timeout):
+        """Si connette a ctrl_tcp riprovando fino a timeout secondi."""
+        scadenza = time.monotonic() + timeout
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                break
+            except OSError:
+                if time.monotonic() >= scadenza:
+                    return False
+                await asyncio.sleep(0.05)
+        self._lettore = asyncio.ensure_future(self._leggi())
+        logger.info("Connesso a ctrl_tcp %s:%d", self.host, self.port)
+        return True
+
+    @staticmethod
+    def _netstring(payload):
+        data = json.dumps(payload).encode()
+        return b"%d:%s," % (len(data), data)
+
+    async def _leggi(self):
+        """Legge i netstring dal socket e smista risposte ed eventi."""
+        try:
+            while True:
+                intestazione = await self.reader.readuntil(b":")
+                try:
+                    lunghezza = int(intestazione[:-1])
+                except ValueError:
+                    logger.error("ctrl_tcp: netstring non valido, chiudo la connessione")
+                    break
+                data = await self.reader.readexactly(lunghezza + 1)
+                if data[-1:] != b",":
+                    logger.error("ctrl_tcp: netstring non terminato, chiudo la connessione")
+                    break
+                try:
+                    messaggio = json.loads(data[:-1])
+                except ValueError:
+                    logger.warning("ctrl_tcp: JSON non valido: %r", data)
+                    continue
+                self._smista(messaggio)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            logger.debug("Errore lettura ctrl_tcp", exc_info=True)
+        logger.info("Connessione ctrl_tcp chiusa")
+        # I comandi in attesa non avranno risposta
+        for risposta in self._pendenti.values():
+            if not risposta.done():
+                risposta.set_result(None)
+        if self.on_chiuso:
+            self.on_chiuso()
+
+    def _smista(self, messaggio):
+        if messaggio.get("response"):
+            risposta = self._pendenti.get(messaggio.get("token"))
+            if risposta is not None and not risposta.done():
+                risposta.set_result(messaggio)
+        elif messaggio.get("event") and self.on_evento:
+            self.on_evento(messaggio)
+
+    async def comando(self, comando, params="", timeout=None):
+        """Invia un comando e attende la risposta correlata.
+
+        Ritorna il dizionario della risposta, None in caso di timeout
+        o errore di invio.
+        """
+        if timeout is None:
+            timeout = CONFIG.TIMEOUT_COMANDO_SEC
+        token = str(next(self._token))
+        risposta = asyncio.get_running_loop().create_future()
+        self._pendenti[token] = risposta
+        try:
+            self.writer.write(self._netstring(
+                {"command": comando, "params": params, "token": token}))
+            await self.writer.drain()
+            return await asyncio.wait_for(risposta, timeout)
+        except asyncio.TimeoutError:
+            logger.error("ctrl_tcp: nessuna risposta a '%s' entro %.1fs", comando, timeout)
+            return None
+        except OSError as e:
+            logger.error("ctrl_tcp: errore invio '%s': %s", comando, e)
+            return None
+        finally:
+            self._pendenti.pop(token, None)
+
+    def chiudi(self):
+        if self._lettore is not None:
+            self._lettore.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
 class BaresipController:
-    """Controlla Baresip via subprocess/stdio."""
-
-    # Pattern per riconoscere DTMF nell'output di baresip (src/call.c):
-    #   RFC 4733: "received in-band DTMF event: '5' (end=0)"
-    #   SIP INFO: "call: received SIP INFO DTMF: '*' (duration=100)"
-    _RE_DTMF = re.compile(r"received (?:in-band DTMF event|SIP INFO DTMF): '([0-9A-D*#])'")
-    _RE_ANSI = re.compile(r'\x1b\[[0-9;]*[a-zA-Z]')
-    _RE_CALL_END = re.compile(
-        r'(?:call.*(?:closed|terminated|rejected|busy)|'
-        r'BYE|'
-        r'487 Request Terminated|'
-        r'486 Busy)',
-        re.IGNORECASE
+    """Controlla Baresip via ctrl_tcp o via subprocess/stdio."""
+
+    # Eventi dall'output testuale usati anche in modalita' ctrl_tcp
+    _EVENTI_AVVIO = (
+        baresip_eventi.BARESIP_PRONTO,
+        baresip_eventi.REGISTRAZIONE_OK,
+        baresip_eventi.REGISTRAZIONE_FALLITA,
     )
 
     def __init__(self):
         self.processo = None
-        self.lock = Lock()
-        self.chiamata_attiva = Event()
         self.running = False
-        self._drain_thread = None
-        self.on_dtmf = None  # callback(tono: str)
-        self.on_incoming_call = None  # callback(numero: str)
-        self.on_call_end = None  # callback()
-
-    def avvia(self):
-        """Avvia il processo Baresip."""
+        self._lettore = None  # task che legge stdout
+        self.ctrl = None  # CtrlTcpClient se in modalita' ctrl_tcp
+        self.registrato = asyncio.Event()  # almeno un account registrato
+        self.registrazioni = {}  # aor -> True/False, per account
+        self.ua = None  # aor dell'account corrente di Baresip (quello di /dial)
+        self.errore_registrazione = None
+        self._t_pronto = None
+        self._t_registrato = None
+        self.tempo_avvio = None  # secondi da pkill a registrazione riuscita
+        self.rtt_registrazione = None  # secondi da "baresip is ready" a 200 OK
+        # Le callback di chiamata ricevono l'id della chiamata di Baresip
+        # (None in modalita' stdio, dove l'output non lo riporta)
+        self.on_dtmf = None  # callback(tono: str, id_chiamata)
+        self.on_incoming_call = None  # callback(numero: str, id_chiamata)
+        self.on_call_outgoing = None  # callback(id_chiamata)
+        self.on_call_ringing = None  # callback(id_chiamata) al 180/183 del chiamato
+        self.on_call_established = None  # callback(id_chiamata)
+        self.on_call_end = None  # callback(id_chiamata, peer)
+        self.on_guasto = None  # callback(motivo: str) dopo l'avvio
+        self.on_registrazione = None  # callback(aor, ok) quando un account cambia stato
+
+    def _guasto(self, motivo):
+        """Segnala un guasto solo se Baresip era operativo e non in arresto."""
+        if self.running and self.on_guasto:
+            self.on_guasto(motivo)
+
+    @staticmethod
+    async def _esegui(*argv):
+        """Esegue un comando di sistema e ne ritorna il codice di uscita."""
+        processo = await asyncio.create_subprocess_exec(
+            *argv, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        return await processo.wait()
+
+    async def avvia(self):
+        """Avvia Baresip e attende la registrazione SIP.
+
+        Invece di attese fisse, aspetta che le istanze precedenti siano
+        terminate e che il centralino confermi la REGISTER, entro
+        TIMEOUT_AVVIO_BARESIP secondi. Ritorna False se Baresip esce o
+        la registrazione non riesce entro la scadenza.
+        """
         logger.info("Avvio Baresip...")
-
-        # Termina eventuali istanze precedenti
-        subprocess.run(['pkill', '-9', 'baresip'], capture_output=True)
-        time.sleep(1)
-
-        # Avvia Baresip con stdin pipe; stdout viene drenato per evitare
-        # che il buffer si riempia e blocchi il processo
-        self.processo = subprocess.Popen(
-            ['baresip'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+        t_inizio = time.monotonic()
+        scadenza = t_inizio + CONFIG.TIMEOUT_AVVIO_BARESIP_SEC
+
+        # Termina eventuali istanze precedenti e attendi che siano uscite
+        await self._esegui('pkill', '-9', 'baresip')
+        while await self._esegui('pgrep', 'baresip') == 0:
+            if time.monotonic() >= scadenza:
+                logger.error("Istanza precedente di Baresip ancora attiva")
+                return False
+            await asyncio.sleep(0.05)
+
+        self.registrato.clear()
+        self.registrazioni.clear()
+        self.errore_registrazione = None
+        self._t_pronto = None
+
+        # Avvia Baresip con stdin pipe; stdout viene letto da un task
+        # del loop, che ne ricava gli eventi e impedisce che il buffer
+        # della pipe si riempia bloccando il processo
+        self.processo = await asyncio.create_subprocess_exec(
+            'baresip', '-f', CONFIG.BARESIP_DIR,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
         )
+        t_processo = time.monotonic()
+        self._lettore = asyncio.ensure_future(self._leggi_stdout())
+
+        if CONFIG.BARESIP_CONTROLLO == 'ctrl_tcp':
+            ctrl = CtrlTcpClient('127.0.0.1', CONFIG.BARESIP_CTRL_PORT, self._on_evento_ctrl)
+            if await ctrl.connetti(timeout=max(0.0, scadenza - time.monotonic())):
+                ctrl.on_chiuso = lambda: self._guasto("connessione ctrl_tcp persa")
+                self.ctrl = ctrl
+            else:
+                logger.warning("ctrl_tcp non raggiungibile sulla porta %d, uso stdio",
+                               CONFIG.BARESIP_CTRL_PORT)
+
+        # Attendi la registrazione SIP, l'uscita del processo o la scadenza
+        registrazione = asyncio.ensure_future(self.registrato.wait())
+        uscita = asyncio.ensure_future(self.processo.wait())
+        try:
+            await asyncio.wait((registrazione, uscita),
+                               timeout=max(0.0, scadenza - time.monotonic()),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            registrazione.cancel()
+            uscita.cancel()
+
+        if not self.registrato.is_set():
+            if self.processo.returncode is not None:
+                logger.error("Baresip non si è avviato (uscito con codice %s)",
+                             self.processo.returncode)
+            else:
+                logger.error("Registrazione SIP non riuscita entro %gs: %s",
+                             CONFIG.TIMEOUT_AVVIO_BARESIP_SEC,
+                             self.errore_registrazione or "nessuna risposta dal centralino")
+            return False
 
-        # Avvia thread per drenare stdout
-        self._drain_thread = Thread(target=self._drain_stdout, daemon=True)
-        self._drain_thread.start()
-
-        # Attendi registrazione SIP
-        time.sleep(4)
-
-        if self.processo.poll() is None:
-            logger.info("Baresip avviato e connesso (PID: %d)", self.processo.pid)
-            self.running = True
-            return True
+        self.tempo_avvio = self._t_registrato - t_inizio
+        self.rtt_registrazione = self._t_registrato - (self._t_pronto or t_processo)
+        logger.info("Baresip avviato e registrato (PID: %d) in %.2fs, registrazione SIP %.0f ms",
+                    self.processo.pid, self.tempo_avvio, self.rtt_registrazione * 1000)
+        self.running = True
+        return True
+
+    def _on_registrazione(self, ok, dettaglio="", aor=None):
+        """Aggiorna lo stato di registrazione da eventi stdio o ctrl_tcp.
+
+        Baresip resta registrato finche' lo e' almeno un account: perdere
+        un centralino di SIP_RISERVA (o il principale, se ce ne sono
+        altri) cambia solo l'account delle chiamate, senza riavvii.
+        """
+        if aor is None and len(self.registrazioni) == 1:
+            aor = next(iter(self.registrazioni))
+        cambiato = self.registrazioni.get(aor) != ok
+        self.registrazioni[aor] = ok
+        if ok:
+            if cambiato:
+                logger.info("Registrazione SIP riuscita %s", aor or dettaglio)
+            if not self.registrato.is_set():
+                self._t_registrato = time.monotonic()
+                self.registrato.set()
         else:
-            logger.error("Baresip non si è avviato")
+            self.errore_registrazione = dettaglio
+            logger.error("Registrazione SIP fallita: %s",
+                         f"{aor}: {dettaglio}" if aor else dettaglio)
+            if self.registrato.is_set() and not any(self.registrazioni.values()):
+                self.registrato.clear()
+                self._guasto(f"registrazione persa: {dettaglio}")
+        if cambiato and self.on_registrazione:
+            self.on_registrazione(aor, ok)
+
+    async def verifica_registrazione(self):
+        """Interroga Baresip (ctrl_tcp) sullo stato della registrazione.
+
+        Ritorna False se Baresip non risponde o non riporta nessun account
+        registrato; True altrimenti, anche in modalita' stdio dove la
+        verifica non e' disponibile. Aggiorna lo stato dei singoli account
+        se un evento di registrazione e' andato perso.
+        """
+        if self.ctrl is None:
+            return True
+        risposta = await self.ctrl.comando("reginfo")
+        if risposta is None:
             return False
-
-    def _drain_stdout(self):
-        """Legge l'output di baresip, rileva eventi DTMF e previene blocchi sulla pipe."""
+        testo = risposta.get("data", "")
+        stato = baresip_eventi.registrazioni(testo)
+        if not stato:
+            testo = baresip_eventi.pulisci(testo)
+            return "ERR" not in testo and "zzz" not in testo
+        for aor, ok in stato.items():
+            if ok != bool(self.registrazioni.get(aor)):
+                self._on_registrazione(ok, "reginfo", aor)
+        return any(stato.values())
+
+    async def _leggi_stdout(self):
+        """Legge l'output di baresip e ne rileva gli eventi."""
         try:
             while True:
-                line = self.processo.stdout.readline()
+                line = await self.processo.stdout.readline()
                 if not line:
                     break
                 # Decodifica e rimuovi codici ANSI che baresip può inserire
-                text = line.decode(errors='replace').rstrip()
-                clean = self._RE_ANSI.sub('', text)
-                if clean != text:
-                    logger.info("baresip (raw): %r", text)
-                    text = clean
-                logger.info("baresip: %s", text)
-
-                # Cerca toni DTMF ricevuti
-                m = self._RE_DTMF.search(text)
-                if m and self.on_dtmf:
-                    tono = m.group(1)
-                    logger.info("DTMF ricevuto da baresip: %s", tono)
-                    self.on_dtmf(tono)
-                    
-                # Intercetta chiamate in ingresso
-                if self.on_incoming_call and re.search(r'(?:Incoming call from|call: incoming call from)[:\s]+', text, re.IGNORECASE):
-                    # Estrae il numero dal formato SIP URI
-                    m_inc = re.search(r"sip:([^@>]+)", text)
-                    numero = m_inc.group(1) if m_inc else "Sconosciuto"
-                    Thread(target=self.on_incoming_call, args=(numero,), daemon=True).start()
-                    
-                # Rilevamento fine/rifiuto chiamata per riagganciare lo stato
-                if self._RE_CALL_END.search(text):
-                    self.chiamata_attiva.clear()
-                    if self.on_call_end:
-                        self.on_call_end()
-                    logger.info("Chiamata terminata o rifiutata (rilevato da output baresip)")
-                    
-        except Exception:
-            logger.debug("Errore drain stdout", exc_info=True)
+                M_RIGHE_BARESIP.inc()
+                text = baresip_eventi.pulisci(line.decode(errors='replace').rstrip())
+                logger_baresip.info("baresip: %s", text)
+
+                # Con ctrl_tcp gli eventi arrivano gia' strutturati; l'output
+                # serve solo fino alla registrazione, che puo' arrivare prima
+                # che il client ctrl_tcp sia connesso
+                if self.ctrl is not None and self.registrato.is_set():
+                    continue
+
+                evento = baresip_eventi.classifica(text)
+                if evento is not None:
+                    if self.ctrl is not None and evento.tipo not in self._EVENTI_AVVIO:
+                        continue
+                    self._on_evento_stdio(evento)
 
-    def chiama(self, numero):
-        """Effettua una chiamata."""
+        except Exception:
+            logger.debug("Errore lettura stdout", exc_info=True)
+        try:
+            codice = await asyncio.wait_for(self.processo.wait(), 1)
+        except asyncio.TimeoutError:
+            codice = None
+        self._guasto(f"processo terminato (codice {codice})")
+
+    def _on_evento_stdio(self, evento):
+        """Gestisce un evento ricavato dall'output testuale di baresip."""
+        tipo = evento.tipo
+        if tipo == baresip_eventi.DTMF:
+            if self.on_dtmf:
+                logger.info("DTMF ricevuto da baresip: %s", evento.valore)
+                self.on_dtmf(evento.valore, None)
+
+        elif tipo == baresip_eventi.CHIAMATA_IN_INGRESSO:
+            if self.on_incoming_call:
+                self.on_incoming_call(evento.valore, None)
+
+        elif tipo == baresip_eventi.CHIAMATA_SQUILLO:
+            if self.on_call_ringing:
+                self.on_call_ringing(None)
+
+        elif tipo == baresip_eventi.CHIAMATA_STABILITA:
+            if self.on_call_established:
+                self.on_call_established(None)
+
+        elif tipo == baresip_eventi.CHIAMATA_TERMINATA:
+            # Rilevamento fine/rifiuto chiamata per riagganciare lo stato
+            if self.on_call_end:
+                self.on_call_end(None, None)
+            logger.info("Chiamata terminata o rifiutata (rilevato da output baresip)")
+
+        elif tipo == baresip_eventi.BARESIP_PRONTO:
+            self._t_pronto = time.monotonic()
+
+        elif tipo == baresip_eventi.REGISTRAZIONE_OK:
+            self._on_registrazione(True, aor=evento.aor)
+
+        elif tipo == baresip_eventi.REGISTRAZIONE_FALLITA:
+            self._on_registrazione(False, evento.valore, evento.aor)
+
+    def _on_evento_ctrl(self, evento):
+        """Gestisce un evento strutturato ricevuto da ctrl_tcp."""
+        tipo = evento.get("type")
+        id_chiamata = evento.get("id")
+        logger.debug("ctrl_tcp evento: %s", evento)
+
+        if tipo == "CALL_DTMF_START":
+            tono = evento.get("param", "")
+            if tono and self.on_dtmf:
+                logger.info("DTMF ricevuto da baresip: %s", tono)
+                self.on_dtmf(tono, id_chiamata)
+
+        elif tipo == "CALL_INCOMING":
+            if self.on_incoming_call:
+                self.on_incoming_call(baresip_eventi.numero_da_uri(evento.get("peeruri", "")),
+                                      id_chiamata)
+
+        elif tipo in ("CALL_OUTGOING", "CALL_RINGING", "CALL_PROGRESS"):
+            if self.on_call_outgoing:
+                self.on_call_outgoing(id_chiamata)
+            if tipo != "CALL_OUTGOING" and self.on_call_ringing:
+                self.on_call_ringing(id_chiamata)
+
+        elif tipo == "CALL_ESTABLISHED":
+            logger.info("Chiamata stabilita con %s", evento.get("peeruri", "?"))
+            if self.on_call_established:
+                self.on_call_established(id_chiamata)
+
+        elif tipo == "CALL_CLOSED":
+            if self.on_call_end:
+                self.on_call_end(id_chiamata, evento.get("peeruri") or None)
+            logger.info("Chiamata terminata: %s", evento.get("param", ""))
+
+        elif tipo == "REGISTER_OK":
+            self._on_registrazione(True, aor=evento.get("accountaor") or None)
+
+        elif tipo == "REGISTER_FAIL":
+            self._on_registrazione(False, evento.get("param", ""),
+                                   evento.get("accountaor") or None)
+
+    async def _invia(self, comando, params=""):
+        """Invia un comando a Baresip (ctrl_tcp se connesso, altrimenti stdin)."""
+        if self.ctrl is not None:
+            risposta = await self.ctrl.comando(comando, params)
+            if risposta is None:
+                raise OSError(f"nessuna conferma per '{comando}'")
+            if not risposta.get("ok", False):
+                raise OSError(f"'{comando}' rifiutato: {risposta.get('data', '')}")
+            return
+        cmd = f"/{comando} {params}".rstrip() + "\n"
+        self.processo.stdin.write(cmd.encode())
+        await self.processo.stdin.drain()
+
+    async def chiama(self, numero, aor=None):
+        """Effettua una chiamata, dall'account aor se indicato (/uafind)."""
         logger.info("Chiamata in uscita verso %s", numero)
         try:
-            cmd = f"/dial {numero}\n"
-            self.processo.stdin.write(cmd.encode())
-            self.processo.stdin.flush()
-            self.chiamata_attiva.set()
+            if aor is not None and aor != self.ua:
+                await self._invia("uafind", aor)
+                self.ua = aor
+                logger.info("Chiamate in uscita dall'account %s", aor)
+            await self._invia("dial", numero)
             return True
         except Exception as e:
             logger.error("Errore chiamata: %s", e)
             return False
 
-    def rispondi(self):
-        """Risponde alla chiamata."""
+    async def rispondi(self, id_chiamata=None):
+        """Risponde alla chiamata (quella corrente se id_chiamata e' None)."""
         logger.info("Risposta chiamata")
         try:
-            self.processo.stdin.write(b"/accept\n")
-            self.processo.stdin.flush()
-            self.chiamata_attiva.set()
+            await self._invia("accept", id_chiamata or "")
             return True
         except Exception as e:
             logger.error("Errore risposta: %s", e)
             return False
 
-    def riaggancia(self):
-        """Termina la chiamata."""
+    async def riaggancia(self, id_chiamata=None):
+        """Termina la chiamata (quella corrente se id_chiamata e' None)."""
         logger.info("Termine chiamata")
         try:
-            self.processo.stdin.write(b"/hangup\n")
-            self.processo.stdin.flush()
-            self.chiamata_attiva.clear()
-            if self.on_call_end:
-                self.on_call_end()
+            await self._invia("hangup", id_chiamata or "")
             return True
         except Exception as e:
             logger.error("Errore hangup: %s", e)
             return False
 
-    def termina(self):
+    async def sorgente_audio(self, modulo, dispositivo):
+        """Cambia la sorgente audio delle chiamate in corso (/ausrc)."""
+        try:
+            await self._invia("ausrc", f"{modulo},{dispositivo}")
+            return True
+        except Exception as e:
+            logger.error("Errore cambio sorgente audio: %s", e)
+            return False
+
+    async def riproduci(self, file):
+        """Riproduce un file di audio_path sul dispositivo locale (/play)."""
+        try:
+            await self._invia("play", file)
+            return True
+        except Exception as e:
+            logger.error("Errore riproduzione %s: %s", file, e)
+            return False
+
+    async def termina(self):
         """Termina Baresip."""
         self.running = False
-        try:
-            self.processo.stdin.write(b"/quit\n")
-            self.processo.stdin.flush()
-            self.processo.wait(timeout=5)
-        except (OSError, subprocess.TimeoutExpired):
-            if self.processo:
-                self.processo.terminate()
+        if self.processo is not None:
+            try:
+                # /quit su stdin funziona in entrambe le modalita' e non
+                # attende una risposta che Baresip potrebbe non inviare
+                self.processo.stdin.write(b"/quit\n")
+                await self.processo.stdin.drain()
+                await asyncio.wait_for(self.processo.wait(), 5)
+            except (OSError, asyncio.TimeoutError):
+                self._segnala(self.processo.terminate)
+            # Chiude la pipe e raccoglie il processo: con i riavvii del
+            # supervisore non devono restare fd aperti o processi zombie
+            self.processo.stdin.close()
+            try:
+                await asyncio.wait_for(self.processo.wait(), 1)
+            except asyncio.TimeoutError:
+                self._segnala(self.processo.kill)
+                await self.processo.wait()
+            if self._lettore is not None:
+                self._lettore.cancel()
+        if self.ctrl is not None:
+            self.ctrl.chiudi()
         logger.info("Baresip terminato")
 
+    @staticmethod
+    def _segnala(invia):
+        try:
+            invia()
+        except ProcessLookupError:
+            pass
+
+class SupervisoreBaresip:
+    """Sorveglia Baresip e lo riavvia se termina o perde la registrazione.
+
+    Espone la stessa interfaccia di BaresipController (chiama, rispondi,
+    riaggancia, termina e le callback on_*), cosi' il resto del sistema
+    non si accorge dei riavvii. Le callback vengono ricollegate a ogni
+    nuova istanza; una chiamata richiesta mentre Baresip e' in riavvio
+    attende il ripristino ed e' fatta appena torna disponibile.
+    Con piu' account (SIP_RISERVA) le chiamate partono dal primo con il
+    centralino registrato e raggiungibile dalla sonda SIP OPTIONS (vedi
+    centralini.py). Supervisione, watchdog e sonda sono task del loop
+    asyncio.
+    """
+
+    def __init__(self):
+        self.baresip = None
+        self.on_dtmf = None  # callback(tono: str, id_chiamata)
+        self.on_incoming_call = None  # callback(numero: str, id_chiamata)
+        self.on_call_outgoing = None  # callback(id_chiamata)
+        self.on_call_ringing = None  # callback(id_chiamata)
+        self.on_call_established = None  # callback(id_chiamata)
+        self.on_call_end = None  # callback(id_chiamata, peer)
+        self.on_calls_lost = None  # callback(): Baresip riavviato, chiamate perse
+        self.running = False
+        self.disponibile = None  # asyncio.Event, creato nel loop da avvia()
+        self.riavvii = 0
+        self.tempo_ripristino = None  # secondi dell'ultimo ripristino
+        self._guasto = None
+        self._motivo_guasto = None
+        self._programmato = False  # il riavvio in corso e' stato richiesto
+        self._attivita = []
+
+    @property
+    def tempo_avvio(self):
+        return self.baresip.tempo_avvio
+
+    @property
+    def rtt_registrazione(self):
+        return self.baresip.rtt_registrazione
+
+    @property
+    def con_id(self):
+        """True se gli eventi riportano l'id della chiamata (ctrl_tcp)."""
+        return self.baresip.ctrl is not None
+
+    def _inoltra(self, nome):
+        # Ogni evento gira in un contesto proprio: l'id di chiamata che la
+        # postazione imposta per il log (tracce.CHIAMATA) non resta al task
+        # che legge Baresip
+        return lambda *args: getattr(self, nome) and contextvars.copy_context().run(
+            getattr(self, nome), *args)
+
+    def _nuova_istanza(self):
+        baresip = BaresipController()
+        for nome in ('on_dtmf', 'on_incoming_call', 'on_call_outgoing', 'on_call_ringing',
+                     'on_call_established', 'on_call_end'):
+            setattr(baresip, nome, self._inoltra(nome))
+        baresip.on_guasto = lambda motivo: self._on_guasto(baresip, motivo)
+        baresip.on_registrazione = lambda aor, ok: self._on_registrazione(baresip)
+        # La nuova istanza legge gli account attuali; Baresip parte dal primo
+        CENTRALINI.imposta(_account_sip())
+        baresip.ua = CENTRALINI.account[0].aor
+        return baresip
+
+    async def avvia(self):
+        """Primo avvio di Baresip, poi attiva la supervisione."""
+        self._guasto = asyncio.Event()
+        self.disponibile = asyncio.Event()
+        self.baresip = self._nuova_istanza()
+        if not await self.baresip.avvia():
+            return False
+        self.running = True
+        self.disponibile.set()
+        self._attivita.append(asyncio.ensure_future(self._supervisiona()))
+        if CONFIG.WATCHDOG_REGISTRAZIONE_SEC > 0:
+            self._attivita.append(asyncio.ensure_future(self._watchdog_registrazione()))
+        if CONFIG.SONDA_SIP_SEC > 0:
+            self._attivita.append(asyncio.ensure_future(self._sonda_centralini()))
+        self._aggiorna_centralino("avvio")
+        return True
+
+    def _on_guasto(self, baresip, motivo):
+        # Ignora segnalazioni tardive di istanze gia' sostituite
+        if baresip is not self.baresip or not self.running or self._guasto.is_set():
+            return
+        self._motivo_guasto = motivo
+        self.disponibile.clear()
+        self._guasto.set()
+        EVENTI.pubblica('baresip', disponibile=False, motivo=motivo)
+        if self._programmato:
+            logger.info("Riavvio Baresip: %s", motivo)
+        else:
+            logger.error("Baresip non disponibile: %s", motivo)
+
+    def riavvia(self, motivo):
+        """Riavvio programmato, ad esempio dopo un cambio di configurazione.
+
+        Se un riavvio e' gia' in corso non serve altro: la nuova istanza
+        legge la configurazione attuale.
+        """
+        if not self.running or self._guasto.is_set():
+            return
+        self._programmato = True
+        self._on_guasto(self.baresip, motivo)
+
+    async def _watchdog_registrazione(self):
+        """Verifica periodicamente che Baresip risponda e sia registrato."""
+        while self.running:
+            await asyncio.sleep(CONFIG.WATCHDOG_REGISTRAZIONE_SEC)
+            baresip = self.baresip
+            if self.disponibile.is_set() and not await baresip.verifica_registrazione():
+                self._on_guasto(baresip, "registrazione non attiva (reginfo)")
+
+    # --------------------------------------------------------
+    # Scelta del centralino
+    # --------------------------------------------------------
+
+    def _on_registrazione(self, baresip):
+        if baresip is self.baresip and self.disponibile.is_set():
+            self._aggiorna_centralino("registrazione")
+
+    async def _sonda_centralini(self):
+        """Sonda i centralini con SIP OPTIONS ogni SONDA_SIP secondi."""
+        while self.running:
+            for esito in await CENTRALINI.sonda(CONFIG.SONDA_SIP_TIMEOUT_SEC,
+                                                CONFIG.SONDA_SIP_FALLIMENTI):
+                aor = esito.account.aor
+                if esito.rtt is not None:
+                    M_SONDA_SIP.osserva(esito.rtt)
+                else:
+                    M_SONDA_SIP_FALLITE.inc()
+                    logger.debug("Sonda di %s fallita: %s", aor, esito.errore)
+                if esito.cambio == centralini.GIU:
+                    logger.warning("Il centralino di %s non risponde alla sonda: %s",
+                                   aor, esito.errore)
+                    EVENTI.pubblica('sonda', aor=aor, raggiungibile=False,
+                                    errore=esito.errore)
+                elif esito.cambio == centralini.SU:
+                    logger.info("Il centralino di %s risponde di nuovo (%.0f ms)",
+                                aor, esito.rtt * 1000)
+                    EVENTI.pubblica('sonda', aor=aor, raggiungibile=True,
+                                    rtt_ms=round(esito.rtt * 1000, 1))
+            if self.disponibile.is_set():
+                self._aggiorna_centralino("sonda")
+            await asyncio.sleep(CONFIG.SONDA_SIP_SEC)
+
+    def _aggiorna_centralino(self, motivo):
+        """Sceglie l'account delle prossime chiamate; registra ogni cambio."""
+        precedente = CENTRALINI.attivo
+        attivo = CENTRALINI.scegli(self.baresip.registrazioni, CONFIG.SONDA_SIP_FALLIMENTI)
+        CENTRALINI.attivo = attivo
+        if precedente is None or attivo == precedente:
+            return
+        M_CAMBI_CENTRALINO.inc()
+        logger.warning("Chiamate in uscita da %s invece che da %s (%s)",
+                       attivo.aor, precedente.aor, motivo)
+        GIORNALE.registra(giornale.CENTRALINO, numero=attivo.aor, dettaglio=motivo)
+        EVENTI.pubblica('centralino', aor=attivo.aor, precedente=precedente.aor, motivo=motivo)
+
+    def stato_centralini(self):
+        """Account e stato dei loro centralini, per l'API locale."""
+        registrazioni = self.baresip.registrazioni if self.baresip is not None else {}
+        stato = []
+        for account in CENTRALINI.account:
+            rtt = CENTRALINI.stato[account.aor].rtt
+            stato.append({
+                'aor': account.aor,
+                'attivo': account == CENTRALINI.attivo,
+                'registrato': registrazioni.get(account.aor),
+                'raggiungibile': CENTRALINI.raggiungibile(account, CONFIG.SONDA_SIP_FALLIMENTI),
+                'rtt_ms': round(rtt * 1000, 1) if rtt is not None else None,
+            })
+        return stato
+
+    # --------------------------------------------------------
+
+    async def _supervisiona(self):
+        """Attende i guasti e riavvia Baresip con backoff esponenziale."""
+        while self.running:
+            await self._guasto.wait()
+            if not self.running:
+                return
+            t_guasto = time.monotonic()
+
+            # Le chiamate in corso sono perse: libera lo stato del sistema
+            await self.baresip.termina()
+            if self.on_calls_lost:
+                contextvars.copy_context().run(self.on_calls_lost)
+
+            tentativo = 0
+            while self.running:
+                attesa = min(CONFIG.RIAVVIO_MAX_SEC, CONFIG.RIAVVIO_MIN_SEC * (2 ** tentativo))
+                tentativo += 1
+                baresip = self._nuova_istanza()
+                self.baresip = baresip
+                if await baresip.avvia():
+                    break
+                await baresip.termina()
+                logger.warning("Riavvio Baresip fallito (tentativo %d), nuovo tentativo tra %gs",
+                               tentativo, attesa)
+                await asyncio.sleep(attesa)
+            if not self.running:
+                return
+
+            if self._programmato:
+                self._programmato = False
+                GIORNALE.registra(giornale.RIAVVIO_BARESIP, valore=time.monotonic() - t_guasto,
+                                  dettaglio='programmato')
+                logger.info("Baresip riavviato in %.2fs", time.monotonic() - t_guasto)
+            else:
+                self.riavvii += 1
+                M_RIAVVII.inc()
+                self.tempo_ripristino = time.monotonic() - t_guasto
+                GIORNALE.registra(giornale.RIAVVIO_BARESIP, valore=self.tempo_ripristino)
+                logger.info("Baresip ripristinato in %.2fs (tentativi: %d, riavvii totali: %d)",
+                            self.tempo_ripristino, tentativo, self.riavvii)
+            self._guasto.clear()
+            self.disponibile.set()
+            self._aggiorna_centralino("riavvio")
+            EVENTI.pubblica('baresip', disponibile=True,
+                            secondi=round(time.monotonic() - t_guasto, 3))
+
+    async def chiama(self, numero):
+        """Effettua una chiamata; se Baresip e' in riavvio attende il ripristino.
+
+        L'attesa dura al massimo SUONERIA_IN_ATTESA_MAX secondi, poi la
+        chiamata viene scartata.
+        """
+        if not self.disponibile.is_set():
+            logger.warning("Baresip in riavvio, chiamata verso %s in attesa", numero)
+            t_attesa = time.monotonic()
+            try:
+                await asyncio.wait_for(self.disponibile.wait(), CONFIG.SUONERIA_IN_ATTESA_MAX_SEC)
+            except asyncio.TimeoutError:
+                logger.warning("Suoneria in attesa scaduta (%.1fs), scartata",
+                               time.monotonic() - t_attesa)
+                return False
+            logger.info("Richiamo la suoneria arrivata durante il riavvio (%.1fs fa)",
+                        time.monotonic() - t_attesa)
+        # Con un solo account non c'e' niente da scegliere
+        attivo = CENTRALINI.attivo if len(CENTRALINI.account) > 1 else None
+        return await self.baresip.chiama(numero, attivo.aor if attivo is not None else None)
+
+    async def rispondi(self, id_chiamata=None):
+        if not self.disponibile.is_set():
+            logger.error("Baresip in riavvio, impossibile rispondere")
+            return False
+        return await self.baresip.rispondi(id_chiamata)
+
+    async def riaggancia(self, id_chiamata=None):
+        if not self.disponibile.is_set():
+            return False
+        return await self.baresip.riaggancia(id_chiamata)
+
+    async def sorgente_audio(self, modulo, dispositivo):
+        if not self.disponibile.is_set():
+            return False
+        return await self.baresip.sorgente_audio(modulo, dispositivo)
+
+    async def riproduci(self, file):
+        if not self.disponibile.is_set():
+            return False
+        return await self.baresip.riproduci(file)
+
+    async def termina(self):
+        self.running = False
+        for attivita in self._attivita:
+            attivita.cancel()
+        if self.baresip:
+            await self.baresip.termina()
+
 class PortoneController:
-    """Gestisce il relè del portone."""
+    """Gestisce il relè del portone.
 
-    def __init__(self, pin):
+    L'apertura e' un impulso programmato sul loop: apri() attiva il relè
+    e ritorna subito, la chiusura e' un handle call_later. Una nuova
+    apertura con il relè gia' attivo ne prolunga la scadenza invece di
+    ripetere l'impulso. Va chiamato dal thread del loop.
+    """
+
+    def __init__(self, gpio, pin, loop, durata=None, nome='portone'):
+        self.gpio = gpio
         self.pin = pin
-        GPIO.setup(self.pin, GPIO.OUT)
-        GPIO.output(self.pin, GPIO.LOW)
-        self.lock = Lock()
+        self.loop = loop
+        self.durata = CONFIG.DURATA_APERTURA_SEC if durata is None else durata
+        self.nome = nome.upper()
+        self.gpio.setup_uscita(self.pin)
+        self._chiusura = None  # handle della chiusura programmata
+        self._t_apertura = None
+        self._scadenza = None
+        self.ultima_durata = None  # secondi effettivi di relè attivo
+        self.on_apertura = None  # callback() a ogni apertura o prolungamento
+        self.on_chiusura = None  # callback() al rilascio del relè
+
+    @property
+    def aperto(self):
+        return self._chiusura is not None
 
     def apri(self, durata=None):
-        """Attiva il relè per aprire il portone."""
+        """Attiva il relè per aprire il portone, o ne prolunga l'apertura."""
         if durata is None:
-            durata = DURATA_APERTURA_SEC
-        with self.lock:
-            logger.info(">>> APERTURA PORTONE (durata: %ds) <<<", durata)
-            GPIO.output(self.pin, GPIO.HIGH)
-            time.sleep(durata)
-            GPIO.output(self.pin, GPIO.LOW)
-            logger.info(">>> PORTONE CHIUSO <<<")
+            durata = self.durata
+        scadenza = self.loop.time() + durata
+        if self.aperto:
+            if scadenza <= self._scadenza:
+                logger.info("%s già aperto, richiesta assorbita", self.nome)
+                return
+            self._chiusura.cancel()
+            M_PROLUNGAMENTI.inc()
+            GIORNALE.registra(giornale.APERTURA, self.nome.lower(), valore=durata,
+                              dettaglio='prolungata')
+            logger.info(">>> APERTURA %s PROLUNGATA (+%.2fs) <<<",
+                        self.nome, scadenza - self._scadenza)
+        else:
+            self.gpio.scrivi(self.pin, True)
+            self._t_apertura = self.loop.time()
+            M_APERTURE.inc()
+            GIORNALE.registra(giornale.APERTURA, self.nome.lower(), valore=durata)
+            logger.info(">>> APERTURA %s (durata: %gs) <<<", self.nome, durata)
+        # Qui _chiusura e' ancora quella precedente: aperto dice se e' un prolungamento
+        EVENTI.pubblica('apertura', rele=self.nome.lower(), durata=durata, prolungata=self.aperto)
+        self._scadenza = scadenza
+        self._chiusura = self.loop.call_at(scadenza, self._chiudi)
+        if self.on_apertura is not None:
+            self.on_apertura()
+
+    def _chiudi(self):
+        self.gpio.scrivi(self.pin, False)
+        self._chiusura = None
+        self.ultima_durata = self.loop.time() - self._t_apertura
+        M_RELE_ATTIVO.osserva(self.ultima_durata)
+        logger.info(">>> %s CHIUSO (relè attivo %.3fs) <<<", self.nome, self.ultima_durata)
+        if self.on_chiusura is not None:
+            self.on_chiusura()
+
+    def termina(self):
+        """Chiude subito il relè se e' attivo."""
+        if self.aperto:
+            self._chiusura.cancel()
+            self._chiudi()
 
 class SuoneriaMonitor:
-    """Monitora il segnale di suoneria del citofono."""
+    """Monitora il segnale di suoneria del citofono.
 
-    def __init__(self, pin, callback):
+    I fronti passano da suoneria.ClassificatoreSuoneria; callback(t_ns)
+    riceve l'istante del primo fronte della suoneria riconosciuta.
+    Facoltativi: on_primo_fronte(t_ns) al primo fronte di un treno ancora
+    da riconoscere, on_scartata() quando quel treno viene scartato.
+    """
+
+    def __init__(self, gpio, pin, callback, loop, on_primo_fronte=None, on_scartata=None):
+        self.gpio = gpio
         self.pin = pin
         self.callback = callback
-        self.ultimo_trigger = 0
-
-        GPIO.setup(self.pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
-    def avvia(self):
-        """Avvia il monitoraggio con interrupt."""
-        try:
-            GPIO.add_event_detect(
-                self.pin,
-                GPIO.RISING,
-                callback=self._on_trigger,
-                bouncetime=DEBOUNCE_SUONERIA_MS,
-            )
-            logger.info("Monitoraggio suoneria attivo su GPIO%d (interrupt)", self.pin)
-        except Exception as e:
-            logger.warning("Edge detection fallito, uso polling: %s", e)
-            Thread(target=self._polling_loop, daemon=True).start()
-
-    def _polling_loop(self):
-        """Fallback: controlla GPIO con polling rilevando il fronte di salita."""
-        logger.info("Monitoraggio suoneria (polling) attivo su GPIO%d", self.pin)
-        time.sleep(2)  # stabilizzazione iniziale
+        self.on_primo_fronte = on_primo_fronte
+        self.on_scartata = on_scartata
+        self.loop = loop
+        self.parametri = SuoneriaMonitor.parametri_attuali()
+        self.classificatore = suoneria.ClassificatoreSuoneria(
+            fronti=CONFIG.SUONERIA_FRONTI,
+            finestra=CONFIG.SUONERIA_FINESTRA_MS / 1000.0,
+            intervallo_min=CONFIG.SUONERIA_INTERVALLO_MIN_MS / 1000.0,
+            intervallo_max=CONFIG.SUONERIA_INTERVALLO_MAX_MS / 1000.0,
+            pausa=CONFIG.DEBOUNCE_SUONERIA_MS / 1000.0,
+        )
+        self._scartati = 0
+        self._verifica = None  # handle della scadenza del treno in corso
+        self.running = False
 
-        ultimo_stato = GPIO.input(self.pin)
-        debounce_sec = DEBOUNCE_SUONERIA_MS / 1000.0
+        self.gpio.setup_ingresso(self.pin, pull_up=True)
 
-        while True:
-            stato = GPIO.input(self.pin)
+    @staticmethod
+    def parametri_attuali():
+        """Impostazioni globali con cui si crea un monitor."""
+        return (CONFIG.DEBOUNCE_SUONERIA_MS, CONFIG.SUONERIA_FRONTI, CONFIG.SUONERIA_FINESTRA_MS,
+                CONFIG.SUONERIA_INTERVALLO_MIN_MS, CONFIG.SUONERIA_INTERVALLO_MAX_MS)
 
-            # Rileva fronte di salita (LOW -> HIGH) per coerenza con GPIO.RISING
-            if stato == GPIO.HIGH and ultimo_stato == GPIO.LOW:
-                self._on_trigger(self.pin)
-                time.sleep(debounce_sec)
+    def avvia(self):
+        """Avvia il monitoraggio dei fronti di salita.
+
+        Il backend chiama la callback dal proprio thread: il fronte viene
+        passato al loop con call_soon_threadsafe e gestito li'. Con un
+        solo fronte per suoneria il backend filtra gia' i rimbalzi per
+        DEBOUNCE_SUONERIA_MS (bouncetime con RPi.GPIO, timestamp del
+        kernel con gpiod); con un treno di impulsi deve passarli tutti
+        tranne quelli piu' vicini di SUONERIA_INTERVALLO_MIN_MS.
+        """
+        self.running = True
+        debounce_ms = (CONFIG.DEBOUNCE_SUONERIA_MS if self.classificatore.fronti == 1
+                       else CONFIG.SUONERIA_INTERVALLO_MIN_MS)
+        self.gpio.osserva_fronti(
+            self.pin,
+            lambda t_ns: self.loop.call_soon_threadsafe(self._on_trigger, t_ns),
+            debounce_ms,
+        )
 
-            ultimo_stato = stato
-            time.sleep(0.02)
+    def _on_trigger(self, t_ns):
+        """Callback a ogni fronte; t_ns e' l'istante del fronte fornito dal backend.
+
+        Il classificatore confronta gli istanti dei fronti e non l'ora in
+        cui la callback viene eseguita, cosi' resta preciso anche se il
+        processo e' in ritardo nel servire l'evento.
+        """
+        if not self.running:
+            return  # fronte gia' in coda quando il pin e' stato rilasciato
+        logger.debug("GPIO%d fronte: t=%.3f", self.pin, t_ns / 1e9)
+        classificatore = self.classificatore
+        in_corso = classificatore.in_corso
+        t_primo = classificatore.fronte(t_ns)
+        if self._conta_scartati():
+            in_corso = False  # questo fronte apre un nuovo treno
+        if t_primo is not None:
+            M_SUONERIE.inc()
+            M_SUONERIA_DECISIONE.osserva((t_ns - t_primo) / 1e9)
+            self.callback(t_primo)
+            # Dopo la callback: la riga riporta l'id della chiamata appena creata
+            logger.info("!!! SUONERIA CITOFONO RILEVATA !!! (%.0f ms dal primo fronte)",
+                        (t_ns - t_primo) / 1e6)
+        elif classificatore.in_corso:
+            if not in_corso and self.on_primo_fronte is not None:
+                self.on_primo_fronte(t_ns)
+            self._programma_verifica()
+
+    def _conta_scartati(self):
+        """Aggiorna metrica e callback dei treni scartati; True se ce ne sono di nuovi."""
+        scartati = self.classificatore.scartati
+        if scartati == self._scartati:
+            return False
+        M_SUONERIE_SCARTATE.inc(scartati - self._scartati)
+        self._scartati = scartati
+        logger.info("GPIO%d: fronti isolati scartati come disturbo", self.pin)
+        if self.on_scartata is not None:
+            self.on_scartata()
+        return True
+
+    def _programma_verifica(self):
+        """Scarta il treno in corso appena scade, senza attendere altri fronti."""
+        if self._verifica is not None:
+            self._verifica.cancel()
+        ritardo = (self.classificatore.scadenza() - time.monotonic_ns()) / 1e9
+        self._verifica = self.loop.call_later(max(ritardo, 0) + 0.001, self._on_verifica)
+
+    def _on_verifica(self):
+        self._verifica = None
+        if not self.running:
+            return
+        if self.classificatore.verifica(time.monotonic_ns()):
+            self._conta_scartati()
+        elif self.classificatore.in_corso:
+            self._programma_verifica()
 
-    def _on_trigger(self, channel):
-        """Callback quando viene rilevata la suoneria."""
-        now = time.time()
-        logger.debug("GPIO%d trigger: stato=%s, timestamp=%.3f", self.pin, GPIO.input(self.pin), now)
-        if now - self.ultimo_trigger > (DEBOUNCE_SUONERIA_MS / 1000.0):
-            self.ultimo_trigger = now
-            logger.info("!!! SUONERIA CITOFONO RILEVATA !!!")
-            self.callback()
+    def termina(self):
+        """Smette di osservare il pin e lo rilascia."""
+        self.running = False
+        if self._verifica is not None:
+            self._verifica.cancel()
+            self._verifica = None
+        self.gpio.rilascia(self.pin)
 
 class DTMFHandler:
-    """Gestisce la ricezione dei toni DTMF."""
-
-    def __init__(self, baresip, portone):
-        self.baresip = baresip
-        self.portone = portone
-        self.buffer = ""
-        self.ultimo_dtmf = 0
+    """Riconosce i codici DTMF di una postazione ed esegue le azioni associate.
+
+    azioni: dizionario azione -> funzione senza argomenti (vedi codici_dtmf.AZIONI).
+    on_errato: callback(tipo) per i tentativi errati (codici_dtmf.ERRATO o BLOCCATO).
+    """
+
+    def __init__(self, codici, azioni, nome='portone', on_errato=None):
+        self.parametri = DTMFHandler.parametri_attuali()
+        self.motore = codici_dtmf.MotoreDTMF(
+            codici, CONFIG.DTMF_TIMEOUT_CIFRA_SEC, CONFIG.DTMF_DUPLICATO_MS / 1000.0,
+            CONFIG.DTMF_TENTATIVI_MAX, CONFIG.DTMF_BLOCCO_SEC)
+        self.azioni = azioni
+        self.nome = nome
+        self.on_errato = on_errato
         self.running = False
 
+    @staticmethod
+    def parametri_attuali():
+        """Impostazioni DTMF globali con cui si crea un handler."""
+        return (CONFIG.DTMF_TIMEOUT_CIFRA_SEC, CONFIG.DTMF_DUPLICATO_MS,
+                CONFIG.DTMF_TENTATIVI_MAX, CONFIG.DTMF_BLOCCO_SEC)
+
     def avvia(self):
         """Segna l'handler come attivo."""
         self.running = True
@@ -353,22 +1208,40 @@ class DTMFHandler:
 
     def processa_dtmf(self, tono):
         """Processa un tono DTMF ricevuto."""
-        now = time.time()
-
-        # Reset buffer se passato troppo tempo
-        if now - self.ultimo_dtmf > 3:
-            self.buffer = ""
-
-        self.buffer += tono
-        self.ultimo_dtmf = now
-
-        logger.debug("DTMF buffer: %s", self.buffer)
-
-        # Controlla se corrisponde al codice apertura
-        if self.buffer.endswith(DTMF_APRI_PORTONE):
-            logger.info("Codice apertura ricevuto: %s", DTMF_APRI_PORTONE)
-            self.portone.apri()
-            self.buffer = ""
+        t_tono = time.monotonic()
+        esito = self.motore.tono(tono, t_tono)
+        if esito is None:
+            if self.motore.bloccato(t_tono):
+                logger.debug("[%s] DTMF %s ignorato: codici bloccati", self.nome, tono)
+            return
+
+        if esito.tipo == codici_dtmf.CODICE:
+            GIORNALE.registra(giornale.DTMF, self.nome,
+                              dettaglio=f"{esito.azione} {giornale.maschera(esito.codice)}")
+            EVENTI.pubblica('dtmf', postazione=self.nome, esito=esito.tipo, azione=esito.azione)
+            if esito.azione == codici_dtmf.APRI:
+                logger.info("Codice apertura ricevuto: %s", esito.codice)
+            else:
+                logger.info("[%s] Codice %s ricevuto: %s", self.nome, esito.codice, esito.azione)
+            self.azioni[esito.azione]()
+            if esito.azione in (codici_dtmf.APRI, codici_dtmf.APRI_SECONDARIO):
+                M_DTMF_RELE.osserva(time.monotonic() - t_tono)
+        else:
+            M_DTMF_ERRATI.inc()
+            GIORNALE.registra(giornale.DTMF, self.nome, dettaglio=esito.tipo)
+            EVENTI.pubblica('dtmf', postazione=self.nome, esito=esito.tipo)
+            if esito.tipo == codici_dtmf.BLOCCATO:
+                M_DTMF_BLOCCHI.inc()
+                logger.warning("[%s] Troppi codici DTMF errati: ignorati per %gs",
+                               self.nome, self.motore.blocco)
+            else:
+                logger.info("[%s] Codice DTMF errato", self.nome)
+            if self.on_errato is not None:
+                self.on_errato(esito.tipo)
+
+    def azzera(self):
+        """Dimentica le cifre della chiamata finita; un blocco resta attivo."""
+        self.motore.azzera()
 
     def termina(self):
         self.running = False
@@ -377,218 +1250,1461 @@ class DTMFHandler:
 class LEDStatus:
     """Gestisce il LED di stato (opzionale)."""
 
-    def __init__(self, pin):
+    def __init__(self, gpio, pin):
+        self.gpio = gpio
         self.pin = pin
         if pin:
-            GPIO.setup(self.pin, GPIO.OUT)
-            GPIO.output(self.pin, GPIO.LOW)
+            self.gpio.setup_uscita(self.pin)
         self.running = False
+        self._lampeggio = None
 
     def avvia(self):
         if self.pin:
             self.running = True
-            Thread(target=self._blink_loop, daemon=True).start()
+            self._lampeggio = asyncio.ensure_future(self._blink_loop())
 
-    def _blink_loop(self):
+    async def _blink_loop(self):
         """Lampeggio lento = tutto ok."""
         while self.running:
-            if self.pin:
-                GPIO.output(self.pin, GPIO.HIGH)
-                time.sleep(0.1)
-                GPIO.output(self.pin, GPIO.LOW)
-                time.sleep(2)
+            self.gpio.scrivi(self.pin, True)
+            await asyncio.sleep(0.1)
+            self.gpio.scrivi(self.pin, False)
+            await asyncio.sleep(2)
 
-    def errore(self):
+    async def errore(self):
         """Lampeggio veloce = errore."""
         if self.pin:
             for _ in range(10):
-                GPIO.output(self.pin, GPIO.HIGH)
-                time.sleep(0.1)
-                GPIO.output(self.pin, GPIO.LOW)
-                time.sleep(0.1)
+                self.gpio.scrivi(self.pin, True)
+                await asyncio.sleep(0.1)
+                self.gpio.scrivi(self.pin, False)
+                await asyncio.sleep(0.1)
 
     def termina(self):
         self.running = False
+        if self._lampeggio is not None:
+            self._lampeggio.cancel()
+        if self.pin:
+            self.gpio.scrivi(self.pin, False)
+
+    def rilascia(self):
+        """Spegne il LED e ne rilascia il pin."""
+        self.termina()
         if self.pin:
-            GPIO.output(self.pin, GPIO.LOW)
+            self.gpio.rilascia(self.pin)
 
 
 # ============================================================
 # SISTEMA PRINCIPALE
 # ============================================================
 
-class CitofonoVoIP:
-    """Sistema principale Citofono-VoIP."""
+class StatoChiamata(enum.Enum):
+    """Stati della chiamata gestita da una postazione."""
+
+    LIBERO = 'libero'
+    COMPOSIZIONE = 'composizione'  # suoneria rilevata, chiamata programmata
+    IN_USCITA = 'in uscita'  # dial inviato, in attesa di risposta
+    IN_INGRESSO = 'in ingresso'  # chiamata ricevuta, risposta programmata
+    ATTIVA = 'attiva'  # chiamata stabilita
+
+
+class Gamba:
+    """Una chiamata in uscita di una postazione verso uno dei numeri."""
+
+    def __init__(self, numero):
+        self.numero = numero
+        self.id = None  # id Baresip, noto dopo il dial (None in stdio)
+        self.t_dial = None
+        self.in_attesa = False  # dial in attesa che Baresip torni disponibile
+        self.esito = None  # None finche' squilla, poi risposta/chiusa/annullata/fallita/persa
+        self.t_esito = None
+
+    @property
+    def aperta(self):
+        return self.t_dial is not None and self.esito is None
+
+    def chiudi(self, esito):
+        self.esito = esito
+        self.t_esito = time.monotonic()
+
+
+class GestorePostazione:
+    """Suoneria, relè, codice DTMF e macchina a stati di una postazione.
+
+    Ogni postazione ha la propria chiamata, identificata dall'id di
+    Baresip: le postazioni non si bloccano a vicenda. Con piu' numeri
+    configurati la suoneria chiama tutti quelli di un'ondata insieme
+    (una gamba per numero), un'ondata dopo l'altra finche' qualcuno non
+    risponde: la prima risposta vince e le altre gambe sono chiuse.
+    Tutti i metodi girano sul loop del sistema.
+    """
+
+    def __init__(self, postazione, sistema):
+        self.postazione = postazione
+        self.nome = postazione.nome
+        self.sistema = sistema
+        self.loop = sistema.loop
+        self.portone = PortoneController(sistema.gpio, postazione.pin_rele, self.loop,
+                                         postazione.durata_apertura, postazione.nome)
+        self.portone_secondario = None
+        if postazione.pin_rele_secondario:
+            self.portone_secondario = PortoneController(
+                sistema.gpio, postazione.pin_rele_secondario, self.loop,
+                postazione.durata_apertura, f'{postazione.nome} secondario')
+        for portone in (self.portone, self.portone_secondario):
+            if portone is not None:
+                portone.on_apertura = functools.partial(self._on_apertura, portone)
+                portone.on_chiusura = functools.partial(self._on_chiusura, portone)
+        self.dtmf_handler = self._crea_dtmf_handler()
+        self.suoneria = SuoneriaMonitor(sistema.gpio, postazione.pin_suoneria,
+                                        self._on_suoneria, self.loop,
+                                        self._on_primo_fronte, self._on_suoneria_scartata)
+        self.stato = StatoChiamata.LIBERO
+        self.id_chiamata = None  # id Baresip della chiamata stabilita o in ingresso
+        self.gambe = []  # Gamba della chiamata in uscita in corso
+        self._azione = None  # handle del prossimo passo (chiamata o risposta)
+        self._timeout = None  # handle del timeout di chiamata
+        self._task_chiamata = None  # task che chiama le ondate
+        self._componendo = 0  # dial in corso, il task non va interrotto
+        self._t_suoneria_ns = None  # fronte della suoneria in corso
+        self._speculativa = False  # chiamata partita prima che la suoneria sia confermata
+        # Primo fronte del treno che ha gia' avuto la chiamata speculativa:
+        # resta finche' il treno non e' confermato o scartato, anche se la
+        # chiamata finisce prima
+        self._treno_speculativo = None
+        self._dalla_coda = False  # chiamata per una suoneria rimasta in coda
+        # Per il giornale: tipo della chiamata in corso, chiamante, inizio,
+        # (numero, secondi) della risposta ed esito imposto (timeout, annullata)
+        self._direzione = None
+        self._chiamante = None
+        self._t_inizio = None
+        self._risposta = None
+        self._esito = None
+        self._t_dial = None
+        self._t_attiva = None
+        self._ascolto = None  # AscoltoDTMF dei toni in banda della chiamata attiva
+        self.traccia = None  # tracce.Traccia della chiamata in corso
+        self._tracce_rele = {}  # portone -> traccia della chiamata che l'ha aperto
+
+    def _crea_dtmf_handler(self):
+        azioni = {
+            codici_dtmf.APRI: self.portone.apri,
+            codici_dtmf.PROLUNGA: self.prolunga,
+            codici_dtmf.RIAGGANCIA: self.riaggancia,
+        }
+        if self.portone_secondario is not None:
+            azioni[codici_dtmf.APRI_SECONDARIO] = self.portone_secondario.apri
+        return DTMFHandler(self.postazione.codici, azioni, self.nome, self._on_codice_errato)
 
-    def __init__(self):
-        self.running = False
-        self.baresip = None
-        self.portone = None
-        self.suoneria = None
-        self.dtmf_handler = None
-        self.led = None
-        self._call_lock = Lock()
-        self._call_active = False
-        self._chiamata_terminata = Event()
+    def avvia(self):
+        self.dtmf_handler.avvia()
+        self.suoneria.avvia()
+
+    def gpio_usati(self):
+        """Pin GPIO della postazione e impostazioni della suoneria."""
+        return configurazione.pin_postazione(self.postazione), self.suoneria.parametri
+
+    def da_aggiornare(self, postazione):
+        """True se postazione o impostazioni DTMF sono cambiate."""
+        return (postazione != self.postazione
+                or self.dtmf_handler.parametri != DTMFHandler.parametri_attuali())
+
+    def aggiorna(self, postazione):
+        """Applica una nuova configurazione con gli stessi pin; solo da LIBERO.
+
+        Il blocco dei codici DTMF in corso resta attivo.
+        """
+        bloccato_fino = self.dtmf_handler.motore.bloccato_fino
+        self.postazione = postazione
+        self.portone.durata = postazione.durata_apertura
+        if self.portone_secondario is not None:
+            self.portone_secondario.durata = postazione.durata_apertura
+        self.dtmf_handler.termina()
+        self.dtmf_handler = self._crea_dtmf_handler()
+        self.dtmf_handler.motore.bloccato_fino = bloccato_fino
+        self.dtmf_handler.avvia()
+        logger.info("[%s] Configurazione aggiornata: chiama %s, codici %s", self.nome,
+                    postazione.numero, ', '.join(f'{c}={a}' for c, a in postazione.codici.items()))
+
+    def _cambia_stato(self, nuovo):
+        """Transizione della macchina a stati; LIBERO annulla ritardi e timeout."""
+        if nuovo is self.stato:
+            return
+        if self.stato is StatoChiamata.LIBERO:
+            # Nuova chiamata: da qui le righe di log ne riportano l'id
+            self._direzione = (giornale.INGRESSO if nuovo is StatoChiamata.IN_INGRESSO
+                               else giornale.CHIAMATA)
+            self.traccia = tracce.Traccia(self.nome, self._direzione)
+            tracce.CHIAMATA.set(self.traccia.id)
+        logger.info("[%s] Stato chiamata: %s -> %s", self.nome, self.stato.value, nuovo.value)
+        ora = time.monotonic()
+        if nuovo is StatoChiamata.ATTIVA:
+            if self.stato is StatoChiamata.IN_USCITA:
+                M_DIAL_RISPOSTA.osserva(ora - self._t_dial)
+            elif self.stato is StatoChiamata.IN_INGRESSO:
+                self._risposta = (self._chiamante, None)
+            self.traccia.fase(tracce.RISPOSTA, numero=self._risposta[0])
+            self._t_attiva = ora
+            if self.sistema.dtmf_in_banda:
+                self._ascolta_in_banda(self._risposta[0])
+        elif self.stato is StatoChiamata.ATTIVA:
+            M_DURATA_CHIAMATA.osserva(ora - self._t_attiva)
+            self._smetti_ascolto()
+        elif nuovo is StatoChiamata.IN_USCITA:
+            self._t_dial = ora
+        if self.stato is StatoChiamata.LIBERO:
+            self._t_inizio = ora
+        self.stato = nuovo
+        EVENTI.pubblica('stato', postazione=self.nome, stato=nuovo.value, numero=self._numero())
+        if nuovo is StatoChiamata.LIBERO:
+            for handle in (self._azione, self._timeout):
+                if handle is not None:
+                    handle.cancel()
+            self._azione = self._timeout = None
+            # Durante un dial il task non va interrotto: al ritorno vede
+            # lo stato e chiude la gamba appena composta
+            task = self._task_chiamata
+            if task is not None and task is not asyncio.current_task() and not self._componendo:
+                task.cancel()
+            self._task_chiamata = None
+            self._speculativa = self._dalla_coda = False
+            self._chiudi_gambe()
+            self._rapporto_gambe()
+            self._chiudi_traccia(self._registra_chiamata(ora))
+            self.gambe = []
+            self.dtmf_handler.azzera()
+            self.sistema.rilascia_chiamata(self.id_chiamata)
+            self.id_chiamata = None
+            self.sistema.postazione_libera(self)
+
+    def _numero(self):
+        """Numero con cui si parla (o che chiama), None se non c'e' ancora."""
+        if self._risposta is not None:
+            return self._risposta[0]
+        return self._chiamante
+
+    def stato_api(self):
+        """Stato della postazione per l'API locale."""
+        stato = {
+            'nome': self.nome,
+            'stato': self.stato.value,
+            'direzione': self._direzione,
+            'numero': self._numero(),
+            'secondi': (round(time.monotonic() - self._t_inizio, 1)
+                        if self.stato is not StatoChiamata.LIBERO else None),
+            'portone_aperto': self.portone.aperto,
+            'chiamata': self.traccia.id if self.traccia is not None else None,
+        }
+        if self.stato is StatoChiamata.IN_USCITA:
+            stato['chiamati'] = [g.numero for g in self.gambe if g.aperta]
+        if self.portone_secondario is not None:
+            stato['secondario_aperto'] = self.portone_secondario.aperto
+        return stato
+
+    def _registra_chiamata(self, ora):
+        """Scrive nel giornale esito e tempi della chiamata appena finita; ne ritorna l'esito."""
+        if self._direzione is None:
+            return None
+        ingresso = self._direzione == giornale.INGRESSO
+        if self._risposta is not None:
+            numero, secondi = self._risposta
+            esito = 'risposta'
+        else:
+            numero = self._chiamante if ingresso else self.postazione.numero
+            secondi = None
+            esito = self._esito or 'senza_risposta'
+        if ingresso:
+            secondi = ora - self._t_inizio  # durata della chiamata in ingresso
+        GIORNALE.registra(self._direzione, self.nome, numero, secondi, esito)
+        EVENTI.pubblica('fine_chiamata', postazione=self.nome, direzione=self._direzione,
+                        numero=numero, esito=esito, chiamata=self.traccia.id)
+        self._direzione = self._chiamante = self._risposta = self._esito = None
+        return esito
+
+    # --------------------------------------------------------
+    # Traccia della chiamata
+    # --------------------------------------------------------
+
+    def _contesto(self):
+        """Da qui le righe di log riportano l'id della chiamata in corso.
+
+        Solo nelle callback che girano in un contesto proprio: quelle del
+        loop e gli eventi di Baresip (vedi SupervisoreBaresip._inoltra).
+        """
+        if self.traccia is not None:
+            tracce.CHIAMATA.set(self.traccia.id)
+
+    def _chiudi_traccia(self, esito):
+        traccia, self.traccia = self.traccia, None
+        if traccia is not None:
+            traccia.chiudi(esito)
+            self._scrivi_traccia(traccia)
+
+    def _scrivi_traccia(self, traccia):
+        """Scrive la traccia chiusa, se nessun rele' che ha aperto e' ancora attivo."""
+        if traccia.chiusa and traccia not in self._tracce_rele.values():
+            TRACCE.registra(traccia)
+
+    def _on_apertura(self, portone):
+        if self.traccia is not None:
+            self.traccia.fase(tracce.RELE_ON, rele=portone.nome.lower())
+            precedente = self._tracce_rele.get(portone)
+            self._tracce_rele[portone] = self.traccia
+            if precedente is not None and precedente is not self.traccia:
+                self._scrivi_traccia(precedente)  # prolungato da un'altra chiamata
+        self.sistema.annuncia(annunci.PORTA_APERTA)
+
+    def _on_chiusura(self, portone):
+        traccia = self._tracce_rele.pop(portone, None)
+        if traccia is not None:
+            traccia.fase(tracce.RELE_OFF, rele=portone.nome.lower())
+            self._scrivi_traccia(traccia)
+
+    # --------------------------------------------------------
+
+    def _on_codice_errato(self, tipo):
+        self.sistema.annuncia(annunci.CODICI_BLOCCATI if tipo == codici_dtmf.BLOCCATO
+                              else annunci.CODICE_ERRATO)
+
+    def _avvia_timeout(self):
+        self._timeout = self.loop.call_later(self.postazione.timeout_chiamata, self._on_timeout)
+
+    def _on_suoneria(self, t_ns):
+        """Suoneria rilevata: programma la chiamata dopo il ritardo di stabilizzazione."""
+        if t_ns == self._treno_speculativo:
+            # La chiamata partita al primo fronte era per una suoneria vera;
+            # se e' gia' finita (dial falliti, rifiutata) non si richiama
+            self._treno_speculativo = None
+            in_corso, self._speculativa = self._speculativa, False
+            if in_corso:
+                self._contesto()
+                self.traccia.fase(tracce.SUONERIA)
+            M_SPECULATIVE_CONFERMATE.inc()
+            GIORNALE.registra(giornale.SUONERIA, self.nome, dettaglio='speculativa')
+            EVENTI.pubblica('suoneria', postazione=self.nome)
+            if not in_corso:
+                logger.info("[%s] Suoneria confermata, la chiamata speculativa e' gia' terminata",
+                            self.nome)
+                return
+            self.sistema.annuncia(annunci.ATTENDERE, nella_chiamata=False)
+            logger.info("[%s] Suoneria confermata, la chiamata speculativa prosegue", self.nome)
+            return
+        if self.stato is not StatoChiamata.LIBERO:
+            self.sistema.accoda_suoneria(self, t_ns)
+            return
+        GIORNALE.registra(giornale.SUONERIA, self.nome)
+        EVENTI.pubblica('suoneria', postazione=self.nome)
+        self.sistema.annuncia(annunci.ATTENDERE, nella_chiamata=False)
+        self._t_suoneria_ns = t_ns
+        self._cambia_stato(StatoChiamata.COMPOSIZIONE)
+        self.traccia.fase(tracce.FRONTE, t_ns)
+        self.traccia.fase(tracce.SUONERIA)
+        if CONFIG.SUONERIA_SPECULATIVA:
+            # La validazione e' gia' finita: nessun ritardo da aggiungere
+            self._avvia_chiamata()
+        else:
+            self._azione = self.loop.call_later(CONFIG.RITARDO_POST_SUONERIA_SEC,
+                                                self._avvia_chiamata)
+
+    def suoneria_dalla_coda(self, richiesta):
+        """Suoneria rimasta in coda mentre la postazione era impegnata:
+        chiama subito. Il giornale conta l'attesa dalla prima suoneria."""
+        self.sistema.annuncia(annunci.ATTENDERE, nella_chiamata=False)
+        self._t_suoneria_ns = int(richiesta.t_primo * 1e9)
+        self._dalla_coda = True
+        self._cambia_stato(StatoChiamata.COMPOSIZIONE)
+        self.traccia.fase(tracce.FRONTE, self._t_suoneria_ns)
+        self.traccia.fase(tracce.CODA, suonerie=richiesta.suonerie)
+        self._avvia_chiamata()
+
+    def _on_primo_fronte(self, t_ns):
+        """Primo fronte di un treno: con SUONERIA_SPECULATIVA chiama subito,
+        mentre il classificatore finisce di riconoscere la suoneria."""
+        if not CONFIG.SUONERIA_SPECULATIVA or self.stato is not StatoChiamata.LIBERO:
+            return
+        logger.info("[%s] Primo fronte della suoneria, chiamata speculativa", self.nome)
+        self._t_suoneria_ns = t_ns
+        self._cambia_stato(StatoChiamata.COMPOSIZIONE)
+        self.traccia.fase(tracce.FRONTE, t_ns)
+        self._speculativa = True
+        self._treno_speculativo = t_ns
+        self._avvia_chiamata()
+
+    def _on_suoneria_scartata(self):
+        """Il treno era un disturbo: annulla la chiamata speculativa se
+        nessuno ha ancora risposto."""
+        self._treno_speculativo = None
+        if not self._speculativa:
+            return
+        self._speculativa = False
+        self._contesto()
+        M_SPECULATIVE_ANNULLATE.inc()
+        if self.stato is StatoChiamata.ATTIVA:
+            logger.warning("[%s] Suoneria non confermata, ma la chiamata ha gia' risposta: "
+                           "la lascio proseguire", self.nome)
+            return
+        logger.info("[%s] Suoneria non confermata, annullo la chiamata speculativa", self.nome)
+        self._esito = 'annullata'
+        if self.stato is StatoChiamata.IN_USCITA:
+            self._riaggancia()
+        else:
+            self._cambia_stato(StatoChiamata.LIBERO)
+
+    def _avvia_chiamata(self):
+        self._azione = None
+        self._task_chiamata = self.sistema.avvia_task(self._chiama())
+
+    async def _chiama(self):
+        """Chiama i numeri della postazione, un'ondata alla volta."""
+        self._cambia_stato(StatoChiamata.IN_USCITA)
+        ondate = self.postazione.ondate
+        if not self.sistema.baresip.con_id and (len(ondate) > 1 or len(ondate[0]) > 1):
+            # Senza id non si distingue quale gamba ha risposto
+            logger.warning("[%s] Chiamate multiple non disponibili senza ctrl_tcp: "
+                           "chiamo solo %s", self.nome, ondate[0][0])
+            ondate = ((ondate[0][0],),)
+        gambe = self.gambe
+        in_attesa = not self.sistema.baresip.disponibile.is_set()
+        for indice, onda in enumerate(ondate):
+            if indice:
+                await asyncio.sleep(self.postazione.intervallo_ondate)
+                if self.stato is not StatoChiamata.IN_USCITA:
+                    return
+                logger.info("[%s] Nessuna risposta, ondata %d: %s",
+                            self.nome, indice + 1, ', '.join(onda))
+            for numero in onda:
+                gamba = Gamba(numero)
+                gambe.append(gamba)
+                traccia = self.traccia
+                traccia.fase(tracce.DIAL, numero=numero)
+                self._componendo += 1
+                try:
+                    ok = await self.sistema.componi(self, gamba)
+                finally:
+                    self._componendo -= 1
+                if ok and not traccia.chiusa:
+                    # Anche dopo la risposta: Baresip puo' confermare il dial per ultimo
+                    traccia.fase(tracce.DIAL_OK, numero=numero)
+                if gamba is gambe[0] and ok and not in_attesa and not self._dalla_coda:
+                    # Una chiamata tenuta in attesa durante un riavvio, o in
+                    # coda, non misura la latenza
+                    M_SUONERIA_DIAL.osserva((time.monotonic_ns() - self._t_suoneria_ns) / 1e9)
+                if gambe is self.gambe and self._timeout is None:
+                    # Il timeout conta dal primo dial partito: l'attesa di un
+                    # riavvio di Baresip ha il suo limite (SUONERIA_IN_ATTESA_MAX)
+                    self._avvia_timeout()
+                if not ok:
+                    gamba.chiudi('fallita')
+                if gambe is not self.gambe or self.stato is not StatoChiamata.IN_USCITA:
+                    # Risposta o fine chiamata durante il dial: se questa
+                    # gamba squilla ancora e' di troppo
+                    if gamba.aperta:
+                        self._annulla(gamba)
+                    return
+        # Nel frattempo le gambe possono aver gia' risposto o chiuso
+        if gambe is self.gambe:
+            self._task_chiamata = None
+            self._verifica_gambe()
+
+    def _gamba(self, id_chiamata):
+        """Gamba della chiamata in uscita con quell'id (l'unica, senza id)."""
+        if id_chiamata is None:
+            return self.gambe[0] if len(self.gambe) == 1 else None
+        return next((g for g in self.gambe if g.id == id_chiamata), None)
+
+    def _annulla(self, gamba):
+        """Chiude una gamba che sta ancora squillando."""
+        if gamba.id is not None:
+            self.sistema.avvia_task(self.sistema.baresip.riaggancia(gamba.id))
+            self.sistema.rilascia_chiamata(gamba.id)
+        if gamba.esito is None:
+            gamba.chiudi('annullata')
+            M_GAMBE_ANNULLATE.inc()
+
+    def _chiudi_gambe(self):
+        for gamba in self.gambe:
+            if gamba.aperta and gamba.id != self.id_chiamata:
+                self._annulla(gamba)
+
+    def _verifica_gambe(self):
+        """Senza gambe aperte ne' ondate da chiamare la chiamata in uscita e' finita."""
+        if (self.stato is StatoChiamata.IN_USCITA and self._task_chiamata is None
+                and not any(g.aperta for g in self.gambe)):
+            self._cambia_stato(StatoChiamata.LIBERO)
+
+    def _rapporto_gambe(self):
+        """Registra esito e tempo di ogni numero chiamato."""
+        for gamba in self.gambe:
+            if gamba.t_dial is None:
+                continue
+            durata = (gamba.t_esito or time.monotonic()) - gamba.t_dial
+            logger.info("[%s] Chiamata a %s: %s dopo %.2fs", self.nome, gamba.numero,
+                        gamba.esito or 'chiusa', durata)
+
+    def in_ingresso(self, id_chiamata, numero=None):
+        """Prende in carico una chiamata in ingresso e programma la risposta."""
+        self.id_chiamata = id_chiamata
+        self._chiamante = numero
+        self._cambia_stato(StatoChiamata.IN_INGRESSO)
+        self.traccia.fase(tracce.INGRESSO, numero=numero)
+        self._avvia_timeout()
 
-    def _setup_gpio(self):
-        """Inizializza GPIO."""
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-        logger.info("GPIO inizializzati")
-
-    def _on_suoneria(self):
-        """Callback quando suona il citofono — dispatch su thread separato."""
-        Thread(target=self._gestisci_suoneria, daemon=True).start()
-
-    def _gestisci_suoneria(self):
-        """Gestisce la suoneria fuori dal thread di interrupt GPIO."""
-        with self._call_lock:
-            if self._call_active:
-                logger.warning("Chiamata già in corso, ignoro suoneria")
+        # Rispondi automaticamente dopo un breve ritardo
+        self._azione = self.loop.call_later(
+            RITARDO_RISPOSTA_SEC, lambda: self.sistema.avvia_task(self._rispondi()))
+
+    async def _rispondi(self):
+        self._azione = None
+        ok = await self.sistema.baresip.rispondi(self.id_chiamata)
+        if self.stato is StatoChiamata.IN_INGRESSO:
+            self._cambia_stato(StatoChiamata.ATTIVA if ok else StatoChiamata.LIBERO)
+
+    def on_squillo(self, id_chiamata):
+        """Il telefono di una gamba squilla (180 Ringing o 183)."""
+        gamba = self._gamba(id_chiamata) if self.stato is StatoChiamata.IN_USCITA else None
+        if gamba is not None and gamba.aperta:
+            self._contesto()
+            self.traccia.fase(tracce.SQUILLO, numero=gamba.numero)
+
+    def on_stabilita(self, id_chiamata):
+        self._contesto()
+        if self.stato is StatoChiamata.IN_USCITA:
+            gamba = self._gamba(id_chiamata)
+            if gamba is None:
                 return
-            self._call_active = True
-            self._chiamata_terminata.clear()
+            # Prima risposta: vince questa gamba, le altre vengono chiuse
+            gamba.chiudi('risposta')
+            self.id_chiamata = gamba.id
+            self._risposta = (gamba.numero, (time.monotonic_ns() - self._t_suoneria_ns) / 1e9)
+            logger.info("[%s] Risposta da %s dopo %.2fs", self.nome, gamba.numero,
+                        gamba.t_esito - gamba.t_dial)
+            self._chiudi_gambe()
+            self._cambia_stato(StatoChiamata.ATTIVA)
+            self.sistema.risposta(self)
+        elif self.stato is StatoChiamata.ATTIVA and id_chiamata != self.id_chiamata:
+            # Risposta arrivata mentre un'altra gamba aveva gia' vinto
+            gamba = self._gamba(id_chiamata)
+            if gamba is not None:
+                self._annulla(gamba)
+        elif self.stato is StatoChiamata.IN_INGRESSO:
+            self._cambia_stato(StatoChiamata.ATTIVA)
+
+    def on_terminata(self, id_chiamata=None):
+        # In COMPOSIZIONE il dial non e' ancora partito: nessuna chiamata
+        # di Baresip puo' riguardarla, e dopo un riavvio va comunque fatta
+        if self.stato is StatoChiamata.COMPOSIZIONE:
+            return
+        self._contesto()
+        if id_chiamata is not None and id_chiamata != self.id_chiamata:
+            # Gamba non ancora vincente: occupato, rifiuto o annullata
+            gamba = self._gamba(id_chiamata)
+            if gamba is not None:
+                if gamba.esito is None:
+                    gamba.chiudi('chiusa')
+                self.sistema.rilascia_chiamata(id_chiamata)
+                self._verifica_gambe()
+            return
+        self._cambia_stato(StatoChiamata.LIBERO)
+
+    def chiamate_perse(self):
+        """Baresip e' stato riavviato: le sue chiamate non esistono piu'.
+
+        Un dial che attende il ripristino non era ancora partito e resta
+        valido: la chiamata prosegue sulla nuova istanza.
+        """
+        self._contesto()
+        if self.stato is StatoChiamata.IN_USCITA and any(g.in_attesa for g in self.gambe):
+            for gamba in self.gambe:
+                if gamba.aperta and not gamba.in_attesa:
+                    gamba.chiudi('persa')
+            return
+        self.on_terminata()
+
+    def on_dtmf(self, tono, id_chiamata=None):
+        # Solo la gamba che ha risposto puo' aprire
+        if id_chiamata is None or id_chiamata == self.id_chiamata:
+            self._contesto()
+            if self.traccia is not None:
+                self.traccia.fase(tracce.DTMF, origine='sip')
+            if self._ascolto is not None:
+                # Il centralino segnala i toni: quelli in banda sarebbero doppi
+                logger.debug("[%s] DTMF fuori banda, smetto di ascoltare l'audio", self.nome)
+                self._smetti_ascolto()
+            self.dtmf_handler.processa_dtmf(tono)
+
+    def _ascolta_in_banda(self, peer):
+        if not peer:
+            # Senza il remoto non si sa quale dump e' di questa chiamata
+            logger.warning("[%s] Numero del remoto sconosciuto, DTMF in banda non ascoltati",
+                           self.nome)
+            return
+        ascolto = dtmf_audio.AscoltoDTMF(
+            self.sistema.cartella_dump, peer,
+            lambda tono: self.loop.call_soon_threadsafe(self._on_dtmf_in_banda, ascolto, tono))
+        self._ascolto = ascolto
+        ascolto.avvia()
+
+    def _smetti_ascolto(self):
+        if self._ascolto is not None:
+            self._ascolto.termina()
+            self._ascolto = None
+
+    def _on_dtmf_in_banda(self, ascolto, tono):
+        # Toni gia' in coda quando l'ascolto e' finito non contano
+        if ascolto is not self._ascolto:
+            return
+        M_DTMF_IN_BANDA.inc()
+        self._contesto()
+        self.traccia.fase(tracce.DTMF, origine='banda')
+        logger.info("[%s] DTMF in banda: %s", self.nome, tono)
+        self.dtmf_handler.processa_dtmf(tono)
+
+    def _on_timeout(self):
+        """Scadenza del timeout di chiamata: riaggancia e libera lo stato."""
+        self._timeout = None
+        M_TIMEOUT.inc()
+        logger.info("[%s] Timeout chiamata, riaggancio", self.nome)
+        self._esito = 'timeout'
+        self._riaggancia()
+
+    def _riaggancia(self):
+        if self.id_chiamata is not None or not self.sistema.baresip.con_id:
+            self.sistema.avvia_task(self.sistema.baresip.riaggancia(self.id_chiamata))
+        self._cambia_stato(StatoChiamata.LIBERO)
+
+    def prolunga(self):
+        """Azione DTMF: fa ripartire il timeout della chiamata."""
+        if self._timeout is not None:
+            self._timeout.cancel()
+            self._avvia_timeout()
+            logger.info("[%s] Chiamata prolungata di %ds", self.nome,
+                        self.postazione.timeout_chiamata)
 
-        # Piccolo ritardo per stabilizzare
-        time.sleep(RITARDO_POST_SUONERIA_SEC)
+    def riaggancia(self):
+        """Azione DTMF: chiude la chiamata."""
+        logger.info("[%s] Riaggancio richiesto via DTMF", self.nome)
+        self._riaggancia()
 
-        # Effettua la chiamata
-        self.baresip.chiama(NUMERO_DA_CHIAMARE)
+    def termina(self):
+        self._cambia_stato(StatoChiamata.LIBERO)
+        self.dtmf_handler.termina()
+        self.portone.termina()
+        if self.portone_secondario is not None:
+            self.portone_secondario.termina()
+
+    def rilascia(self):
+        """Termina la postazione e ne rilascia i pin, per rimuoverla o rifarla."""
+        self.termina()
+        self.suoneria.termina()
+        self.sistema.gpio.rilascia(self.portone.pin)
+        if self.portone_secondario is not None:
+            self.sistema.gpio.rilascia(self.portone_secondario.pin)
+
+
+def _scrivi_se_cambiato(percorso, contenuto, modo=0o644):
+    """Scrive un file in modo atomico, solo se il contenuto e' cambiato.
+
+    Il nuovo contenuto va in un file temporaneo sincronizzato su disco
+    e poi rinominato: un'interruzione lascia il file vecchio o quello
+    nuovo, mai uno a meta'. Il file sostituito resta come
+    percorso.bak.<data> (un link, senza copiarlo), conservando solo gli
+    ultimi BARESIP_BACKUP. Ritorna True se il file e' stato scritto.
+    """
+    dati = contenuto.encode()
+    try:
+        with open(percorso, 'rb') as f:
+            attuale = f.read()
+    except FileNotFoundError:
+        attuale = None
+    if attuale == dati:
+        logger.debug("%s invariato", percorso)
+        return False
+
+    provvisorio = percorso + '.tmp'
+    with open(os.open(provvisorio, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, modo), 'wb') as f:
+        f.write(dati)
+        f.flush()
+        os.fsync(f.fileno())
+    if attuale is not None and CONFIG.BARESIP_BACKUP:
+        backup = f"{percorso}.bak.{time.strftime('%Y%m%d_%H%M%S')}"
+        try:
+            os.link(percorso, backup)
+            logger.info("Backup %s -> %s", percorso, backup)
+        except FileExistsError:
+            pass
+    os.replace(provvisorio, percorso)
+    cartella = os.open(os.path.dirname(percorso) or '.', os.O_RDONLY)
+    try:
+        os.fsync(cartella)
+    finally:
+        os.close(cartella)
+    logger.info("Scritto %s", percorso)
+
+    # Backup piu' vecchi oltre BARESIP_BACKUP (il nome ordina per data)
+    prefisso = os.path.basename(percorso) + '.bak.'
+    backup = sorted(nome for nome in os.listdir(os.path.dirname(percorso) or '.')
+                    if nome.startswith(prefisso))
+    for nome in backup[:max(0, len(backup) - CONFIG.BARESIP_BACKUP)]:
+        os.remove(os.path.join(os.path.dirname(percorso), nome))
+        logger.info("Rimosso backup %s", nome)
+    return True
 
-        # Thread per gestire timeout
-        Thread(target=self._timeout_chiamata, daemon=True).start()
 
-    def _on_chiamata_in_ingresso(self, numero):
-        """Callback quando arriva una chiamata in ingresso."""
-        logger.info("Chiamata in ingresso da %s", numero)
+class CitofonoVoIP:
+    """Sistema principale Citofono-VoIP.
 
-        with self._call_lock:
-            if self._call_active:
-                logger.warning("Chiamata già in corso, rifiuto")
-                self.baresip.riaggancia()
-                return
-            self._call_active = True
-            self._chiamata_terminata.clear()
-        self.baresip.chiamata_attiva.set()   # evita race con _timeout_chiamata
+    Gira su un unico loop asyncio: l'output e gli eventi di Baresip
+    sono letti da task del loop, i fronti GPIO arrivano dal thread del
+    backend tramite call_soon_threadsafe, ritardi e timeout di chiamata
+    sono handle programmati con call_later. Ogni postazione ha la sua
+    macchina a stati (GestorePostazione); gli eventi di Baresip sono
+    instradati alla postazione proprietaria tramite l'id della chiamata.
+    """
 
-        # Rispondi automaticamente dopo un breve ritardo
-        time.sleep(0.5)
-        self.baresip.rispondi()
+    def __init__(self):
+        self.running = False
+        self.loop = None
+        self.gpio = None
+        self.baresip = None
+        self.postazioni = []  # GestorePostazione, nell'ordine di POSTAZIONI
+        self.led = None
+        self.annunci = None  # CacheAnnunci, se ANNUNCI_DIR e' impostata
+        self._chiamate = {}  # id chiamata Baresip -> GestorePostazione
+        self._lock_dial = None
+        self._dial_in_corso = None  # (gestore, future dell'id) durante un dial
+        self._attivita = set()  # task in corso, referenziati fino al termine
+        self._arresto = None
+        self._server_metriche = None
+        self._osservatore = None  # OsservatoreFile di config.env
+        self._baresip_applicata = None  # valori con cui e' stato avviato Baresip
+        self._metriche_applicate = None  # indirizzo e porta dell'endpoint
+        self._api = None  # api_locale.ServerAPI
+        self._api_applicata = None  # valori API_* con cui e' stata aperta
+        self._in_attesa = False  # modifiche da applicare a fine chiamata
+        self._lock_annunci = None
+        self._ripristino_audio = None  # handle del ritorno al microfono dopo un annuncio
+        self._sorgente_audio = None  # (modulo, dispositivo) di audio_source nella config generata
+        self._scadenza_coda = None  # handle dello scarto della prossima richiesta in coda
+        self.cartella_dump = annunci.cartella_tmpfs('audio')  # snd_path di Baresip
+
+    @property
+    def dtmf_in_banda(self):
+        """True se i toni DTMF vanno cercati anche nell'audio della chiamata."""
+        return bool(CONFIG.DTMF_AUDIO) and dtmf_audio.disponibile()
+
+    @property
+    def occupato(self):
+        """True se almeno una postazione ha una chiamata in corso."""
+        return any(g.stato is not StatoChiamata.LIBERO for g in self.postazioni)
 
-        # Thread per gestire timeout
-        Thread(target=self._timeout_chiamata, daemon=True).start()
+    def _setup_gpio(self):
+        """Inizializza il backend GPIO."""
+        self.gpio = gpio_backend.crea_backend(CONFIG.GPIO_BACKEND, CONFIG.GPIO_CHIP)
+        logger.info("GPIO inizializzati (backend %s)", self.gpio.nome)
+
+    def avvia_task(self, coro):
+        """Esegue una coroutine sul loop mantenendone un riferimento."""
+        task = self.loop.create_task(coro)
+        self._attivita.add(task)
+        task.add_done_callback(self._attivita.discard)
+        return task
+
+    # --------------------------------------------------------
+    # Instradamento delle chiamate
+    # --------------------------------------------------------
+
+    async def componi(self, gestore, gamba):
+        """Invia /dial per una gamba di una postazione e ne ricava l'id.
+
+        Baresip non riporta l'id nella risposta al dial: lo si prende dal
+        primo evento di chiamata in uscita con un id sconosciuto. I dial
+        sono serializzati perche' quell'evento sia attribuito alla
+        gamba giusta.
+        """
+        async with self._lock_dial:
+            id_futuro = self.loop.create_future()
+            self._dial_in_corso = (gestore, gamba, id_futuro)
+            gamba.t_dial = time.monotonic()
+            gamba.in_attesa = not self.baresip.disponibile.is_set()
+            M_GAMBE.inc()
+            try:
+                ok = await self.baresip.chiama(gamba.numero)
+                if ok and self.baresip.con_id:
+                    await asyncio.wait_for(asyncio.shield(id_futuro), CONFIG.TIMEOUT_COMANDO_SEC)
+            except asyncio.TimeoutError:
+                logger.warning("[%s] Id della chiamata a %s non ricevuto da Baresip",
+                               gestore.nome, gamba.numero)
+            finally:
+                gamba.in_attesa = False
+                self._dial_in_corso = None
+        return ok
+
+    def rilascia_chiamata(self, id_chiamata):
+        if id_chiamata is not None:
+            self._chiamate.pop(id_chiamata, None)
+
+    def _assegna(self, id_chiamata, gestore):
+        self._chiamate[id_chiamata] = gestore
+        logger.debug("Chiamata %s -> postazione %s", id_chiamata, gestore.nome)
+
+    def _gestore(self, id_chiamata, assegna=True):
+        """Postazione proprietaria della chiamata, o None.
+
+        Un id sconosciuto viene assegnato alla gamba con un dial in corso,
+        o all'unica gamba in uscita ancora senza id. Senza id (modalita'
+        stdio) la chiamata e' dell'unica postazione impegnata.
+        """
+        if id_chiamata is not None:
+            gestore = self._chiamate.get(id_chiamata)
+            if gestore is None and assegna:
+                if self._dial_in_corso is not None:
+                    gestore, gamba, id_futuro = self._dial_in_corso
+                    if not id_futuro.done():
+                        id_futuro.set_result(id_chiamata)
+                else:
+                    senza_id = [(g, gamba) for g in self.postazioni for gamba in g.gambe
+                                if gamba.aperta and gamba.id is None]
+                    gestore, gamba = senza_id[0] if len(senza_id) == 1 else (None, None)
+                if gestore is not None:
+                    gamba.id = id_chiamata
+                    self._assegna(id_chiamata, gestore)
+            return gestore
+        if len(self.postazioni) == 1:
+            return self.postazioni[0]
+        impegnate = [g for g in self.postazioni
+                     if g.stato not in (StatoChiamata.LIBERO, StatoChiamata.COMPOSIZIONE)]
+        if len(impegnate) == 1:
+            return impegnate[0]
+        if impegnate:
+            logger.warning("Evento di chiamata senza id con più postazioni impegnate: ignorato")
+        return None
+
+    def _on_dtmf(self, tono, id_chiamata):
+        gestore = self._gestore(id_chiamata)
+        if gestore is not None:
+            gestore.on_dtmf(tono, id_chiamata)
+        else:
+            logger.warning("DTMF %s di una chiamata senza postazione, ignorato", tono)
 
-    def _timeout_chiamata(self):
-        """Attende la fine della chiamata o scade il timeout."""
-        terminata = self._chiamata_terminata.wait(timeout=TIMEOUT_CHIAMATA_SEC)
-        if not terminata:
-            logger.info("Timeout chiamata, riaggancio")
-            self.baresip.riaggancia()
+    def _on_chiamata_in_ingresso(self, numero, id_chiamata):
+        """Assegna la chiamata in ingresso a una postazione libera; se sono
+        tutte occupate la chiamata resta a squillare in coda, o e' rifiutata."""
+        logger.info("Chiamata in ingresso da %s", numero)
+        libere = [g for g in self.postazioni if g.stato is StatoChiamata.LIBERO]
+        if libere:
+            self._affida_ingresso(libere, numero, id_chiamata)
+            return
+        # Senza id non si saprebbe a quale chiamata rispondere poi
+        if id_chiamata is not None and CONFIG.SUONERIA_CODA != coda_chiamate.SCARTA:
+            richiesta = coda_chiamate.Richiesta(coda_chiamate.INGRESSO, time.monotonic(),
+                                                id_chiamata=id_chiamata, numero=numero)
+            esito, _ = CODA.aggiungi(richiesta, CONFIG.SUONERIA_CODA, CONFIG.SUONERIA_CODA_MAX)
+            if esito == coda_chiamate.IN_CODA:
+                logger.info("Postazioni occupate, chiamata da %s in coda (%d in attesa)",
+                            numero, len(CODA))
+                self._programma_scadenza_coda()
+                return
+            M_CODA_SCARTATE.inc()
+            logger.warning("Postazioni occupate e coda piena, rifiuto")
+        else:
+            logger.warning("Chiamata già in corso, rifiuto")
+        self.avvia_task(self.baresip.riaggancia(id_chiamata))
+
+    def _affida_ingresso(self, libere, numero, id_chiamata):
+        """Passa la chiamata in ingresso a una delle postazioni libere.
+
+        Si preferisce la postazione che chiama quel numero, cosi' chi
+        richiama un citofono parla con lo stesso ingresso.
+        """
+        gestore = next((g for g in libere
+                        if any(numero in onda for onda in g.postazione.ondate)), libere[0])
+        if id_chiamata is not None:
+            self._assegna(id_chiamata, gestore)
+        gestore.in_ingresso(id_chiamata, numero)
+
+    def _on_chiamata_in_uscita(self, id_chiamata):
+        self._gestore(id_chiamata)
+
+    def _on_chiamata_squillo(self, id_chiamata):
+        gestore = self._gestore(id_chiamata)
+        if gestore is not None:
+            gestore.on_squillo(id_chiamata)
+
+    def _on_chiamata_stabilita(self, id_chiamata):
+        gestore = self._gestore(id_chiamata)
+        if gestore is not None:
+            gestore.on_stabilita(id_chiamata)
+
+    def _on_chiamata_terminata(self, id_chiamata, peer=None):
+        richiesta = CODA.togli_chiamata(id_chiamata) if id_chiamata is not None else None
+        if richiesta is not None:
+            self._scarta_richiesta(richiesta, "il chiamante ha riagganciato")
+            self._programma_scadenza_coda()
+        else:
+            gestore = self._gestore(id_chiamata, assegna=False)
+            if gestore is not None:
+                gestore.on_terminata(id_chiamata)
+        if peer is not None:
+            self._cancella_dump(peer)
+
+    def _cancella_dump(self, peer=None):
+        """Cancella i dump di sndfile delle chiamate chiuse con peer (tutti
+        con None), anche di quelle mai ascoltate: gambe annullate,
+        chiamate rifiutate o in coda. Restano quelli delle chiamate
+        ancora ascoltate e, per non rubarglieli, quelli con lo stesso
+        remoto di un ascolto che non ha ancora trovato il suo."""
+        if not os.path.isdir(self.cartella_dump):
+            return
+        ascolti = [g._ascolto for g in self.postazioni if g._ascolto is not None]
+        if peer is None:
+            percorsi = glob.glob(os.path.join(glob.escape(self.cartella_dump), 'dump-*.wav'))
+        else:
+            if any(a.file is None and a.stesso_remoto(peer) for a in ascolti):
+                return
+            percorsi = dtmf_audio.dump_chiamata(self.cartella_dump, peer)
+        in_uso = {a.file[:-len('-dec.wav')] for a in ascolti if a.file is not None}
+        percorsi = [p for p in percorsi if p.rpartition('-')[0] not in in_uso]
+        cancellati = dtmf_audio.cancella_dump(percorsi)
+        if cancellati:
+            logger.debug("Cancellati %d dump audio di chiamate chiuse", cancellati)
+
+    def _on_chiamate_perse(self):
+        self._chiamate.clear()
+        for richiesta in CODA.togli_ingressi():
+            self._scarta_richiesta(richiesta, "Baresip riavviato")
+        self._programma_scadenza_coda()
+        for gestore in self.postazioni:
+            gestore.chiamate_perse()
+
+    # --------------------------------------------------------
+    # Coda delle richieste a postazioni occupate
+    # --------------------------------------------------------
+
+    def accoda_suoneria(self, gestore, t_ns):
+        """Suoneria a postazione impegnata: in coda secondo SUONERIA_CODA."""
+        esito = 'ignorata'
+        if CONFIG.SUONERIA_CODA != coda_chiamate.SCARTA:
+            richiesta = coda_chiamate.Richiesta(coda_chiamate.SUONERIA, t_ns / 1e9,
+                                                postazione=gestore.nome)
+            esito, _ = CODA.aggiungi(richiesta, CONFIG.SUONERIA_CODA, CONFIG.SUONERIA_CODA_MAX)
+        if esito == coda_chiamate.IN_CODA:
+            logger.info("[%s] Chiamata in corso, suoneria in coda (%d in attesa)",
+                        gestore.nome, len(CODA))
+            self._programma_scadenza_coda()
+        elif esito == coda_chiamate.UNITA:
+            M_SUONERIE_UNITE.inc()
+            logger.info("[%s] Chiamata in corso, suoneria unita a quella in coda", gestore.nome)
+        elif esito == coda_chiamate.PIENA:
+            M_CODA_SCARTATE.inc()
+            logger.warning("[%s] Chiamata in corso e coda piena, ignoro suoneria", gestore.nome)
+            esito = 'ignorata'
+        else:
+            M_SUONERIE_IGNORATE.inc()
+            logger.warning("[%s] Chiamata già in corso, ignoro suoneria", gestore.nome)
+        GIORNALE.registra(giornale.SUONERIA, gestore.nome, dettaglio=esito)
+        EVENTI.pubblica('suoneria', postazione=gestore.nome, coda=esito)
+
+    def risposta(self, gestore):
+        """Risposta alla chiamata in uscita di una postazione: con
+        SUONERIA_CODA=unisci le sue suonerie in coda erano del visitatore
+        che ora parla, e non vanno richiamate."""
+        if CONFIG.SUONERIA_CODA != coda_chiamate.UNISCI:
+            return
+        for richiesta in CODA.togli_suonerie(gestore.nome):
+            M_SUONERIE_UNITE.inc(richiesta.suonerie)
+            logger.info("[%s] Risposta: suonerie in coda unite alla chiamata", gestore.nome)
+        self._programma_scadenza_coda()
+
+    def _servi_coda(self):
+        """Passa le richieste in coda alle postazioni libere, in ordine di arrivo."""
+        if not self.running:
+            return
+        self._scarta_scadute()
+        while True:
+            libere = [g for g in self.postazioni if g.stato is StatoChiamata.LIBERO]
+            richiesta = CODA.prossima({g.nome for g in libere})
+            if richiesta is None:
+                break
+            attesa = time.monotonic() - richiesta.t_primo
+            M_CODA_SERVITE.inc()
+            M_CODA_ATTESA.osserva(attesa)
+            if richiesta.tipo == coda_chiamate.SUONERIA:
+                gestore = next(g for g in libere if g.nome == richiesta.postazione)
+                logger.info("[%s] Postazione libera, servo la suoneria in coda da %.1fs "
+                            "(%d suonerie)", gestore.nome, attesa, richiesta.suonerie)
+                gestore.suoneria_dalla_coda(richiesta)
+            else:
+                logger.info("Postazione libera, rispondo alla chiamata da %s in coda da %.1fs",
+                            richiesta.numero, attesa)
+                self._affida_ingresso(libere, richiesta.numero, richiesta.id_chiamata)
+        self._programma_scadenza_coda()
+
+    def _scarta_richiesta(self, richiesta, motivo):
+        M_CODA_SCARTATE.inc()
+        if richiesta.tipo == coda_chiamate.SUONERIA:
+            logger.warning("[%s] Suoneria tolta dalla coda: %s", richiesta.postazione, motivo)
+        else:
+            logger.warning("Chiamata da %s tolta dalla coda: %s", richiesta.numero, motivo)
+
+    def _scarta_scadute(self):
+        """Toglie le richieste ferme da SUONERIA_CODA_ATTESA_MAX; chi chiama
+        viene riagganciato."""
+        for richiesta in CODA.scadute(time.monotonic(), CONFIG.SUONERIA_CODA_ATTESA_MAX_SEC):
+            self._scarta_richiesta(richiesta, "attesa scaduta")
+            if richiesta.tipo == coda_chiamate.INGRESSO:
+                self.avvia_task(self.baresip.riaggancia(richiesta.id_chiamata))
+
+    def _programma_scadenza_coda(self):
+        if self._scadenza_coda is not None:
+            self._scadenza_coda.cancel()
+            self._scadenza_coda = None
+        scadenza = CODA.scadenza(CONFIG.SUONERIA_CODA_ATTESA_MAX_SEC)
+        if scadenza is not None:
+            self._scadenza_coda = self.loop.call_later(
+                max(scadenza - time.monotonic(), 0) + 0.001, self._on_scadenza_coda)
+
+    def _on_scadenza_coda(self):
+        self._scadenza_coda = None
+        self._scarta_scadute()
+        self._programma_scadenza_coda()
+
+    # --------------------------------------------------------
+    # Annunci vocali
+    # --------------------------------------------------------
+
+    def _avvia_annunci(self):
+        """Decodifica gli annunci in RAM; va fatto prima di generare la
+        configurazione di Baresip, che ne usa la cartella come audio_path."""
+        if not CONFIG.ANNUNCI_DIR:
+            return
+        cache = annunci.CacheAnnunci(CONFIG.ANNUNCI_DIR, annunci.cartella_tmpfs(),
+                                     CONFIG.ANNUNCI_CACHE_KB * 1024,
+                                     audio_profili.CODEC[CONFIG.AUDIO_CODEC].frequenza)
+        try:
+            quanti = cache.avvia()
+        except OSError as e:
+            logger.warning("Annunci vocali non disponibili: %s", e)
+            return
+        self.annunci = cache
+        self._lock_annunci = asyncio.Lock()
+        M_ANNUNCI_DECODIFICATI.inc(cache.decodifiche)
+        logger.info("Annunci vocali: %d in memoria (%d kB) da %s", quanti,
+                    cache.occupati // 1024, CONFIG.ANNUNCI_DIR)
+        if 'aufile' not in CONFIG.BARESIP_MODULI:
+            logger.warning("Modulo aufile non in BARESIP_MODULI: annunci solo sul citofono")
+
+    def annuncia(self, nome, nella_chiamata=True):
+        """Riproduce un annuncio nella chiamata (a chi ha risposto) o sul
+        citofono (al visitatore); senza il file dell'annuncio non fa nulla.
+
+        Baresip cambia la sorgente audio di tutte le chiamate in corso:
+        con chiamate contemporanee l'annuncio arriva a tutte.
+        """
+        if self.annunci is None or (nella_chiamata and 'aufile' not in CONFIG.BARESIP_MODULI):
+            return
+        self.avvia_task(self._annuncia(nome, nella_chiamata))
+
+    async def _annuncia(self, nome, nella_chiamata):
+        cache = self.annunci
+        async with self._lock_annunci:
+            decodifiche = cache.decodifiche
+            if cache.in_memoria(nome):
+                annuncio = cache.prepara(nome)
+            else:
+                # Uscito dalla cache: la decodifica legge la SD, fuori dal loop
+                annuncio = await self.loop.run_in_executor(None, cache.prepara, nome)
+            M_ANNUNCI_DECODIFICATI.inc(cache.decodifiche - decodifiche)
+        if annuncio is None:
+            return
+        if nella_chiamata:
+            if self._ripristino_audio is not None:
+                self._ripristino_audio.cancel()
+            ok = await self.baresip.sorgente_audio('aufile', annuncio.percorso)
+            # Il microfono torna comunque: /ausrc cambia anche la sorgente predefinita
+            self._ripristino_audio = self.loop.call_later(
+                annuncio.durata if ok else 0, self._ripristina_audio)
+        else:
+            ok = await self.baresip.riproduci(os.path.basename(annuncio.percorso))
+        if ok:
+            M_ANNUNCI.inc()
+            logger.info("Annuncio '%s' %s (%.1fs)", nome,
+                        "nella chiamata" if nella_chiamata else "sul citofono", annuncio.durata)
+
+    def _ripristina_audio(self):
+        self._ripristino_audio = None
+        self.avvia_task(self.baresip.sorgente_audio(*self._sorgente_audio))
+
+    # --------------------------------------------------------
+    # Ricarica della configurazione
+    # --------------------------------------------------------
+
+    def ricarica(self):
+        """Rilegge la configurazione e applica solo cio' che e' cambiato.
+
+        Una configurazione non valida viene scartata e resta quella in uso.
+        Le costanti lette al momento dell'uso valgono subito; per il resto
+        vedi _applica_modifiche().
+        """
+        global CONFIG
+        try:
+            nuova = configurazione.carica()
+            if not nuova.SIP_PASSWORD:
+                raise ValueError("SIP_PASSWORD non configurata")
+        except (OSError, ValueError) as e:
+            M_RICARICHE_FALLITE.inc()
+            logger.error("Configurazione non valida, mantengo la precedente: %s", e)
+            return False
+        cambiate = CONFIG.differenze(nuova)
+        # Le costanti lette solo all'avvio restano quelle in uso: restano
+        # diverse dal file, e segnalate a ogni ricarica, fino al riavvio
+        all_avvio = sorted(nome for nome in cambiate
+                           if configurazione.EFFETTI[nome] == configurazione.AVVIO)
+        applicate = sorted(cambiate.difference(all_avvio))
+        if all_avvio:
+            logger.warning("Modifiche attive al prossimo riavvio del servizio: %s",
+                           ', '.join(all_avvio))
+        if not applicate:
+            logger.info("Configurazione ricaricata: nessuna modifica da applicare")
+            return True
+        CONFIG = nuova.con_valori(CONFIG, all_avvio)
+        M_RICARICHE.inc()
+        logger.info("Configurazione ricaricata, modificati: %s", ', '.join(applicate))
+        self._applica_modifiche()
+        return True
+
+    def _applica_modifiche(self):
+        """Porta postazioni, LED, Baresip e metriche alla configurazione attuale.
+
+        Codici, numeri e durate di una postazione cambiano appena quella
+        postazione e' libera; pin GPIO e riavvio di Baresip aspettano che
+        lo siano tutte. Viene richiamata ogni volta che una postazione
+        torna libera finche' resta qualcosa in attesa.
+        """
+        if not self.running:
+            return
+        in_attesa = []
+        nuove = {p.nome: p for p in CONFIG.POSTAZIONI}
+        gpio_cambiati = (nuove.keys() != {g.nome for g in self.postazioni}
+                         or self.led.pin != CONFIG.PIN_LED_STATO
+                         or any(g.gpio_usati() != (configurazione.pin_postazione(nuove[g.nome]),
+                                                   SuoneriaMonitor.parametri_attuali())
+                                for g in self.postazioni))
+        if gpio_cambiati:
+            if self.occupato:
+                in_attesa.append('GPIO')
+            else:
+                self._riconfigura_gpio()
+        else:
+            for gestore in self.postazioni:
+                postazione = nuove[gestore.nome]
+                if not gestore.da_aggiornare(postazione):
+                    continue
+                if gestore.stato is StatoChiamata.LIBERO:
+                    gestore.aggiorna(postazione)
+                else:
+                    in_attesa.append(gestore.nome)
+
+        baresip = _valori_config(configurazione.BARESIP)
+        if baresip != self._baresip_applicata:
+            if self.occupato:
+                in_attesa.append('Baresip')
+            else:
+                self._baresip_applicata = baresip
+                try:
+                    cambiata = self._genera_config_baresip()
+                except OSError as e:
+                    logger.error("Impossibile scrivere la configurazione di Baresip: %s", e)
+                else:
+                    # Senza file nuovi si riavvia solo per cambiare modalita' di controllo
+                    if cambiata or self.baresip.con_id != (CONFIG.BARESIP_CONTROLLO == 'ctrl_tcp'):
+                        self.baresip.riavvia("configurazione cambiata")
+
+        if (CONFIG.METRICHE_INDIRIZZO, CONFIG.METRICHE_PORTA) != self._metriche_applicate:
+            self.avvia_task(self._riapri_metriche())
+        if _valori_config(configurazione.API) != self._api_applicata:
+            self.avvia_task(self._riapri_api())
+
+        if in_attesa and not self._in_attesa:
+            logger.info("Modifiche in attesa della fine delle chiamate: %s", ', '.join(in_attesa))
+        self._in_attesa = bool(in_attesa)
+
+    def postazione_libera(self, gestore):
+        """Una postazione e' tornata libera: applica le modifiche in attesa,
+        poi serve la coda."""
+        if self._in_attesa:
+            self.loop.call_soon(self._applica_modifiche)
+        if not self.occupato:
+            # Nessuna chiamata: i dump rimasti (eventi senza remoto, in
+            # modalita' stdio) non servono piu'
+            self._cancella_dump()
+        if CODA:
+            self.loop.call_soon(self._servi_coda)
+
+    def _riconfigura_gpio(self):
+        """Rifa le postazioni e il LED i cui pin sono cambiati; a sistema libero.
+
+        Prima si rilasciano tutti i pin cambiati, poi si configurano i
+        nuovi: un pin puo' passare da una postazione all'altra.
+        """
+        nuove = {p.nome: p for p in CONFIG.POSTAZIONI}
+        rimaste = {}
+        for gestore in self.postazioni:
+            postazione = nuove.get(gestore.nome)
+            if postazione is not None and gestore.gpio_usati() == (
+                    configurazione.pin_postazione(postazione), SuoneriaMonitor.parametri_attuali()):
+                rimaste[gestore.nome] = gestore
+                continue
+            gestore.rilascia()
+            if postazione is None:
+                logger.info("[%s] Postazione rimossa", gestore.nome)
+        led_cambiato = self.led.pin != CONFIG.PIN_LED_STATO
+        if led_cambiato:
+            self.led.rilascia()
+
+        postazioni = []
+        for postazione in CONFIG.POSTAZIONI:
+            gestore = rimaste.get(postazione.nome)
+            if gestore is None:
+                gestore = GestorePostazione(postazione, self)
+                gestore.avvia()
+                logger.info("[%s] Postazione configurata: suoneria GPIO%d, relè GPIO%d, chiama %s",
+                            postazione.nome, postazione.pin_suoneria, postazione.pin_rele,
+                            postazione.numero)
+            elif gestore.da_aggiornare(postazione):
+                gestore.aggiorna(postazione)
+            postazioni.append(gestore)
+        self.postazioni = postazioni
+        if led_cambiato:
+            self.led = LEDStatus(self.gpio, CONFIG.PIN_LED_STATO)
+            self.led.avvia()
 
-        self._chiamata_terminata.clear()
-        with self._call_lock:
-            self._call_active = False
+    async def _avvia_metriche(self):
+        """Apre l'endpoint delle metriche, chiudendo quello precedente."""
+        self._metriche_applicate = (CONFIG.METRICHE_INDIRIZZO, CONFIG.METRICHE_PORTA)
+        if self._server_metriche:
+            self._server_metriche.close()
+            await self._server_metriche.wait_closed()
+            self._server_metriche = None
+        if CONFIG.METRICHE_PORTA:
+            self._server_metriche = await metriche.avvia_server(
+                METRICHE, CONFIG.METRICHE_INDIRIZZO, CONFIG.METRICHE_PORTA)
+
+    async def _riapri_metriche(self):
+        try:
+            await self._avvia_metriche()
+        except OSError as e:
+            logger.error("Endpoint delle metriche non disponibile: %s", e)
+
+    # --------------------------------------------------------
+    # API locale
+    # --------------------------------------------------------
+
+    async def _avvia_api(self):
+        """Apre l'API locale, chiudendo quella precedente."""
+        self._api_applicata = _valori_config(configurazione.API)
+        if self._api is not None:
+            await self._api.chiudi()
+            self._api = None
+        if not CONFIG.API_PORTA:
+            return
+        if not CONFIG.API_TOKEN and not _locale(CONFIG.API_INDIRIZZO):
+            # L'API apre il portone: fuori da localhost serve un token
+            logger.error("API_INDIRIZZO %s non locale senza API_TOKEN: API non avviata",
+                         CONFIG.API_INDIRIZZO)
+            return
+        if not CONFIG.API_TOKEN:
+            logger.warning("API locale senza API_TOKEN: sola lettura, /apri disattivato")
+        api = api_locale.ServerAPI(EVENTI, self.stato_api, self.apri_da_api,
+                                   lambda: CONFIG.API_CODA_MAX, CONFIG.API_TOKEN)
+        await api.avvia(CONFIG.API_INDIRIZZO, CONFIG.API_PORTA)
+        self._api = api
+
+    async def _riapri_api(self):
+        try:
+            await self._avvia_api()
+        except OSError as e:
+            logger.error("API locale non disponibile: %s", e)
+
+    def stato_api(self):
+        baresip = self.baresip
+        return {
+            'baresip': {
+                'disponibile': baresip is not None and baresip.disponibile.is_set(),
+                'controllo': CONFIG.BARESIP_CONTROLLO,
+                'riavvii': baresip.riavvii if baresip is not None else 0,
+                'centralini': baresip.stato_centralini() if baresip is not None else [],
+            },
+            'occupato': self.occupato,
+            'postazioni': [g.stato_api() for g in self.postazioni],
+        }
+
+    def apri_da_api(self, nome, rele):
+        """Apre il rele' principale o secondario di una postazione (default la prima)."""
+        gestore = next((g for g in self.postazioni if nome is None or g.nome == nome), None)
+        if gestore is None:
+            raise api_locale.ErroreAPI(404, f"postazione sconosciuta: {nome}")
+        if rele == 'principale':
+            portone = gestore.portone
+        elif rele == 'secondario':
+            portone = gestore.portone_secondario
+            if portone is None:
+                raise api_locale.ErroreAPI(409, f"{gestore.nome} non ha un rele' secondario")
+        else:
+            raise api_locale.ErroreAPI(400, "rele deve essere 'principale' o 'secondario'")
+        logger.info("[%s] Apertura richiesta dall'API (%s)", gestore.nome, rele)
+        portone.apri()
+        return {'postazione': gestore.nome, 'rele': rele, 'aperto': portone.aperto}
 
     def _genera_config_baresip(self):
-        """Genera i file di configurazione per Baresip."""
-        baresip_dir = '/root/.baresip'
-        accounts_path = os.path.join(baresip_dir, 'accounts')
-        config_path = os.path.join(baresip_dir, 'config')
-
-        # Crea la directory se non esiste
-        if not os.path.isdir(baresip_dir):
-            os.makedirs(baresip_dir)
-            logger.info("Creata directory %s", baresip_dir)
-
-        # Backup dei file esistenti
-        timestamp = time.strftime('%Y%m%d_%H%M%S')
-        for path in (accounts_path, config_path):
-            if os.path.isfile(path):
-                backup = f"{path}.bak.{timestamp}"
-                os.rename(path, backup)
-                logger.info("Backup %s -> %s", path, backup)
-
-        # Scrivi accounts
-        accounts_line = (
-            f"<sip:{SIP_USERNAME}@{SIP_DOMAIN}>"
-            f";auth_pass={SIP_PASSWORD}"
+        """Genera accounts e config di Baresip; ritorna True se sono cambiati.
+
+        I file sono composti in memoria e riscritti solo se il contenuto
+        differisce da quello su disco (vedi _scrivi_se_cambiato).
+        """
+        if not os.path.isdir(CONFIG.BARESIP_DIR):
+            os.makedirs(CONFIG.BARESIP_DIR)
+            logger.info("Creata directory %s", CONFIG.BARESIP_DIR)
+
+        profilo = audio_profili.PROFILI[CONFIG.AUDIO_PROFILO]
+        codec = audio_profili.CODEC[CONFIG.AUDIO_CODEC]
+        # Un account per centralino: Baresip li registra tutti, il primo e'
+        # quello corrente all'avvio (vedi SupervisoreBaresip)
+        accounts = ''.join(
+            f"<{account.aor}>"
+            f";auth_pass={account.password}"
             f";regint=300"
-            f";answermode=manual\n"
+            f";answermode=manual"
+            f"{audio_profili.parametri_account(profilo, codec)}\n"
+            for account in _account_sip()
         )
-        with open(accounts_path, 'w') as f:
-            f.write(accounts_line)
-        logger.info("Scritto %s", accounts_path)
-
-        # Scrivi config
-        config_content = (
-            f"module_path /usr/lib/baresip/modules\n"
-            f"audio_player alsa,{AUDIO_PLAY_DEVICE}\n"
-            f"audio_source alsa,{AUDIO_REC_DEVICE}\n"
-            f"module alsa.so\n"
-            f"module account.so\n"
-            f"module menu.so\n"
-            f"module contact.so\n"
-            f"module stdio.so\n"
-            f"module g711.so\n"
-            f"module ctrl_tcp.so\n"
-            f"ctrl_tcp_listen 0.0.0.0:4444\n"
+        sorgente = ('alsa', CONFIG.AUDIO_REC_DEVICE)
+        config = (
+            f"module_path {CONFIG.BARESIP_MODULE_PATH}\n"
+            f"audio_player alsa,{CONFIG.AUDIO_PLAY_DEVICE}\n"
+            f"audio_source {','.join(sorgente)}\n"
         )
-        with open(config_path, 'w') as f:
-            f.write(config_content)
-        logger.info("Scritto %s", config_path)
-
-    def avvia(self):
+        config += audio_profili.config(profilo, codec)
+        logger.info("Profilo audio: %s", audio_profili.descrivi(profilo, codec))
+        if profilo.nome == audio_profili.BASSA_LATENZA and any(
+                d.startswith('plughw:')
+                for d in (CONFIG.AUDIO_PLAY_DEVICE, CONFIG.AUDIO_REC_DEVICE)):
+            # plug converte formato e frequenza in software, con un suo buffer
+            logger.warning("Profilo bassa_latenza con un dispositivo plughw: "
+                           "meglio hw: se la scheda supporta %d Hz", codec.frequenza)
+        moduli = list(CONFIG.BARESIP_MODULI)
+        moduli += [m for m in audio_profili.moduli(codec) if m not in moduli]
+        if CONFIG.DTMF_AUDIO:
+            if not dtmf_audio.disponibile():
+                logger.error("DTMF_AUDIO=1 ma NumPy non e' installato: toni in banda ignorati")
+            elif 'sndfile' not in moduli:
+                moduli.append('sndfile')
+        config += ''.join(f"module {modulo}.so\n" for modulo in moduli)
+        if 'ctrl_tcp' in moduli:
+            # Il citofono si collega in locale: ctrl_tcp non va esposto alla rete
+            config += f"ctrl_tcp_listen 127.0.0.1:{CONFIG.BARESIP_CTRL_PORT}\n"
+        if self.annunci is not None:
+            # /play cerca i file qui: annunci e suoni di Baresip
+            config += f"audio_path {self.annunci.cartella}\n"
+        if 'sndfile' in moduli:
+            # sndfile registra l'audio di ogni chiamata: su tmpfs, e i file
+            # vengono cancellati a fine chiamata (vedi dtmf_audio.AscoltoDTMF)
+            os.makedirs(self.cartella_dump, exist_ok=True)
+            config += f"snd_path {self.cartella_dump}\n"
+
+        # accounts contiene la password SIP
+        cambiati = _scrivi_se_cambiato(os.path.join(CONFIG.BARESIP_DIR, 'accounts'),
+                                       accounts, 0o600)
+        cambiati |= _scrivi_se_cambiato(os.path.join(CONFIG.BARESIP_DIR, 'config'), config)
+        # A fine annuncio si torna alla sorgente di questa configurazione
+        self._sorgente_audio = sorgente
+        if self.annunci is not None and self.annunci.frequenza != codec.frequenza:
+            # aufile non ricampiona: gli annunci vanno alla frequenza del codec
+            decodifiche = self.annunci.decodifiche
+            quanti = self.annunci.cambia_frequenza(codec.frequenza)
+            M_ANNUNCI_DECODIFICATI.inc(self.annunci.decodifiche - decodifiche)
+            logger.info("Annunci vocali ridecodificati a %d Hz: %d in memoria",
+                        codec.frequenza, quanti)
+        return cambiati
+
+    async def avvia(self):
         """Avvia il sistema."""
         logger.info("=" * 60)
         logger.info("AVVIO SISTEMA CITOFONO-VOIP")
         logger.info("=" * 60)
 
+        self.loop = asyncio.get_running_loop()
+        self._arresto = asyncio.Event()
+
         try:
             # Validazione configurazione
-            if not SIP_PASSWORD:
+            if not CONFIG.SIP_PASSWORD:
                 logger.error("SIP_PASSWORD non configurata! Impostala in config.env")
                 return False
 
+            GIORNALE.avvia()
+            TRACCE.avvia()
+
             # Setup GPIO
             self._setup_gpio()
 
             # Inizializza componenti
-            self.portone = PortoneController(PIN_RELE_PORTONE)
-            self.led = LEDStatus(PIN_LED_STATO)
+            self.led = LEDStatus(self.gpio, CONFIG.PIN_LED_STATO)
             self.led.avvia()
 
+            self._avvia_annunci()
+
             # Genera configurazione Baresip
+            self._baresip_applicata = _valori_config(configurazione.BARESIP)
             self._genera_config_baresip()
 
             # Avvia Baresip
-            self.baresip = BaresipController()
-            if not self.baresip.avvia():
+            self.baresip = SupervisoreBaresip()
+            if not await self.baresip.avvia():
                 logger.error("Impossibile avviare Baresip!")
-                self.led.errore()
+                await self.led.errore()
                 return False
+            self._lock_dial = asyncio.Lock()
 
-            # Avvia handler DTMF e collegalo all'output di baresip
-            self.dtmf_handler = DTMFHandler(self.baresip, self.portone)
-            self.dtmf_handler.avvia()
-            self.baresip.on_dtmf = self.dtmf_handler.processa_dtmf
-            
-            # Collega l'evento di chiamata in ingresso
-            self.baresip.on_incoming_call = self._on_chiamata_in_ingresso
-            self.baresip.on_call_end = self._chiamata_terminata.set
+            # Una macchina a stati per postazione, con suoneria, relè e codice
+            self.postazioni = [GestorePostazione(p, self) for p in CONFIG.POSTAZIONI]
 
-            # Avvia monitor suoneria
-            self.suoneria = SuoneriaMonitor(PIN_SUONERIA, self._on_suoneria)
-            self.suoneria.avvia()
+            # Instrada gli eventi di chiamata alla postazione proprietaria
+            self.baresip.on_dtmf = self._on_dtmf
+            self.baresip.on_incoming_call = self._on_chiamata_in_ingresso
+            self.baresip.on_call_outgoing = self._on_chiamata_in_uscita
+            self.baresip.on_call_ringing = self._on_chiamata_squillo
+            self.baresip.on_call_established = self._on_chiamata_stabilita
+            self.baresip.on_call_end = self._on_chiamata_terminata
+            self.baresip.on_calls_lost = self._on_chiamate_perse
+
+            # Avvia handler DTMF e monitor suoneria
+            for gestore in self.postazioni:
+                gestore.avvia()
+
+            # Endpoint delle metriche e API locale sullo stesso loop
+            await self._avvia_metriche()
+            await self._avvia_api()
+
+            # Ricarica a caldo quando config.env cambia (oltre che con SIGHUP)
+            if CONFIG.percorso is not None:
+                self._osservatore = configurazione.OsservatoreFile(
+                    CONFIG.percorso, self.ricarica, self.loop)
+                self._osservatore.avvia()
 
             self.running = True
 
             logger.info("-" * 60)
             logger.info("SISTEMA PRONTO")
-            logger.info("  Interno SIP: %s", SIP_USERNAME)
-            logger.info("  Centralino: %s", SIP_DOMAIN)
-            logger.info("  Chiama: %s", NUMERO_DA_CHIAMARE)
-            logger.info("  Codice apertura: %s", DTMF_APRI_PORTONE)
+            logger.info("  Interno SIP: %s", CONFIG.SIP_USERNAME)
+            logger.info("  Centralino: %s", CONFIG.SIP_DOMAIN)
+            for riserva in _account_sip()[1:]:
+                logger.info("  Centralino di riserva: %s", riserva.dominio)
+            for p in CONFIG.POSTAZIONI:
+                logger.info("  Postazione %s: suoneria GPIO%d, relè GPIO%d, chiama %s, codici %s",
+                            p.nome, p.pin_suoneria, p.pin_rele, p.numero,
+                            ', '.join(f'{c}={a}' for c, a in p.codici.items()))
+            logger.info("  Avvio Baresip: %.2fs (registrazione %.0f ms)",
+                        self.baresip.tempo_avvio, self.baresip.rtt_registrazione * 1000)
             logger.info("-" * 60)
 
             return True
@@ -596,32 +2712,65 @@ class CitofonoVoIP:
         except Exception as e:
             logger.error("Errore avvio sistema: %s", e)
             if self.led:
-                self.led.errore()
+                await self.led.errore()
             return False
 
-    def loop(self):
-        """Loop principale."""
+    async def esegui(self):
+        """Avvia il sistema e lo mantiene attivo fino a SIGINT/SIGTERM.
+
+        SIGHUP ricarica la configurazione.
+        """
+        if not await self.avvia():
+            return False
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self._on_segnale, sig)
+        self.loop.add_signal_handler(signal.SIGHUP, self._on_sighup)
         try:
-            while self.running:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            logger.info("Interruzione utente")
+            await self._arresto.wait()
         finally:
-            self.termina()
+            await self.termina()
+        return True
 
-    def termina(self):
+    def _on_segnale(self, sig):
+        """Gestisce segnali di terminazione."""
+        logger.info("Ricevuto segnale %s", sig)
+        self.arresta()
+
+    def _on_sighup(self):
+        logger.info("Ricevuto SIGHUP, ricarico la configurazione")
+        self.ricarica()
+
+    def arresta(self):
+        """Richiede l'arresto del sistema; puo' essere chiamata da qualunque thread."""
+        self.loop.call_soon_threadsafe(self._arresto.set)
+
+    async def termina(self):
         """Termina il sistema."""
         logger.info("Arresto sistema...")
         self.running = False
 
-        if self.dtmf_handler:
-            self.dtmf_handler.termina()
+        if self._osservatore:
+            self._osservatore.termina()
+        if self._server_metriche:
+            self._server_metriche.close()
+        if self._api is not None:
+            await self._api.chiudi()
+        if self._scadenza_coda is not None:
+            self._scadenza_coda.cancel()
+        CODA.svuota()
+        for gestore in self.postazioni:
+            gestore.termina()
         if self.baresip:
-            self.baresip.termina()
+            await self.baresip.termina()
         if self.led:
             self.led.termina()
 
-        GPIO.cleanup()
+        if self.gpio:
+            self.gpio.cleanup()
+        if self.annunci:
+            self.annunci.termina()
+        GIORNALE.ferma()
+        TRACCE.ferma()
         logger.info("Sistema terminato")
 
 
@@ -629,34 +2778,15 @@ class CitofonoVoIP:
 # ENTRY POINT
 # ============================================================
 
-sistema = None
-
-
-def signal_handler(sig, frame):
-    """Gestisce segnali di terminazione."""
-    logger.info("Ricevuto segnale %s", sig)
-    if sistema is not None:
-        sistema.running = False
-
-
 def main():
-    global sistema
-
-    # Registra handler per segnali
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
     # Verifica permessi root (necessari per GPIO)
     if os.geteuid() != 0:
         print("ERRORE: Eseguire come root (sudo)")
         sys.exit(1)
 
-    # Avvia sistema
+    # Avvia sistema; SIGINT e SIGTERM sono gestiti dal loop
     sistema = CitofonoVoIP()
-
-    if sistema.avvia():
-        sistema.loop()
-    else:
+    if not asyncio.run(sistema.esegui()):
         sys.exit(1)
 
 
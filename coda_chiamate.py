@@ -0,0 +1,142 @@
+"""
+Coda delle suonerie e delle chiamate in ingresso arrivate a postazioni occupate.
+
+Una postazione gestisce una chiamata alla volta. Senza coda una
+suoneria che arriva mentre la chiamata precedente sta ancora finendo (o
+scadendo per timeout) va persa, e con essa il visitatore. CodaChiamate
+tiene invece la richiesta finche' la postazione non torna libera, e lo
+stesso fa con una chiamata in ingresso quando tutte le postazioni sono
+occupate: resta a squillare invece di essere rifiutata.
+
+Politiche:
+
+    scarta   nessuna coda: suoneria ignorata, chiamata rifiutata
+    unisci   le suonerie ripetute di una postazione gia' in coda
+             diventano una sola richiesta, che mantiene il suo posto;
+             quando qualcuno risponde alla chiamata della postazione le
+             sue suonerie in coda sono dello stesso visitatore, e vengono
+             tolte (togli_suonerie())
+    accoda   ogni suoneria e' una richiesta a se'
+
+Le chiamate in ingresso non si uniscono mai: ognuna ha il suo chiamante.
+La coda ha una lunghezza massima (la richiesta in piu' e' rifiutata) e
+un'attesa massima, contata dall'ultima suoneria unita: chi suona ancora
+e' ancora li'.
+
+CodaChiamate non conosce il loop: l'istante (time.monotonic()) si passa
+a ogni chiamata e scadenza() dice quando chiamare scadute().
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+from collections import deque
+
+SCARTA = 'scarta'
+UNISCI = 'unisci'
+ACCODA = 'accoda'
+POLITICHE = (SCARTA, UNISCI, ACCODA)
+
+# Tipi di richiesta
+SUONERIA = 'suoneria'
+INGRESSO = 'ingresso'
+
+# Esiti di aggiungi()
+IN_CODA = 'in_coda'
+UNITA = 'unita'
+PIENA = 'piena'
+
+
+class Richiesta:
+    """Suoneria di una postazione o chiamata in ingresso in attesa.
+
+    t_primo e t_ultimo: istanti della prima e dell'ultima suoneria (per
+    una chiamata in ingresso coincidono); suonerie: quante ne sono state
+    unite in questa richiesta, compresa la prima.
+    """
+
+    def __init__(self, tipo, ora, postazione=None, id_chiamata=None, numero=None):
+        self.tipo = tipo
+        self.postazione = postazione
+        self.id_chiamata = id_chiamata
+        self.numero = numero
+        self.t_primo = self.t_ultimo = ora
+        self.suonerie = 1
+
+    def __repr__(self):
+        chi = self.postazione if self.tipo == SUONERIA else self.numero
+        return f'<Richiesta {self.tipo} {chi}>'
+
+
+class CodaChiamate:
+    """Richieste in attesa, in ordine di arrivo."""
+
+    def __init__(self):
+        self._richieste = deque()
+
+    def __len__(self):
+        return len(self._richieste)
+
+    def aggiungi(self, richiesta, politica, lunghezza_max):
+        """Mette in coda una richiesta; ritorna (esito, richiesta in coda).
+
+        Con UNITA la richiesta in coda e' quella gia' presente per la
+        stessa postazione, aggiornata; con PIENA e' None.
+        """
+        if politica == UNISCI and richiesta.tipo == SUONERIA:
+            for presente in self._richieste:
+                if presente.tipo == SUONERIA and presente.postazione == richiesta.postazione:
+                    presente.t_ultimo = richiesta.t_ultimo
+                    presente.suonerie += 1
+                    return UNITA, presente
+        if len(self._richieste) >= lunghezza_max:
+            return PIENA, None
+        self._richieste.append(richiesta)
+        return IN_CODA, richiesta
+
+    def prossima(self, libere):
+        """Toglie e ritorna la prima richiesta servibile, o None.
+
+        libere: nomi delle postazioni libere. Una suoneria aspetta la sua
+        postazione, una chiamata in ingresso la prima che si libera.
+        """
+        if not libere:
+            return None
+        for richiesta in self._richieste:
+            if richiesta.tipo == INGRESSO or richiesta.postazione in libere:
+                self._richieste.remove(richiesta)
+                return richiesta
+        return None
+
+    def togli_chiamata(self, id_chiamata):
+        """Toglie la chiamata in ingresso con quell'id (il chiamante ha
+        riagganciato); ritorna la richiesta o None."""
+        for richiesta in self._richieste:
+            if richiesta.tipo == INGRESSO and richiesta.id_chiamata == id_chiamata:
+                self._richieste.remove(richiesta)
+                return richiesta
+        return None
+
+    def togli_suonerie(self, postazione):
+        """Toglie e ritorna le suonerie in coda di una postazione."""
+        return self._togli(lambda r: r.tipo == SUONERIA and r.postazione == postazione)
+
+    def togli_ingressi(self):
+        """Toglie e ritorna tutte le chiamate in ingresso (Baresip riavviato)."""
+        return self._togli(lambda r: r.tipo == INGRESSO)
+
+    def scadute(self, ora, attesa_max):
+        """Toglie e ritorna le richieste ferme da piu' di attesa_max secondi."""
+        return self._togli(lambda r: ora - r.t_ultimo >= attesa_max)
+
+    def scadenza(self, attesa_max):
+        """Istante in cui scade la prossima richiesta, None con la coda vuota."""
+        return min((r.t_ultimo + attesa_max for r in self._richieste), default=None)
+
+    def svuota(self):
+        return self._togli(lambda r: True)
+
+    def _togli(self, condizione):
+        tolte = [r for r in self._richieste if condizione(r)]
+        if tolte:
+            self._richieste = deque(r for r in self._richieste if not condizione(r))
+        return tolte
@@ -0,0 +1,192 @@
+"""
+Riconoscimento dei codici DTMF.
+
+I codici configurati sono compilati in un automa (trie con i collegamenti
+di fallimento di Aho-Corasick, risolti in una tabella di transizioni):
+ogni tono costa una sola lettura di tabella, qualunque sia il numero dei
+codici, e un codice viene riconosciuto sull'ultima cifra anche se
+preceduto da toni sbagliati, come il vecchio controllo endswith().
+
+Sopra l'automa, MotoreDTMF gestisce:
+- il timeout tra una cifra e l'altra, oltre il quale si riparte da capo;
+- i toni duplicati (stesso tono entro pochi millisecondi, ad esempio
+  RFC 4733 e SIP INFO attivi insieme), che vengono scartati;
+- il blocco dopo troppi tentativi errati: un tentativo e' errato se
+  scade il timeout a codice incompleto o se si digitano tante cifre
+  quante il codice piu' lungo senza riconoscerne nessuno.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+from collections import deque, namedtuple
+
+ALFABETO = '0123456789*#ABCD'
+_INDICE = {simbolo: i for i, simbolo in enumerate(ALFABETO)}
+
+# Azioni associabili a un codice
+APRI = 'apri'                    # rele' della postazione
+APRI_SECONDARIO = 'apri_secondario'  # secondo rele' della postazione
+PROLUNGA = 'prolunga'            # riparte il timeout della chiamata
+RIAGGANCIA = 'riaggancia'        # chiude la chiamata
+AZIONI = (APRI, APRI_SECONDARIO, PROLUNGA, RIAGGANCIA)
+
+LUNGHEZZA_MIN = 2  # cifre minime di un codice
+
+# Esiti di MotoreDTMF.tono()
+CODICE = 'codice'      # codice riconosciuto
+ERRATO = 'errato'      # tentativo errato
+BLOCCATO = 'bloccato'  # tentativo errato che fa scattare il blocco
+
+# tipo: uno degli esiti sopra; codice e azione solo per CODICE
+Esito = namedtuple('Esito', 'tipo codice azione')
+
+
+def leggi_codici(testo):
+    """'92:apri_secondario,##:riaggancia' -> {'92': 'apri_secondario', '##': 'riaggancia'}."""
+    codici = {}
+    for voce in testo.split(','):
+        voce = voce.strip()
+        if not voce:
+            continue
+        codice, sep, azione = voce.partition(':')
+        codice, azione = codice.strip().upper(), azione.strip()
+        if not sep or azione not in AZIONI:
+            raise ValueError(f"Codice DTMF non valido '{voce}': usare codice:azione, "
+                             f"azione tra {', '.join(AZIONI)}")
+        aggiungi_codice(codici, codice, azione)
+    return codici
+
+
+def aggiungi_codice(codici, codice, azione):
+    """Aggiunge un codice al dizionario verificandone le cifre e l'unicita'."""
+    if not codice or any(simbolo not in _INDICE for simbolo in codice):
+        raise ValueError(f"Codice DTMF '{codice}': ammesse solo le cifre {ALFABETO}")
+    if len(codice) < LUNGHEZZA_MIN:
+        # Un tono solo aprirebbe o azzererebbe i tentativi errati a ogni pressione
+        raise ValueError(f"Codice DTMF '{codice}': servono almeno {LUNGHEZZA_MIN} cifre")
+    if codici.get(codice, azione) != azione:
+        raise ValueError(f"Codice DTMF '{codice}' associato a piu' azioni")
+    codici[codice] = azione
+
+
+class Automa:
+    """Automa deterministico che riconosce i codici come suffisso dei toni.
+
+    Lo stato 0 e' la radice. transizioni[stato][simbolo] e' lo stato
+    successivo; uscite[stato] e' (codice, azione) se in quello stato
+    termina un codice (il piu' lungo, se piu' codici finiscono li').
+    """
+
+    def __init__(self, codici):
+        if not codici:
+            raise ValueError("Nessun codice DTMF configurato")
+        self.lunghezza_max = max(len(codice) for codice in codici)
+        figli = [{}]
+        uscite = [None]
+        for codice, azione in codici.items():
+            stato = 0
+            for simbolo in codice:
+                i = _INDICE[simbolo]
+                if i not in figli[stato]:
+                    figli.append({})
+                    uscite.append(None)
+                    figli[stato][i] = len(figli) - 1
+                stato = figli[stato][i]
+            uscite[stato] = (codice, azione)
+
+        # Visita in ampiezza: la transizione mancante di uno stato e'
+        # quella del suo stato di fallimento, gia' calcolato
+        transizioni = [None] * len(figli)
+        transizioni[0] = [figli[0].get(i, 0) for i in range(len(ALFABETO))]
+        fallimento = [0] * len(figli)
+        coda = deque(figli[0].values())
+        while coda:
+            stato = coda.popleft()
+            f = fallimento[stato]
+            if uscite[stato] is None:
+                uscite[stato] = uscite[f]
+            riga = list(transizioni[f])
+            for i, figlio in figli[stato].items():
+                fallimento[figlio] = transizioni[f][i]
+                riga[i] = figlio
+                coda.append(figlio)
+            transizioni[stato] = riga
+        self.transizioni = transizioni
+        self.uscite = uscite
+
+    def avanza(self, stato, simbolo):
+        return self.transizioni[stato][_INDICE[simbolo]]
+
+
+class MotoreDTMF:
+    """Riconoscimento dei codici tono per tono, con timeout, duplicati e blocco.
+
+    Gli istanti sono in secondi di time.monotonic(); nessun timer: le
+    scadenze sono verificate all'arrivo del tono successivo.
+    """
+
+    def __init__(self, codici, timeout_cifra=3.0, finestra_duplicati=0.08,
+                 tentativi_max=3, blocco=60.0):
+        self.automa = Automa(codici)
+        self.timeout_cifra = timeout_cifra
+        self.finestra_duplicati = finestra_duplicati
+        self.tentativi_max = tentativi_max  # 0 = nessun blocco
+        self.blocco = blocco
+        self.bloccato_fino = 0.0
+        self.errati = 0  # tentativi errati consecutivi
+        self._stato = 0
+        self._cifre = 0  # toni del tentativo in corso
+        self._ultimo = None
+        self._t_ultimo = float('-inf')
+
+    def bloccato(self, ora):
+        return ora < self.bloccato_fino
+
+    def azzera(self):
+        """Ricomincia da capo (ad esempio a fine chiamata); il blocco resta."""
+        self._stato = 0
+        self._cifre = 0
+        self._ultimo = None
+
+    def tono(self, simbolo, ora):
+        """Elabora un tono; ritorna un Esito oppure None."""
+        simbolo = simbolo.upper()
+        if simbolo not in _INDICE:
+            return None
+        if simbolo == self._ultimo and ora - self._t_ultimo < self.finestra_duplicati:
+            return None
+        trascorso = ora - self._t_ultimo
+        self._ultimo, self._t_ultimo = simbolo, ora
+        if self.bloccato(ora):
+            return None
+
+        esito = None
+        if trascorso > self.timeout_cifra and self._cifre:
+            esito = self._errato(ora)
+            if esito.tipo == BLOCCATO:
+                return esito
+            self._stato = 0
+            self._cifre = 0
+
+        self._stato = self.automa.avanza(self._stato, simbolo)
+        uscita = self.automa.uscite[self._stato]
+        if uscita is not None:
+            self.azzera()
+            self.errati = 0
+            return Esito(CODICE, *uscita)
+
+        self._cifre += 1
+        if self._cifre >= self.automa.lunghezza_max:
+            # Lo stato resta: un codice puo' ancora finire col prossimo tono
+            self._cifre = 0
+            esito = self._errato(ora)
+        return esito
+
+    def _errato(self, ora):
+        self.errati += 1
+        if self.tentativi_max and self.errati >= self.tentativi_max:
+            self.bloccato_fino = ora + self.blocco
+            self.errati = 0
+            self.azzera()
+            return Esito(BLOCCATO, None, None)
+        return Esito(ERRATO, None, None)
@@ -0,0 +1,459 @@
+"""
+Configurazione del citofono.
+
+I valori vengono dall'ambiente, sovrascritti da config.env se presente.
+carica() legge e valida tutto in un oggetto Configurazione; una
+configurazione non valida solleva ValueError e non sostituisce mai
+quella in uso. Ogni chiave ha un tipo, un default e un effetto, che
+dice cosa va rifatto quando il suo valore cambia a caldo:
+
+    VIVO        letto al momento dell'uso: basta il nuovo valore
+    POSTAZIONI  tabella delle postazioni e codici DTMF
+    GPIO        pin delle postazioni e del LED, da riconfigurare
+    BARESIP     account SIP, audio e controllo: riavvio di Baresip
+    METRICHE    endpoint HTTP da riaprire
+    API         API locale da riaprire
+    AVVIO       letto solo all'avvio: richiede il riavvio del servizio
+
+OsservatoreFile segnala le modifiche di config.env tramite inotify
+(con polling di riserva dove inotify non c'e').
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import copy
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+from collections import namedtuple
+
+import codici_dtmf
+
+logger = logging.getLogger(__name__)
+
+PERCORSI = (
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.env'),
+    '/etc/citofono-voip/config.env',
+)
+
+# Effetti di una modifica a caldo
+VIVO = 'vivo'
+POSTAZIONI = 'postazioni'
+GPIO = 'gpio'
+BARESIP = 'baresip'
+METRICHE = 'metriche'
+API = 'api'
+AVVIO = 'avvio'
+
+# nome: costante del programma; chiave: variabile di config.env
+Campo = namedtuple('Campo', 'nome chiave tipo default effetto scelte')
+
+
+def _campo(nome, chiave, tipo, default, effetto, scelte=None):
+    return Campo(nome, chiave, tipo, default, effetto, scelte)
+
+
+def _moduli(testo):
+    """'alsa, g711.so' -> ('alsa', 'g711'): moduli di Baresip."""
+    moduli = tuple(m.strip()[:-3] if m.strip().endswith('.so') else m.strip()
+                   for m in testo.split(',') if m.strip())
+    if not moduli:
+        raise ValueError(testo)
+    return moduli
+
+
+def _riserve(testo):
+    """'3000:pw@pbx2:5070, pbx3' -> (('3000', 'pw', 'pbx2:5070'), (None, None, 'pbx3')).
+
+    Centralini di riserva; utente e password mancanti (None) sono quelli
+    di SIP_USERNAME e SIP_PASSWORD.
+    """
+    riserve = []
+    for voce in testo.split(','):
+        voce = voce.strip()
+        if not voce:
+            continue
+        credenziali, separatore, dominio = voce.rpartition('@')
+        utente, due_punti, password = credenziali.partition(':')
+        host, _, porta = dominio.rpartition(':')
+        if not dominio or (separatore and not utente) or (host and not porta.isdigit()):
+            raise ValueError(voce)
+        riserve.append((utente or None, password if due_punti else None, dominio))
+    return tuple(riserve)
+
+
+CAMPI = (
+    # GPIO (numerazione BCM)
+    _campo('PIN_SUONERIA', 'PIN_SUONERIA', int, '17', POSTAZIONI),
+    _campo('PIN_RELE_PORTONE', 'PIN_RELE_PORTONE', int, '27', POSTAZIONI),
+    _campo('PIN_LED_STATO', 'PIN_LED_STATO', int, '22', GPIO),
+    # Secondo rele' (es. cancello pedonale) del codice apri_secondario; 0 = nessuno
+    _campo('PIN_RELE_SECONDARIO', 'PIN_RELE_SECONDARIO', int, '0', POSTAZIONI),
+    # 'auto' usa libgpiod se disponibile, altrimenti RPi.GPIO
+    _campo('GPIO_BACKEND', 'GPIO_BACKEND', str, 'auto', AVVIO,
+           ('auto', 'gpiod', 'rpigpio', 'sim')),
+    _campo('GPIO_CHIP', 'GPIO_CHIP', str, '/dev/gpiochip0', AVVIO),
+    # SIP
+    _campo('SIP_USERNAME', 'SIP_USERNAME', str, '2000', BARESIP),
+    _campo('SIP_PASSWORD', 'SIP_PASSWORD', str, '', BARESIP),
+    _campo('SIP_DOMAIN', 'SIP_DOMAIN', str, 'centralino.ponsacco.local', BARESIP),
+    _campo('SIP_PORT', 'SIP_PORT', int, '5060', BARESIP),
+    # Centralini di riserva, in ordine: '[utente[:password]@]dominio[:porta]'
+    # separati da virgola (vedi centralini.py)
+    _campo('SIP_RISERVA', 'SIP_RISERVA', _riserve, '', BARESIP),
+    # Sonda SIP OPTIONS dei centralini: intervallo (0 = disattivata), attesa
+    # della risposta e sonde fallite di fila dopo cui si passa al successivo
+    _campo('SONDA_SIP_SEC', 'SONDA_SIP', float, '5', AVVIO),
+    _campo('SONDA_SIP_TIMEOUT_SEC', 'SONDA_SIP_TIMEOUT', float, '2', VIVO),
+    _campo('SONDA_SIP_FALLIMENTI', 'SONDA_SIP_FALLIMENTI', int, '2', VIVO),
+    # Numeri da chiamare: separati da virgola insieme, gruppi separati da
+    # ';' in ondate successive. Altri codici DTMF come 'codice:azione,...'
+    _campo('NUMERO_DA_CHIAMARE', 'NUMERO_DA_CHIAMARE', str, '6400', POSTAZIONI),
+    _campo('INTERVALLO_ONDATE_SEC', 'INTERVALLO_ONDATE', float, '15', POSTAZIONI),
+    _campo('DTMF_APRI_PORTONE', 'DTMF_APRI_PORTONE', str, '91', POSTAZIONI),
+    _campo('CODICI_DTMF', 'CODICI_DTMF', str, '', POSTAZIONI),
+    _campo('DTMF_TIMEOUT_CIFRA_SEC', 'DTMF_TIMEOUT_CIFRA', float, '3', POSTAZIONI),
+    _campo('DTMF_DUPLICATO_MS', 'DTMF_DUPLICATO_MS', int, '80', POSTAZIONI),
+    _campo('DTMF_TENTATIVI_MAX', 'DTMF_TENTATIVI_MAX', int, '3', POSTAZIONI),
+    _campo('DTMF_BLOCCO_SEC', 'DTMF_BLOCCO', float, '60', POSTAZIONI),
+    # Toni DTMF anche dall'audio della chiamata (modulo sndfile di Baresip, NumPy)
+    _campo('DTMF_AUDIO', 'DTMF_AUDIO', int, '0', BARESIP, (0, 1)),
+    # Suoneria: fronti necessari entro la finestra, intervalli ammessi tra
+    # due fronti (piu' vicini = rimbalzo, piu' lontani = treno interrotto),
+    # pausa che chiude uno squillo (vedi suoneria.py) e ritardo prima del dial;
+    # con SUONERIA_SPECULATIVA il dial parte gia' al primo fronte del treno
+    _campo('DEBOUNCE_SUONERIA_MS', 'DEBOUNCE_SUONERIA_MS', int, '300', GPIO),
+    _campo('SUONERIA_FRONTI', 'SUONERIA_FRONTI', int, '1', GPIO),
+    _campo('SUONERIA_FINESTRA_MS', 'SUONERIA_FINESTRA_MS', int, '1000', GPIO),
+    _campo('SUONERIA_INTERVALLO_MIN_MS', 'SUONERIA_INTERVALLO_MIN_MS', int, '0', GPIO),
+    _campo('SUONERIA_INTERVALLO_MAX_MS', 'SUONERIA_INTERVALLO_MAX_MS', int, '200', GPIO),
+    _campo('RITARDO_POST_SUONERIA_SEC', 'RITARDO_POST_SUONERIA', float, '0.5', VIVO),
+    _campo('SUONERIA_SPECULATIVA', 'SUONERIA_SPECULATIVA', int, '0', VIVO, (0, 1)),
+    # Suonerie e chiamate in ingresso a postazione occupata (vedi coda_chiamate.py)
+    _campo('SUONERIA_CODA', 'SUONERIA_CODA', str, 'unisci', VIVO, ('scarta', 'unisci', 'accoda')),
+    _campo('SUONERIA_CODA_MAX', 'SUONERIA_CODA_MAX', int, '4', VIVO),
+    _campo('SUONERIA_CODA_ATTESA_MAX_SEC', 'SUONERIA_CODA_ATTESA_MAX', float, '60', VIVO),
+    # Timing
+    _campo('DURATA_APERTURA_SEC', 'DURATA_APERTURA', float, '2', POSTAZIONI),
+    _campo('TIMEOUT_CHIAMATA_SEC', 'TIMEOUT_CHIAMATA', int, '60', POSTAZIONI),
+    # Audio
+    _campo('AUDIO_PLAY_DEVICE', 'AUDIO_PLAY_DEVICE', str, 'plughw:1,0', BARESIP),
+    _campo('AUDIO_REC_DEVICE', 'AUDIO_REC_DEVICE', str, 'plughw:1,0', BARESIP),
+    # Profilo dei buffer audio e codec preferito (vedi audio_profili.py)
+    _campo('AUDIO_PROFILO', 'AUDIO_PROFILO', str, 'bilanciato', BARESIP,
+           ('bassa_latenza', 'bilanciato', 'robusto')),
+    _campo('AUDIO_CODEC', 'AUDIO_CODEC', str, 'g711', BARESIP, ('g711', 'g722', 'opus')),
+    # Baresip: controllo 'ctrl_tcp' (JSON su netstring) o 'stdio', moduli
+    # caricati, backup conservati dei file generati e watchdog della
+    # registrazione (0 = disattivato)
+    _campo('BARESIP_CONTROLLO', 'BARESIP_CONTROLLO', str, 'ctrl_tcp', BARESIP,
+           ('ctrl_tcp', 'stdio')),
+    _campo('BARESIP_DIR', 'BARESIP_DIR', str, '/root/.baresip', BARESIP),
+    _campo('BARESIP_CTRL_PORT', 'BARESIP_CTRL_PORT', int, '4444', BARESIP),
+    _campo('BARESIP_MODULE_PATH', 'BARESIP_MODULE_PATH', str, '/usr/lib/baresip/modules', BARESIP),
+    _campo('BARESIP_MODULI', 'BARESIP_MODULI', _moduli,
+           'alsa,account,menu,contact,stdio,g711,aufile,ctrl_tcp', BARESIP),
+    _campo('BARESIP_BACKUP', 'BARESIP_BACKUP', int, '3', VIVO),
+    _campo('TIMEOUT_COMANDO_SEC', 'TIMEOUT_COMANDO', float, '2', VIVO),
+    _campo('TIMEOUT_AVVIO_BARESIP_SEC', 'TIMEOUT_AVVIO_BARESIP', float, '20', VIVO),
+    _campo('RIAVVIO_MIN_SEC', 'RIAVVIO_BARESIP_MIN', float, '1', VIVO),
+    _campo('RIAVVIO_MAX_SEC', 'RIAVVIO_BARESIP_MAX', float, '60', VIVO),
+    _campo('WATCHDOG_REGISTRAZIONE_SEC', 'WATCHDOG_REGISTRAZIONE', float, '30', AVVIO),
+    _campo('SUONERIA_IN_ATTESA_MAX_SEC', 'SUONERIA_IN_ATTESA_MAX', float, '30', VIVO),
+    # Logging: LOG_BARESIP_MAX righe uguali per finestra, 0 = nessun limite
+    _campo('LOG_FILE', 'LOG_FILE', str, '/var/log/citofono-voip.log', AVVIO),
+    _campo('LOG_FORMATO', 'LOG_FORMATO', str, 'testo', AVVIO, ('testo', 'json')),
+    _campo('LOG_MAX_MB', 'LOG_MAX_MB', float, '5', AVVIO),
+    _campo('LOG_BACKUP', 'LOG_BACKUP', int, '3', AVVIO),
+    _campo('LOG_BARESIP_MAX', 'LOG_BARESIP_MAX', int, '20', AVVIO),
+    _campo('LOG_BARESIP_FINESTRA_SEC', 'LOG_BARESIP_FINESTRA', float, '60', AVVIO),
+    # Annunci vocali (vuoto = disattivati) e memoria massima della loro cache
+    _campo('ANNUNCI_DIR', 'ANNUNCI_DIR', str, '/opt/citofono-voip/annunci', AVVIO),
+    _campo('ANNUNCI_CACHE_KB', 'ANNUNCI_CACHE_KB', int, '512', AVVIO),
+    # Giornale degli eventi su SQLite (vuoto = disattivato), potato oltre GIORNALE_MAX_MB
+    _campo('GIORNALE_FILE', 'GIORNALE_FILE', str, '/var/lib/citofono-voip/giornale.db', AVVIO),
+    _campo('GIORNALE_MAX_MB', 'GIORNALE_MAX_MB', float, '20', AVVIO),
+    # Tracce delle chiamate, una riga per chiamata (vuoto = disattivate)
+    _campo('TRACCE_FILE', 'TRACCE_FILE', str, '/var/lib/citofono-voip/tracce.jsonl', AVVIO),
+    _campo('TRACCE_FORMATO', 'TRACCE_FORMATO', str, 'json', AVVIO, ('json', 'otlp')),
+    _campo('TRACCE_MAX_MB', 'TRACCE_MAX_MB', float, '5', AVVIO),
+    # Endpoint Prometheus, porta 0 = disattivato
+    _campo('METRICHE_INDIRIZZO', 'METRICHE_INDIRIZZO', str, '127.0.0.1', METRICHE),
+    _campo('METRICHE_PORTA', 'METRICHE_PORTA', int, '9110', METRICHE),
+    # API locale (porta 0 = disattivata), token facoltativo e coda massima
+    # di eventi per client del flusso
+    _campo('API_INDIRIZZO', 'API_INDIRIZZO', str, '127.0.0.1', API),
+    _campo('API_PORTA', 'API_PORTA', int, '9111', API),
+    _campo('API_TOKEN', 'API_TOKEN', str, '', API),
+    _campo('API_CODA_MAX', 'API_CODA_MAX', int, '64', VIVO),
+)
+
+# Effetto di ogni costante, compresa la tabella delle postazioni
+EFFETTI = {campo.nome: campo.effetto for campo in CAMPI}
+EFFETTI['POSTAZIONI'] = POSTAZIONI
+
+# Postazioni (ingressi) servite dal demone: nomi separati da virgola.
+# Per ogni postazione NOME si possono impostare POSTAZIONE_NOME_PIN_SUONERIA,
+# _PIN_RELE, _PIN_RELE_SECONDARIO, _NUMERO, _CODICE, _CODICI,
+# _DURATA_APERTURA, _TIMEOUT_CHIAMATA e _INTERVALLO_ONDATE; i valori
+# mancanti sono quelli globali. Senza POSTAZIONI c'e' una sola postazione
+# 'portone' con la configurazione globale. codici e' il dizionario
+# codice -> azione, compreso il codice di apertura.
+Postazione = namedtuple(
+    'Postazione',
+    'nome pin_suoneria pin_rele pin_rele_secondario numero ondate intervallo_ondate '
+    'codice codici durata_apertura timeout_chiamata')
+
+# Campi di Postazione che richiedono di riconfigurare i GPIO
+CAMPI_PIN = ('pin_suoneria', 'pin_rele', 'pin_rele_secondario')
+
+
+def pin_postazione(postazione):
+    """Pin GPIO di una postazione, nell'ordine di CAMPI_PIN."""
+    return tuple(getattr(postazione, campo) for campo in CAMPI_PIN)
+
+
+def trova_file():
+    """Primo config.env esistente tra PERCORSI, o None."""
+    return next((p for p in PERCORSI if os.path.isfile(p)), None)
+
+
+def leggi_file(percorso):
+    """Legge le righe CHIAVE=valore di config.env."""
+    valori = {}
+    with open(percorso) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '=' in line:
+                key, _, value = line.partition('=')
+                valori[key.strip()] = value.strip()
+    return valori
+
+
+def _converti(chiave, valore, tipo, scelte=None):
+    try:
+        valore = tipo(valore)
+    except (TypeError, ValueError):
+        raise ValueError(f"{chiave}: valore non valido '{valore}'") from None
+    if scelte and valore not in scelte:
+        raise ValueError(f"{chiave}: '{valore}' non e' tra {', '.join(map(str, scelte))}")
+    if tipo in (int, float) and valore < 0:
+        raise ValueError(f"{chiave}: il valore non puo' essere negativo")
+    return valore
+
+
+def _ondate(numero):
+    """'101,102;103' -> (('101', '102'), ('103',)): numeri per ondata."""
+    ondate = tuple(tuple(n.strip() for n in onda.split(',') if n.strip())
+                   for onda in numero.split(';'))
+    ondate = tuple(onda for onda in ondate if onda)
+    if not ondate:
+        raise ValueError(f"Nessun numero da chiamare in '{numero}'")
+    return ondate
+
+
+def _postazioni(sorgente, c):
+    """Legge la tabella delle postazioni e verifica che i pin non siano condivisi."""
+    def valore(chiave, default, tipo=str):
+        return _converti(chiave, sorgente.get(chiave, default), tipo)
+
+    nomi = [nome.strip() for nome in sorgente.get('POSTAZIONI', '').split(',') if nome.strip()]
+    postazioni = []
+    for nome in nomi or ['portone']:
+        prefisso = f'POSTAZIONE_{nome.upper()}_'
+        numero = valore(prefisso + 'NUMERO', c['NUMERO_DA_CHIAMARE'])
+        codice = valore(prefisso + 'CODICE', c['DTMF_APRI_PORTONE'])
+        codici = codici_dtmf.leggi_codici(valore(prefisso + 'CODICI', c['CODICI_DTMF']))
+        codici_dtmf.aggiungi_codice(codici, codice, codici_dtmf.APRI)
+        pin_rele_secondario = valore(prefisso + 'PIN_RELE_SECONDARIO',
+                                     c['PIN_RELE_SECONDARIO'], int)
+        if codici_dtmf.APRI_SECONDARIO in codici.values() and not pin_rele_secondario:
+            raise ValueError(f"Postazione {nome}: codice apri_secondario senza PIN_RELE_SECONDARIO")
+        postazioni.append(Postazione(
+            nome=nome,
+            pin_suoneria=valore(prefisso + 'PIN_SUONERIA', c['PIN_SUONERIA'], int),
+            pin_rele=valore(prefisso + 'PIN_RELE', c['PIN_RELE_PORTONE'], int),
+            pin_rele_secondario=pin_rele_secondario,
+            numero=numero,
+            ondate=_ondate(numero),
+            intervallo_ondate=valore(prefisso + 'INTERVALLO_ONDATE',
+                                     c['INTERVALLO_ONDATE_SEC'], float),
+            codice=codice,
+            codici=codici,
+            durata_apertura=valore(prefisso + 'DURATA_APERTURA', c['DURATA_APERTURA_SEC'], float),
+            timeout_chiamata=valore(prefisso + 'TIMEOUT_CHIAMATA', c['TIMEOUT_CHIAMATA_SEC'], int),
+        ))
+    pin = [p.pin_suoneria for p in postazioni] + [p.pin_rele for p in postazioni]
+    pin += [p.pin_rele_secondario for p in postazioni if p.pin_rele_secondario]
+    if c['PIN_LED_STATO']:
+        pin.append(c['PIN_LED_STATO'])
+    if len(set(pin)) != len(pin):
+        raise ValueError("POSTAZIONI: ogni postazione deve avere pin di suoneria e relè propri, "
+                         "diversi da PIN_LED_STATO")
+    if len({p.nome.upper() for p in postazioni}) != len(postazioni):
+        raise ValueError("POSTAZIONI: nomi duplicati")
+    return tuple(postazioni)
+
+
+class Configurazione:
+    """Configurazione validata: un attributo per campo di CAMPI, piu' POSTAZIONI.
+
+    Va trattata come immutabile: una ricarica produce un nuovo oggetto.
+    """
+
+    def __init__(self, sorgente, percorso=None):
+        self.percorso = percorso
+        valori = {}
+        for campo in CAMPI:
+            valori[campo.nome] = _converti(campo.chiave, sorgente.get(campo.chiave, campo.default),
+                                           campo.tipo, campo.scelte)
+        if valori['SUONERIA_FRONTI'] < 1:
+            raise ValueError("SUONERIA_FRONTI: serve almeno un fronte")
+        if valori['SONDA_SIP_FALLIMENTI'] < 1:
+            raise ValueError("SONDA_SIP_FALLIMENTI: serve almeno una sonda fallita")
+        if valori['API_CODA_MAX'] < 1:
+            raise ValueError("API_CODA_MAX: serve almeno un evento in coda")
+        aor = [f"sip:{utente or valori['SIP_USERNAME']}@{dominio}"
+               for utente, _, dominio in ((None, None, valori['SIP_DOMAIN']),)
+               + valori['SIP_RISERVA']]
+        if len(set(aor)) != len(aor):
+            raise ValueError("SIP_RISERVA: account ripetuto")
+        if valori['BARESIP_CONTROLLO'] == 'ctrl_tcp' and 'ctrl_tcp' not in valori['BARESIP_MODULI']:
+            raise ValueError("BARESIP_MODULI: il controllo ctrl_tcp richiede il modulo ctrl_tcp")
+        valori['POSTAZIONI'] = _postazioni(sorgente, valori)
+        self._valori = valori
+        self.__dict__.update(valori)
+
+    def con_valori(self, altra, nomi):
+        """Copia di questa configurazione con i valori di altra per i nomi dati."""
+        copia = copy.copy(self)
+        copia._valori = dict(self._valori, **{nome: altra._valori[nome] for nome in nomi})
+        copia.__dict__.update(copia._valori)
+        return copia
+
+    def differenze(self, altra):
+        """Nomi delle costanti che hanno un valore diverso in altra."""
+        return {nome for nome, valore in self._valori.items() if altra._valori[nome] != valore}
+
+
+def carica(percorso=None, ambiente=None):
+    """Legge ambiente e config.env e ritorna una Configurazione validata.
+
+    percorso None cerca config.env in PERCORSI. Solleva OSError se il
+    file non si legge e ValueError se un valore non e' valido.
+    """
+    sorgente = dict(os.environ if ambiente is None else ambiente)
+    if percorso is None:
+        percorso = trova_file()
+    if percorso is not None:
+        sorgente.update(leggi_file(percorso))
+    return Configurazione(sorgente, percorso)
+
+
+# ============================================================
+# Osservazione di config.env
+# ============================================================
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_EVENTO = struct.Struct('iIII')  # wd, mask, cookie, len (poi il nome)
+
+
+def _libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class OsservatoreFile:
+    """Chiama callback() sul loop quando il file viene scritto o sostituito.
+
+    Si osserva la directory, perche' molti editor salvano scrivendo un
+    file nuovo e rinominandolo. Le notifiche ravvicinate sono raccolte in
+    una sola chiamata dopo `attesa` secondi. Senza inotify si controlla
+    la data di modifica ogni `intervallo` secondi.
+    """
+
+    def __init__(self, percorso, callback, loop, attesa=0.5, intervallo=5.0):
+        self.percorso = percorso
+        self.callback = callback
+        self.loop = loop
+        self.attesa = attesa
+        self.intervallo = intervallo
+        self._fd = None
+        self._differita = None
+        self._controllo = None
+        self._firma = None
+
+    def avvia(self):
+        libc = _libc()
+        cartella, self._nome = os.path.split(self.percorso)
+        if libc is not None:
+            fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+            if fd >= 0 and libc.inotify_add_watch(
+                    fd, os.fsencode(cartella), _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE) >= 0:
+                self._fd = fd
+                self.loop.add_reader(fd, self._leggi)
+                logger.info("Osservo %s (inotify)", self.percorso)
+                return
+            if fd >= 0:
+                os.close(fd)
+        self._firma = self._firma_file()
+        self._controllo = self.loop.call_later(self.intervallo, self._controlla)
+        logger.info("Osservo %s (controllo ogni %gs)", self.percorso, self.intervallo)
+
+    def _leggi(self):
+        try:
+            dati = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        nome = os.fsencode(self._nome)
+        posizione = 0
+        while posizione + _EVENTO.size <= len(dati):
+            _, _, _, lunghezza = _EVENTO.unpack_from(dati, posizione)
+            inizio = posizione + _EVENTO.size
+            if dati[inizio:inizio + lunghezza].rstrip(b'\0') == nome:
+                self._segnala()
+            posizione = inizio + lunghezza
+
+    def _firma_file(self):
+        try:
+            st = os.stat(self.percorso)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _controlla(self):
+        firma = self._firma_file()
+        if firma != self._firma:
+            self._firma = firma
+            self._segnala()
+        self._controllo = self.loop.call_later(self.intervallo, self._controlla)
+
+    def _segnala(self):
+        if self._differita is not None:
+            self._differita.cancel()
+        self._differita = self.loop.call_later(self.attesa, self._scaduta)
+
+    def _scaduta(self):
+        self._differita = None
+        self.callback()
+
+    def termina(self):
+        for handle in (self._differita, self._controllo):
+            if handle is not None:
+                handle.cancel()
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,274 @@
+"""
+Riconoscimento dei toni DTMF nell'audio della chiamata.
+
+Serve quando il centralino manda i toni solo in banda: Baresip non li
+segnala come eventi RFC 4733 o SIP INFO, ma restano nell'audio ricevuto.
+Il modulo sndfile di Baresip scrive l'audio decodificato di ogni
+chiamata in un WAV (dump-<locale>=><remoto>-dec.wav) nella sua snd_path,
+che il citofono tiene su tmpfs: AscoltoDTMF segue il file mentre cresce
+e passa i campioni a RivelatoreDTMF.
+
+Il rivelatore e' un banco di filtri di Goertzel sulle otto frequenze
+DTMF, calcolato con NumPy su tutte le finestre disponibili in una volta:
+l'uscita di Goertzel alla frequenza f e' |sum x[n] e^(-j2pi f n/fs)|^2,
+cioe' due prodotti matrice per coseni e seni. Finestre di 205 campioni a
+8 kHz, sovrapposte a meta'. Una finestra contiene un tono se:
+
+  - in ciascun gruppo (basse, alte) la frequenza piu' forte supera la
+    soglia di livello e di RAPPORTO_GRUPPO_DB le altre del gruppo
+  - il twist (alta rispetto a bassa) e' entro TWIST_NORMALE_DB e
+    TWIST_INVERSO_DB
+  - le due frequenze portano almeno QUOTA_TONI dell'energia della
+    finestra: voce e rumore la distribuiscono su tutto lo spettro
+
+Un tasto e' riconosciuto dopo due finestre consecutive uguali (toni di
+almeno 50 ms) e rilasciato alla prima finestra senza tono.
+
+NumPy e' opzionale: senza, disponibile() e' False.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import glob
+import logging
+import os
+import struct
+import time
+from threading import Event, Thread
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+BASSE = (697, 770, 852, 941)
+ALTE = (1209, 1336, 1477, 1633)
+TASTI = ('123A', '456B', '789C', '*0#D')  # riga = bassa, colonna = alta
+
+# Finestra di Goertzel a 8 kHz (25.6 ms), scalata con la frequenza
+CAMPIONI_8KHZ = 205
+
+# Livello minimo di ciascun tono, in dB rispetto al fondo scala
+LIVELLO_MIN_DBFS = -30.0
+TWIST_NORMALE_DB = 8.0  # alta piu' debole della bassa
+TWIST_INVERSO_DB = 4.0  # alta piu' forte della bassa
+RAPPORTO_GRUPPO_DB = 6.0
+QUOTA_TONI = 0.7
+
+# Attesa tra due letture del file mentre Baresip lo scrive
+INTERVALLO_LETTURA = 0.02
+
+
+def disponibile():
+    return np is not None
+
+
+class RivelatoreDTMF:
+    """Rivelatore a flusso: analizza() accetta blocchi di campioni di
+    qualsiasi lunghezza e ritorna i tasti riconosciuti come
+    (secondi dall'inizio del flusso, tasto).
+    """
+
+    def __init__(self, frequenza=8000):
+        self.frequenza = frequenza
+        self.n = round(CAMPIONI_8KHZ * frequenza / 8000)
+        self.passo = self.n // 2
+        t = np.arange(self.n) / frequenza
+        frequenze = np.array(BASSE + ALTE, dtype=np.float64)
+        angoli = 2 * np.pi * np.outer(t, frequenze)
+        # (n, 16): coseni e seni delle otto frequenze
+        self._base = np.hstack((np.cos(angoli), np.sin(angoli)))
+        fondo_scala = (32768 * self.n / 2) ** 2  # potenza di una sinusoide a fondo scala
+        self._potenza_min = fondo_scala * 10 ** (LIVELLO_MIN_DBFS / 10)
+        self._tasti = np.array([c for riga in TASTI for c in riga])
+        self._resto = np.zeros(0, dtype=np.float64)
+        self._inizio = 0  # indice nel flusso del primo campione di _resto
+        self._precedente = -1
+        self._premuto = -1
+
+    def finestre(self, campioni):
+        """Codice del tasto (riga * 4 + colonna) di ogni finestra, -1 se nessuno."""
+        quante = (len(campioni) - self.n) // self.passo + 1
+        if quante <= 0:
+            return np.zeros(0, dtype=np.int64)
+        x = np.lib.stride_tricks.as_strided(
+            campioni, (quante, self.n), (campioni.strides[0] * self.passo, campioni.strides[0]),
+            writeable=False)
+        y = x @ self._base
+        potenza = y[:, :8] ** 2 + y[:, 8:] ** 2
+        energia = np.einsum('ij,ij->i', x, x)
+
+        basse, alte = potenza[:, :4], potenza[:, 4:]
+        riga, colonna = basse.argmax(axis=1), alte.argmax(axis=1)
+        indici = np.arange(quante)
+        p_bassa, p_alta = basse[indici, riga], alte[indici, colonna]
+        # Seconda frequenza di ciascun gruppo
+        seconda_bassa = np.sort(basse, axis=1)[:, -2]
+        seconda_alta = np.sort(alte, axis=1)[:, -2]
+        gruppo = 10 ** (RAPPORTO_GRUPPO_DB / 10)
+        ok = ((p_bassa >= self._potenza_min) & (p_alta >= self._potenza_min)
+              & (p_bassa >= gruppo * seconda_bassa) & (p_alta >= gruppo * seconda_alta)
+              & (p_alta * 10 ** (TWIST_NORMALE_DB / 10) >= p_bassa)
+              & (p_alta <= p_bassa * 10 ** (TWIST_INVERSO_DB / 10))
+              # Potenza di Goertzel -> energia nel tempo: p * 2 / n
+              & ((p_bassa + p_alta) * 2 / self.n >= QUOTA_TONI * energia))
+        return np.where(ok, riga * 4 + colonna, -1)
+
+    def analizza(self, campioni):
+        """Aggiunge campioni int16 (array o bytes PCM little-endian) e ritorna i tasti."""
+        if isinstance(campioni, (bytes, bytearray, memoryview)):
+            campioni = np.frombuffer(campioni, dtype='<i2')
+        flusso = np.concatenate((self._resto, np.asarray(campioni, dtype=np.float64)))
+        codici = self.finestre(flusso)
+        tasti = []
+        for i, codice in enumerate(codici.tolist()):
+            if codice < 0:
+                self._premuto = -1
+            elif codice == self._precedente and codice != self._premuto:
+                self._premuto = codice
+                fine = self._inizio + i * self.passo + self.n
+                tasti.append((fine / self.frequenza, str(self._tasti[codice])))
+            self._precedente = codice
+        consumati = len(codici) * self.passo
+        self._resto = flusso[consumati:]
+        self._inizio += consumati
+        return tasti
+
+
+def leggi_intestazione(f):
+    """Formato di un WAV PCM e posizione dei dati; None se l'intestazione
+    non e' ancora completa (file appena creato)."""
+    intestazione = f.read(12)
+    if len(intestazione) < 12 or intestazione[:4] != b'RIFF' or intestazione[8:] != b'WAVE':
+        return None
+    formato = None
+    while True:
+        blocco = f.read(8)
+        if len(blocco) < 8:
+            return None
+        nome, lunghezza = blocco[:4], struct.unpack('<I', blocco[4:])[0]
+        if nome == b'data':
+            if formato is None:
+                return None
+            return formato + (f.tell(),)
+        dati = f.read(lunghezza + (lunghezza & 1))
+        if nome == b'fmt ':
+            if len(dati) < 16:
+                return None
+            _, canali, frequenza, _, _, bit = struct.unpack('<HHIIHH', dati[:16])
+            formato = (canali, frequenza, bit)
+
+
+def _remoto(peer):
+    """Parte del nome dei dump che identifica il remoto: '=>sip:numero@'
+    per un numero, '=>uri' per un URI completo."""
+    return '=>' + (peer if peer.startswith('sip:') else f'sip:{peer}@')
+
+
+def dump_chiamata(cartella, peer):
+    """Dump di Baresip (inviato e ricevuto) delle chiamate con il remoto peer."""
+    remoto = _remoto(peer)
+    return [p for p in glob.glob(os.path.join(glob.escape(cartella), 'dump-*.wav'))
+            if remoto in os.path.basename(p)]
+
+
+def cancella_dump(percorsi):
+    """Cancella i file dati; ritorna quanti ne ha cancellati."""
+    cancellati = 0
+    for percorso in percorsi:
+        try:
+            os.unlink(percorso)
+            cancellati += 1
+        except OSError:
+            pass
+    return cancellati
+
+
+class AscoltoDTMF:
+    """Segue il dump di Baresip di una chiamata e riconosce i toni in banda.
+
+    cartella: snd_path di Baresip; peer: numero o URI del remoto, per
+    trovare il file della chiamata giusta (un dump di un altro remoto non
+    viene mai letto); on_tono(tono) viene chiamata dal thread di ascolto.
+    """
+
+    def __init__(self, cartella, peer, on_tono):
+        self.cartella = cartella
+        self.peer = peer
+        self._remoto = _remoto(peer)
+        self.on_tono = on_tono
+        self.file = None
+        self._fine = Event()
+        self._t_avvio = time.time()
+        self._thread = None
+
+    def stesso_remoto(self, peer):
+        """True se peer (numero o URI) e' il remoto di questo ascolto."""
+        remoto = _remoto(peer)
+        return remoto.startswith(self._remoto) or self._remoto.startswith(remoto)
+
+    def avvia(self):
+        self._thread = Thread(target=self._ascolta, name='dtmf-audio', daemon=True)
+        self._thread.start()
+
+    def _trova(self):
+        """Dump decodificato piu' recente della chiamata, creato dopo l'avvio."""
+        candidati = []
+        for p in glob.glob(os.path.join(glob.escape(self.cartella), '*-dec.wav')):
+            try:
+                if (self._remoto in os.path.basename(p)
+                        and os.path.getmtime(p) >= self._t_avvio - 1):
+                    candidati.append(p)
+            except OSError:
+                pass  # cancellato nel frattempo
+        return max(candidati, key=os.path.getmtime, default=None)
+
+    def _ascolta(self):
+        try:
+            while self.file is None:
+                self.file = self._trova()
+                if self._fine.wait(INTERVALLO_LETTURA):
+                    return
+            with open(self.file, 'rb') as f:
+                formato = None
+                while formato is None:
+                    f.seek(0)
+                    formato = leggi_intestazione(f)
+                    if formato is None and self._fine.wait(INTERVALLO_LETTURA):
+                        return
+                canali, frequenza, bit, _ = formato
+                if bit != 16:
+                    logger.warning("Dump %s a %d bit: DTMF in banda non supportato",
+                                   self.file, bit)
+                    return
+                rivelatore = RivelatoreDTMF(frequenza)
+                logger.debug("Ascolto DTMF in banda su %s (%d Hz)", self.file, frequenza)
+                frame = 2 * canali
+                avanzo = b''
+                while not self._fine.is_set():
+                    dati = avanzo + f.read()
+                    utili = len(dati) - len(dati) % frame
+                    dati, avanzo = dati[:utili], dati[utili:]
+                    if dati:
+                        campioni = np.frombuffer(dati, dtype='<i2')
+                        if canali > 1:
+                            campioni = campioni[::canali]
+                        for _, tono in rivelatore.analizza(campioni):
+                            self.on_tono(tono)
+                    else:
+                        self._fine.wait(INTERVALLO_LETTURA)
+        except OSError as e:
+            logger.warning("Ascolto DTMF in banda interrotto: %s", e)
+
+    def termina(self):
+        """Ferma l'ascolto e cancella i dump della chiamata (Baresip li
+        chiude a fine chiamata; su tmpfs occupano RAM). Un dump non
+        ancora trovato viene cancellato alla chiusura della chiamata
+        (vedi dump_chiamata)."""
+        self._fine.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        if self.file is not None:
+            cancella_dump((self.file, self.file[:-len('-dec.wav')] + '-enc.wav'))
@@ -0,0 +1,262 @@
+"""
+Giornale persistente di suonerie, chiamate ed eventi del citofono.
+
+Gli eventi finiscono in un database SQLite in modalita' WAL. Chi registra
+un evento mette solo una tupla in coda: un thread dedicato svuota la
+coda a lotti e scrive ogni lotto in una sola transazione, come fa
+log_asincrono.py per il log, cosi' una write lenta della SD card non
+ricade sul loop degli eventi.
+
+Oltre la dimensione massima vengono cancellati gli eventi piu' vecchi e
+le pagine liberate restituite al filesystem (auto_vacuum incrementale).
+
+Tipi di evento (colonna tipo):
+
+    suoneria         suoneria riconosciuta; con una chiamata gia' in corso
+                     dettaglio 'in_coda', 'unita' (a una gia' in coda) o
+                     'ignorata' (vedi coda_chiamate.py)
+    chiamata         chiamata in uscita conclusa; dettaglio = esito
+                     (risposta, senza_risposta, timeout, annullata),
+                     numero = chi ha risposto, valore = secondi dalla
+                     suoneria alla risposta
+    ingresso         chiamata in ingresso conclusa; dettaglio = esito,
+                     numero = chiamante, valore = durata (secondi)
+    dtmf             codice ricevuto; dettaglio = azione e codice
+                     mascherato, oppure 'errato' / 'bloccato'
+    apertura         rele' attivato; dettaglio 'prolungata' se era gia'
+                     aperto
+    riavvio_baresip  Baresip riavviato; valore = secondi di ripristino,
+                     dettaglio 'programmato' per i riavvii voluti
+    centralino       cambio dell'account delle chiamate in uscita
+                     (vedi centralini.py); numero = aor del nuovo account,
+                     dettaglio = cosa l'ha causato (sonda, registrazione,
+                     riavvio)
+
+Le interrogazioni per intervallo di tempo e tipo usano gli indici su
+(ts) e (tipo, ts); rapporto_chiamate.py ne ricava i rapporti.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import logging
+import os
+import pathlib
+import queue
+import sqlite3
+import statistics
+import time
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+# Numero massimo di eventi scritti per transazione
+LOTTO_MAX = 256
+
+# Quota di eventi cancellati quando il database supera la dimensione massima
+QUOTA_POTATURA = 0.1
+
+SUONERIA = 'suoneria'
+CHIAMATA = 'chiamata'
+INGRESSO = 'ingresso'
+DTMF = 'dtmf'
+APERTURA = 'apertura'
+RIAVVIO_BARESIP = 'riavvio_baresip'
+CENTRALINO = 'centralino'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS eventi (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    tipo TEXT NOT NULL,
+    postazione TEXT,
+    numero TEXT,
+    valore REAL,
+    dettaglio TEXT
+);
+CREATE INDEX IF NOT EXISTS eventi_ts ON eventi (ts);
+CREATE INDEX IF NOT EXISTS eventi_tipo_ts ON eventi (tipo, ts);
+"""
+
+_INSERISCI = ("INSERT INTO eventi (ts, tipo, postazione, numero, valore, dettaglio) "
+              "VALUES (?, ?, ?, ?, ?, ?)")
+
+
+def apri(percorso):
+    """Apre (o crea) il database del giornale."""
+    db = sqlite3.connect(percorso, check_same_thread=False)
+    # auto_vacuum vale solo se impostato prima di creare le tabelle
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def apri_lettura(percorso):
+    """Apre il giornale in sola lettura, anche con il servizio che lo scrive.
+
+    Non crea il file e non tocca schema e impostazioni: solleva
+    sqlite3.OperationalError se il database non c'e'.
+    """
+    uri = pathlib.Path(percorso).resolve().as_uri() + '?mode=ro'
+    return sqlite3.connect(uri, uri=True)
+
+
+def maschera(codice):
+    """Codice DTMF mascherato: ne resta solo la lunghezza."""
+    return '*' * len(codice)
+
+
+class Giornale:
+    """Coda degli eventi e thread che li scrive a lotti.
+
+    Con percorso vuoto il giornale e' disattivato e registra() non fa
+    nulla. max_mb: dimensione oltre la quale si cancellano gli eventi
+    piu' vecchi (0 = nessun limite).
+    """
+
+    def __init__(self, percorso, max_mb=0):
+        self.percorso = percorso
+        self.max_byte = int(max_mb * 1024 * 1024)
+        self.coda = queue.SimpleQueue()
+        self.attivo = False
+        self._db = None
+        self._thread = None
+
+    def avvia(self):
+        """Apre il database e avvia il thread di scrittura."""
+        if not self.percorso:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.percorso) or '.', exist_ok=True)
+            self._db = apri(self.percorso)
+        except (OSError, sqlite3.Error) as e:
+            logger.error("Giornale %s non disponibile: %s", self.percorso, e)
+            return
+        self.attivo = True
+        self._thread = Thread(target=self._scrivi, name='giornale', daemon=True)
+        self._thread.start()
+        logger.info("Giornale eventi: %s", self.percorso)
+
+    def registra(self, tipo, postazione=None, numero=None, valore=None, dettaglio=None):
+        """Mette un evento in coda; non attende mai il database."""
+        if self.attivo:
+            self.coda.put((time.time(), tipo, postazione, numero, valore, dettaglio))
+
+    def _scrivi(self):
+        while True:
+            lotto = [self.coda.get()]
+            try:
+                while len(lotto) < LOTTO_MAX:
+                    lotto.append(self.coda.get_nowait())
+            except queue.Empty:
+                pass
+            fine = None in lotto
+            righe = [evento for evento in lotto if evento is not None]
+            try:
+                if righe:
+                    with self._db:
+                        self._db.executemany(_INSERISCI, righe)
+                    if self.max_byte:
+                        self._pota()
+            except sqlite3.Error as e:
+                logger.error("Scrittura del giornale fallita, %d eventi persi: %s",
+                             len(righe), e)
+            if fine:
+                return
+
+    def _pota(self):
+        """Cancella gli eventi piu' vecchi se il database e' troppo grande."""
+        db = self._db
+        pagine = db.execute("PRAGMA page_count").fetchone()[0]
+        libere = db.execute("PRAGMA freelist_count").fetchone()[0]
+        dimensione = (pagine - libere) * db.execute("PRAGMA page_size").fetchone()[0]
+        if dimensione <= self.max_byte:
+            return
+        totale = db.execute("SELECT COUNT(*) FROM eventi").fetchone()[0]
+        quanti = max(1, int(totale * QUOTA_POTATURA))
+        with db:
+            db.execute("DELETE FROM eventi WHERE id IN "
+                       "(SELECT id FROM eventi ORDER BY id LIMIT ?)", (quanti,))
+        db.execute("PRAGMA incremental_vacuum")
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logger.info("Giornale oltre %d MB: cancellati i %d eventi piu' vecchi",
+                    self.max_byte // (1024 * 1024), quanti)
+
+    def ferma(self):
+        """Scrive gli eventi ancora in coda e chiude il database."""
+        if not self.attivo:
+            return
+        self.attivo = False
+        self.coda.put(None)
+        self._thread.join(timeout=5)
+        self._db.close()
+
+
+# ============================================================
+# INTERROGAZIONI
+# ============================================================
+
+def eventi(db, da=None, a=None, tipo=None, limite=None):
+    """Eventi nell'intervallo [da, a) (epoch), in ordine di tempo."""
+    condizioni, parametri = [], []
+    if da is not None:
+        condizioni.append("ts >= ?")
+        parametri.append(da)
+    if a is not None:
+        condizioni.append("ts < ?")
+        parametri.append(a)
+    if tipo is not None:
+        condizioni.append("tipo = ?")
+        parametri.append(tipo)
+    sql = "SELECT ts, tipo, postazione, numero, valore, dettaglio FROM eventi"
+    if condizioni:
+        sql += " WHERE " + " AND ".join(condizioni)
+    sql += " ORDER BY ts"
+    if limite:
+        sql += " LIMIT ?"
+        parametri.append(limite)
+    return db.execute(sql, parametri).fetchall()
+
+
+def per_giorno(db, da=None, a=None):
+    """Riepilogo giornaliero (ora locale): lista di dizionari per giorno.
+
+    chiamate esclude quelle annullate (suonerie non confermate);
+    tasso_risposta e' None senza chiamate, mediana_risposta (secondi
+    dalla suoneria alla risposta) None senza risposte.
+    """
+    giorni = {}
+    for ts, tipo, _, _, valore, dettaglio in eventi(db, da, a):
+        giorno = giorni.setdefault(time.strftime('%Y-%m-%d', time.localtime(ts)), {
+            'suonerie': 0, 'chiamate': 0, 'risposte': 0, 'timeout': 0,
+            'ingresso': 0, 'aperture': 0, 'dtmf_errati': 0, 'riavvii_baresip': 0,
+            '_attese': [],
+        })
+        if tipo == SUONERIA and dettaglio not in ('ignorata', 'unita'):
+            giorno['suonerie'] += 1
+        elif tipo == CHIAMATA and dettaglio != 'annullata':
+            giorno['chiamate'] += 1
+            if dettaglio == 'risposta':
+                giorno['risposte'] += 1
+                if valore is not None:
+                    giorno['_attese'].append(valore)
+        elif tipo == INGRESSO:
+            giorno['ingresso'] += 1
+        elif tipo == APERTURA and dettaglio != 'prolungata':
+            giorno['aperture'] += 1
+        elif tipo == DTMF and dettaglio in ('errato', 'bloccato'):
+            giorno['dtmf_errati'] += 1
+        elif tipo == RIAVVIO_BARESIP and dettaglio != 'programmato':
+            giorno['riavvii_baresip'] += 1
+        if tipo in (CHIAMATA, INGRESSO) and dettaglio == 'timeout':
+            giorno['timeout'] += 1
+    riepilogo = []
+    for data, giorno in sorted(giorni.items()):
+        attese = giorno.pop('_attese')
+        giorno['giorno'] = data
+        giorno['tasso_risposta'] = (giorno['risposte'] / giorno['chiamate']
+                                    if giorno['chiamate'] else None)
+        giorno['mediana_risposta'] = statistics.median(attese) if attese else None
+        riepilogo.append(giorno)
+    return riepilogo
@@ -0,0 +1,322 @@
+"""
+Backend GPIO per il citofono.
+
+Tutti i backend espongono la stessa interfaccia:
+
+    setup_uscita(pin)                       uscita, inizialmente bassa
+    scrivi(pin, valore)                     imposta un'uscita
+    setup_ingresso(pin, pull_up=True)       ingresso con pull-up/pull-down
+    leggi(pin)                              livello di un ingresso
+    osserva_fronti(pin, callback, debounce_ms)
+                                            callback(t_ns) a ogni fronte di
+                                            salita; t_ns e' l'istante del
+                                            fronte in ns (CLOCK_MONOTONIC)
+    rilascia(pin)                           smette di osservare e libera un pin,
+                                            che si puo' poi configurare di nuovo
+    cleanup()
+
+Backend disponibili:
+    gpiod    - character device /dev/gpiochipN tramite libgpiod (v1 o v2):
+               un thread bloccato sugli eventi del kernel, timestamp del
+               fronte preso dal kernel, debounce sui timestamp
+    rpigpio  - RPi.GPIO: timestamp letto all'ingresso della callback,
+               polling a 20 ms se add_event_detect non e' disponibile
+    sim      - simulato in memoria, per i test
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import logging
+import os
+import select
+import time
+from threading import Thread, Lock, current_thread
+
+try:
+    import gpiod
+except ImportError:
+    gpiod = None
+
+logger = logging.getLogger(__name__)
+
+CONSUMER = 'citofono-voip'
+
+
+class BackendRPiGPIO:
+    """Backend basato su RPi.GPIO."""
+
+    nome = 'rpigpio'
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        self._polling = set()  # pin osservati dal thread di polling
+
+    def setup_uscita(self, pin):
+        self.GPIO.setup(pin, self.GPIO.OUT)
+        self.GPIO.output(pin, self.GPIO.LOW)
+
+    def scrivi(self, pin, valore):
+        self.GPIO.output(pin, self.GPIO.HIGH if valore else self.GPIO.LOW)
+
+    def setup_ingresso(self, pin, pull_up=True):
+        pud = self.GPIO.PUD_UP if pull_up else self.GPIO.PUD_DOWN
+        self.GPIO.setup(pin, self.GPIO.IN, pull_up_down=pud)
+
+    def leggi(self, pin):
+        return bool(self.GPIO.input(pin))
+
+    def osserva_fronti(self, pin, callback, debounce_ms):
+        # bouncetime=0 non e' accettato: senza debounce non si passa
+        opzioni = {'bouncetime': debounce_ms} if debounce_ms > 0 else {}
+        try:
+            self.GPIO.add_event_detect(
+                pin,
+                self.GPIO.RISING,
+                callback=lambda canale: callback(time.monotonic_ns()),
+                **opzioni,
+            )
+            logger.info("Monitoraggio GPIO%d attivo (RPi.GPIO, interrupt)", pin)
+        except Exception as e:
+            logger.warning("Edge detection fallito, uso polling: %s", e)
+            self._polling.add(pin)
+            Thread(target=self._polling_loop, args=(pin, callback, debounce_ms),
+                   daemon=True).start()
+
+    def _polling_loop(self, pin, callback, debounce_ms):
+        """Fallback: controlla GPIO con polling rilevando il fronte di salita."""
+        logger.info("Monitoraggio GPIO%d attivo (RPi.GPIO, polling)", pin)
+        time.sleep(2)  # stabilizzazione iniziale
+
+        ultimo_stato = self.GPIO.input(pin)
+        debounce_sec = debounce_ms / 1000.0
+
+        while pin in self._polling:
+            stato = self.GPIO.input(pin)
+
+            # Rileva fronte di salita (LOW -> HIGH) per coerenza con GPIO.RISING
+            if stato == self.GPIO.HIGH and ultimo_stato == self.GPIO.LOW:
+                callback(time.monotonic_ns())
+                time.sleep(debounce_sec)
+
+            ultimo_stato = stato
+            time.sleep(0.02)
+
+    def rilascia(self, pin):
+        self._polling.discard(pin)
+        try:
+            self.GPIO.remove_event_detect(pin)
+        except Exception:
+            pass
+        self.GPIO.cleanup(pin)
+
+    def cleanup(self):
+        self._polling.clear()
+        self.GPIO.cleanup()
+
+
+class BackendGpiod:
+    """Backend su character device tramite libgpiod (API v1 e v2).
+
+    Il debounce e' fatto sui timestamp del kernel, come il bouncetime di
+    RPi.GPIO: un fronte piu' vicino di debounce_ms all'ultimo passato
+    alla callback viene scartato.
+    """
+
+    nome = 'gpiod'
+
+    def __init__(self, chip):
+        if gpiod is None:
+            raise RuntimeError("modulo gpiod non installato (python3-libgpiod)")
+        self.chip_path = chip
+        self.v2 = hasattr(gpiod, 'request_lines')
+        self._richieste = {}  # pin -> request (v2) o line (v1)
+        self._pull_up = {}
+        self._osservatori = {}  # pin -> (thread, pipe di arresto)
+        self._lock = Lock()
+        self._stop_r, self._stop_w = os.pipe()
+        self._chip = None if self.v2 else gpiod.Chip(chip)
+        logger.info("Backend GPIO: libgpiod %s su %s", 'v2' if self.v2 else 'v1', chip)
+
+    def _richiedi(self, pin, uscita, pull_up=True, fronti=False):
+        # Una linea gia' richiesta va rilasciata prima di richiederla di nuovo
+        self.rilascia(pin)
+
+        if self.v2:
+            from gpiod.line import Bias, Direction, Edge, Value
+            if uscita:
+                settings = gpiod.LineSettings(direction=Direction.OUTPUT,
+                                              output_value=Value.INACTIVE)
+            else:
+                settings = gpiod.LineSettings(
+                    direction=Direction.INPUT,
+                    bias=Bias.PULL_UP if pull_up else Bias.PULL_DOWN,
+                    edge_detection=Edge.RISING if fronti else Edge.NONE,
+                )
+            richiesta = gpiod.request_lines(self.chip_path, consumer=CONSUMER,
+                                            config={pin: settings})
+        else:
+            richiesta = self._chip.get_line(pin)
+            if uscita:
+                richiesta.request(consumer=CONSUMER, type=gpiod.LINE_REQ_DIR_OUT,
+                                  default_vals=[0])
+            else:
+                flag = (gpiod.LINE_REQ_FLAG_BIAS_PULL_UP if pull_up
+                        else gpiod.LINE_REQ_FLAG_BIAS_PULL_DOWN)
+                tipo = gpiod.LINE_REQ_EV_RISING_EDGE if fronti else gpiod.LINE_REQ_DIR_IN
+                richiesta.request(consumer=CONSUMER, type=tipo, flags=flag)
+        with self._lock:
+            self._richieste[pin] = richiesta
+        return richiesta
+
+    def setup_uscita(self, pin):
+        self._richiedi(pin, uscita=True)
+
+    def scrivi(self, pin, valore):
+        richiesta = self._richieste[pin]
+        if self.v2:
+            from gpiod.line import Value
+            richiesta.set_value(pin, Value.ACTIVE if valore else Value.INACTIVE)
+        else:
+            richiesta.set_value(1 if valore else 0)
+
+    def setup_ingresso(self, pin, pull_up=True):
+        self._pull_up[pin] = pull_up
+        self._richiedi(pin, uscita=False, pull_up=pull_up)
+
+    def leggi(self, pin):
+        richiesta = self._richieste[pin]
+        if self.v2:
+            from gpiod.line import Value
+            return richiesta.get_value(pin) == Value.ACTIVE
+        return bool(richiesta.get_value())
+
+    def osserva_fronti(self, pin, callback, debounce_ms):
+        # La richiesta va rifatta con il rilevamento dei fronti abilitato
+        richiesta = self._richiedi(pin, uscita=False,
+                                   pull_up=self._pull_up.get(pin, True), fronti=True)
+        stop_r, stop_w = os.pipe()
+        thread = Thread(target=self._attendi_fronti,
+                        args=(pin, richiesta, callback, debounce_ms, stop_r),
+                        name=f'gpiod-{pin}', daemon=True)
+        self._osservatori[pin] = (thread, stop_w)
+        thread.start()
+        logger.info("Monitoraggio GPIO%d attivo (libgpiod, eventi kernel)", pin)
+
+    def _attendi_fronti(self, pin, richiesta, callback, debounce_ms, stop_r):
+        """Resta bloccato sul file descriptor della linea fino al prossimo fronte."""
+        try:
+            self._attendi(pin, richiesta, callback, debounce_ms, stop_r)
+        finally:
+            os.close(stop_r)
+
+    def _attendi(self, pin, richiesta, callback, debounce_ms, stop_r):
+        fd = richiesta.fd if self.v2 else richiesta.event_get_fd()
+        debounce_ns = int(debounce_ms * 1_000_000)
+        ultimo = None  # timestamp dell'ultimo fronte passato alla callback
+        while True:
+            pronti, _, _ = select.select([fd, self._stop_r, stop_r], [], [])
+            if self._stop_r in pronti or stop_r in pronti:
+                return
+            try:
+                if self.v2:
+                    eventi = [e.timestamp_ns for e in richiesta.read_edge_events()]
+                else:
+                    e = richiesta.event_read()
+                    eventi = [e.sec * 1_000_000_000 + e.nsec]
+            except OSError:
+                logger.error("Errore lettura eventi GPIO%d", pin, exc_info=True)
+                return
+            for t_ns in eventi:
+                if ultimo is not None and t_ns - ultimo < debounce_ns:
+                    continue
+                ultimo = t_ns
+                callback(t_ns)
+
+    def rilascia(self, pin):
+        # Il thread degli eventi va fermato prima di chiudere la linea
+        # su cui e' in attesa
+        osservatore = self._osservatori.pop(pin, None)
+        if osservatore is not None:
+            thread, stop_w = osservatore
+            os.write(stop_w, b'x')
+            if thread is not current_thread():
+                thread.join(1.0)
+            os.close(stop_w)
+        with self._lock:
+            richiesta = self._richieste.pop(pin, None)
+        if richiesta is not None:
+            try:
+                richiesta.release()
+            except OSError:
+                pass
+
+    def cleanup(self):
+        os.write(self._stop_w, b'x')
+        with self._lock:
+            richieste, self._richieste = self._richieste, {}
+        for richiesta in richieste.values():
+            try:
+                richiesta.release()
+            except OSError:
+                pass
+        if self._chip is not None:
+            self._chip.close()
+
+
+class BackendSimulato:
+    """Backend in memoria: i fronti si generano con simula_fronte()."""
+
+    nome = 'sim'
+
+    def __init__(self):
+        self.livelli = {}
+        self.callbacks = {}
+        self.storico = []  # (pin, valore, t_ns) per ogni scrivi()
+
+    def setup_uscita(self, pin):
+        self.livelli[pin] = False
+
+    def scrivi(self, pin, valore):
+        self.livelli[pin] = bool(valore)
+        self.storico.append((pin, bool(valore), time.monotonic_ns()))
+
+    def setup_ingresso(self, pin, pull_up=True):
+        self.livelli[pin] = pull_up
+
+    def leggi(self, pin):
+        return self.livelli.get(pin, False)
+
+    def osserva_fronti(self, pin, callback, debounce_ms):
+        self.callbacks.setdefault(pin, []).append(callback)
+        logger.info("Monitoraggio GPIO%d attivo (simulato)", pin)
+
+    def simula_fronte(self, pin, t_ns=None):
+        """Genera un fronte di salita; t_ns di default e' l'istante attuale."""
+        if t_ns is None:
+            t_ns = time.monotonic_ns()
+        self.livelli[pin] = True
+        for callback in self.callbacks.get(pin, ()):
+            callback(t_ns)
+
+    def rilascia(self, pin):
+        self.callbacks.pop(pin, None)
+        self.livelli.pop(pin, None)
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+
+def crea_backend(nome='auto', chip='/dev/gpiochip0'):
+    """Crea il backend richiesto; 'auto' preferisce libgpiod se disponibile."""
+    if nome == 'auto':
+        nome = 'gpiod' if gpiod is not None and os.path.exists(chip) else 'rpigpio'
+    if nome == 'gpiod':
+        return BackendGpiod(chip)
+    if nome == 'rpigpio':
+        return BackendRPiGPIO()
+    if nome == 'sim':
+        return BackendSimulato()
+    raise ValueError(f"backend GPIO sconosciuto: {nome}")
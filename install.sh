@@ -28,6 +28,7 @@ echo ""
 echo "[1/5] Installazione dipendenze..."
 apt update
 apt install -y \
+    python3-libgpiod \
     python3-rpi.gpio \
     baresip \
     baresip-core \
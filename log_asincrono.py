@@ -0,0 +1,197 @@
+"""
+Logging asincrono per il citofono.
+
+Chi registra un messaggio mette solo il record in coda: formattazione e
+scrittura avvengono in un thread dedicato, che svuota la coda a lotti e
+scrive su file con un solo flush per lotto, ruotando il file per
+dimensione. Le SD card possono bloccare una write per centinaia di
+millisecondi: cosi' il blocco non ricade sul loop degli eventi.
+
+Le righe di Baresip passano da un limitatore: righe uguali (a meno dei
+numeri) oltre un certo numero per finestra vengono scartate, e a fine
+finestra viene registrato quante ne sono state soppresse.
+
+Formati: 'testo' (come prima) o 'json' (un oggetto JSON per riga). Un
+record con l'attributo chiamata (vedi tracce.FiltroChiamata) riporta
+anche l'id della chiamata: nel testo tra parentesi dopo il livello, nel
+JSON come campo chiamata.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import time
+from threading import Thread
+
+FORMATO_TESTO = '%(asctime)s [%(levelname)s] %(message)s'
+FORMATO_CHIAMATA = '%(asctime)s [%(levelname)s] (%(chiamata)s) %(message)s'
+
+# Numero massimo di record scritti per lotto
+LOTTO_MAX = 256
+
+_RE_NUMERI = re.compile(r'\d+')
+
+
+class FormatterJSON(logging.Formatter):
+    """Un oggetto JSON per riga: ts, livello, logger, msg (ed eccezione)."""
+
+    def format(self, record):
+        voce = {
+            'ts': round(record.created, 3),
+            'livello': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'chiamata', None):
+            voce['chiamata'] = record.chiamata
+        if record.exc_info:
+            voce['eccezione'] = self.formatException(record.exc_info)
+        return json.dumps(voce, ensure_ascii=False)
+
+
+class FormatterTesto(logging.Formatter):
+    """FORMATO_TESTO, o FORMATO_CHIAMATA per i record di una chiamata."""
+
+    def __init__(self):
+        super().__init__(FORMATO_TESTO)
+        self._chiamata = logging.Formatter(FORMATO_CHIAMATA)
+
+    def format(self, record):
+        if getattr(record, 'chiamata', None):
+            return self._chiamata.format(record)
+        return super().format(record)
+
+
+class HandlerCoda(logging.handlers.QueueHandler):
+    """Mette il record in coda cosi' com'e', senza formattarlo.
+
+    QueueHandler.prepare() formatta gia' il messaggio nel thread
+    chiamante; qui la formattazione e' lasciata allo scrittore.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class FileRuotato(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler con flush esplicito a fine lotto."""
+
+    def flush(self):
+        pass
+
+    def scarica(self):
+        super().flush()
+
+
+class LimitatoreRighe(logging.Filter):
+    """Limita le righe ripetitive: al massimo `massimo` per finestra.
+
+    Le righe sono raggruppate sostituendo i numeri, cosi' statistiche e
+    contatori che cambiano a ogni riga contano come la stessa riga.
+    """
+
+    def __init__(self, massimo, finestra):
+        super().__init__()
+        self.massimo = massimo
+        self.finestra = finestra
+        self._inizio = time.monotonic()
+        self._conteggi = {}
+        self.soppresse = 0  # totale dall'avvio
+
+    def filter(self, record):
+        ora = time.monotonic()
+        if ora - self._inizio >= self.finestra:
+            self._chiudi_finestra(record.name)
+            self._inizio = ora
+        chiave = _RE_NUMERI.sub('#', record.getMessage())
+        conteggio = self._conteggi.get(chiave, 0) + 1
+        self._conteggi[chiave] = conteggio
+        if conteggio > self.massimo:
+            self.soppresse += 1
+            return False
+        return True
+
+    def _chiudi_finestra(self, nome):
+        soppresse = sum(c - self.massimo for c in self._conteggi.values() if c > self.massimo)
+        self._conteggi = {}
+        if soppresse:
+            # Il record di riepilogo non passa dal filtro: va all'handler
+            logging.getLogger().handle(logging.LogRecord(
+                nome, logging.INFO, __file__, 0,
+                "%d righe ripetute soppresse negli ultimi %gs", (soppresse, self.finestra), None))
+
+
+class ScrittoreLog:
+    """Thread che svuota la coda dei record e li scrive a lotti."""
+
+    def __init__(self, coda, handlers):
+        self.coda = coda
+        self.handlers = handlers
+        self._thread = Thread(target=self._scrivi, name='log', daemon=True)
+
+    def avvia(self):
+        self._thread.start()
+
+    def _scrivi(self):
+        while True:
+            lotto = [self.coda.get()]
+            try:
+                while len(lotto) < LOTTO_MAX:
+                    lotto.append(self.coda.get_nowait())
+            except queue.Empty:
+                pass
+            fine = None in lotto
+            handlers = self.handlers
+            for handler in handlers:
+                for record in lotto:
+                    if record is not None and record.levelno >= handler.level:
+                        handler.handle(record)
+                if isinstance(handler, FileRuotato):
+                    handler.scarica()
+            if fine:
+                return
+
+    def ferma(self):
+        """Scrive i record ancora in coda e termina il thread."""
+        if self._thread.is_alive():
+            self.coda.put(None)
+            self._thread.join(timeout=5)
+        for handler in self.handlers:
+            handler.close()
+
+
+def configura(livello, file=None, formato='testo', max_byte=0, backup=0,
+              logger_righe=None, righe_max=0, righe_finestra=60, filtro=None):
+    """Installa la pipeline sul logger radice e ritorna lo ScrittoreLog.
+
+    file: percorso del log (None = solo console); max_byte/backup:
+    rotazione per dimensione (0 = nessuna rotazione). logger_righe:
+    nome del logger a cui applicare il limitatore (righe_max per
+    righe_finestra secondi; 0 = nessun limite). filtro: logging.Filter
+    applicato a ogni record nel thread di chi registra, prima della coda.
+    """
+    formatter = FormatterJSON() if formato == 'json' else FormatterTesto()
+    handlers = [logging.StreamHandler()]
+    if file:
+        handlers.append(FileRuotato(file, maxBytes=max_byte, backupCount=backup))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    coda = queue.SimpleQueue()
+    radice = logging.getLogger()
+    radice.setLevel(livello)
+    handler_coda = HandlerCoda(coda)
+    if filtro is not None:
+        handler_coda.addFilter(filtro)
+    radice.addHandler(handler_coda)
+
+    if logger_righe and righe_max > 0:
+        logging.getLogger(logger_righe).addFilter(LimitatoreRighe(righe_max, righe_finestra))
+
+    scrittore = ScrittoreLog(coda, handlers)
+    scrittore.avvia()
+    return scrittore
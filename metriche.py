@@ -0,0 +1,135 @@
+"""
+Metriche del citofono in formato testo Prometheus.
+
+Contatori, gauge e istogrammi con bucket fissi, aggiornati dal thread
+del loop senza lock. Il server HTTP gira sullo stesso loop asyncio e
+risponde a GET /metrics.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import asyncio
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bucket (secondi) per le latenze del percorso di chiamata
+BUCKET_LATENZA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 10)
+# Bucket (secondi) per attesa risposta e durata chiamata
+BUCKET_CHIAMATA = (1, 2, 5, 10, 15, 20, 30, 45, 60, 120, 300, 600)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _valore(v):
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+class Contatore:
+    tipo = 'counter'
+
+    def __init__(self, nome, descrizione):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.valore = 0
+
+    def inc(self, n=1):
+        self.valore += n
+
+    def campioni(self):
+        yield self.nome, self.valore
+
+
+class Gauge:
+    """Valore letto da una funzione al momento della richiesta."""
+
+    tipo = 'gauge'
+
+    def __init__(self, nome, descrizione, funzione):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.funzione = funzione
+
+    def campioni(self):
+        yield self.nome, self.funzione()
+
+
+class Istogramma:
+    tipo = 'histogram'
+
+    def __init__(self, nome, descrizione, bucket):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.bucket = tuple(sorted(bucket))
+        self.conteggi = [0] * (len(self.bucket) + 1)  # l'ultimo e' +Inf
+        self.somma = 0.0
+
+    def osserva(self, valore):
+        self.conteggi[bisect.bisect_left(self.bucket, valore)] += 1
+        self.somma += valore
+
+    def campioni(self):
+        cumulato = 0
+        for limite, conteggio in zip(self.bucket, self.conteggi):
+            cumulato += conteggio
+            yield f'{self.nome}_bucket{{le="{_valore(limite)}"}}', cumulato
+        cumulato += self.conteggi[-1]
+        yield f'{self.nome}_bucket{{le="+Inf"}}', cumulato
+        yield f'{self.nome}_sum', self.somma
+        yield f'{self.nome}_count', cumulato
+
+
+class Registro:
+    """Insieme delle metriche esposte dall'endpoint."""
+
+    def __init__(self):
+        self.metriche = []
+
+    def _aggiungi(self, metrica):
+        self.metriche.append(metrica)
+        return metrica
+
+    def contatore(self, nome, descrizione):
+        return self._aggiungi(Contatore(nome, descrizione))
+
+    def gauge(self, nome, descrizione, funzione):
+        return self._aggiungi(Gauge(nome, descrizione, funzione))
+
+    def istogramma(self, nome, descrizione, bucket=BUCKET_LATENZA):
+        return self._aggiungi(Istogramma(nome, descrizione, bucket))
+
+    def testo(self):
+        righe = []
+        for metrica in self.metriche:
+            righe.append(f'# HELP {metrica.nome} {metrica.descrizione}')
+            righe.append(f'# TYPE {metrica.nome} {metrica.tipo}')
+            for nome, valore in metrica.campioni():
+                righe.append(f'{nome} {_valore(valore)}')
+        return '\n'.join(righe) + '\n'
+
+
+async def _rispondi(registro, reader, writer):
+    try:
+        richiesta = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        metodo, percorso, _ = richiesta.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+        if metodo == 'GET' and percorso.split('?', 1)[0] in ('/metrics', '/'):
+            stato, corpo = '200 OK', registro.testo().encode()
+        else:
+            stato, corpo = '404 Not Found', b'non trovato\n'
+        writer.write((f'HTTP/1.1 {stato}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+                      f'Content-Length: {len(corpo)}\r\nConnection: close\r\n\r\n').encode() + corpo)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ValueError, OSError):
+        logger.debug("Richiesta metriche non valida", exc_info=True)
+    finally:
+        writer.close()
+
+
+async def avvia_server(registro, host, porta):
+    """Avvia l'endpoint HTTP sul loop corrente e ritorna il server asyncio."""
+    server = await asyncio.start_server(
+        lambda reader, writer: _rispondi(registro, reader, writer), host, porta)
+    logger.info("Metriche Prometheus su http://%s:%d/metrics", host, porta)
+    return server
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Ritardo e CPU dei profili audio, misurati con una chiamata in locale.
+
+    python3 misura_audio.py                        # tutti i profili, G.711
+    python3 misura_audio.py -p bassa_latenza -c opus -d 30
+    python3 misura_audio.py --scheda hw:1,0        # eco attraverso la scheda audio
+
+Per ogni profilo avvia due Baresip su 127.0.0.1, configurati da
+audio_profili come quello del citofono:
+
+    A  chiama B; la sorgente e' un file di impulsi di tono (uno al
+       secondo) e il modulo sndfile registra l'audio inviato e ricevuto
+    B  risponde da solo e rimanda indietro l'audio che riceve: con il
+       modulo aubridge o, con --scheda, attraverso la scheda audio con
+       l'uscita collegata all'ingresso (un cavo, o il microfono del
+       portone davanti al suo altoparlante)
+
+Lo script segue i due dump di A mentre crescono e prende per ogni
+impulso l'istante in cui compare nell'audio inviato e in quello
+ricevuto. La differenza e' il ritardo di andata e ritorno: due volte
+codec, rete e jitter buffer, piu' riproduzione e acquisizione di B. La
+meta' e' la stima del ritardo bocca-orecchio; con --scheda il percorso
+di B e' quello del citofono, buffer ALSA compresi. La risoluzione e' di
+qualche ms: i dump crescono di un pacchetto alla volta.
+
+La CPU e' il tempo di calcolo di ciascun Baresip (utente + sistema, da
+/proc) per secondo di misura, in percentuale di un core. Va eseguito
+sul Raspberry Pi, a servizio fermo se si usa la sua scheda audio.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import argparse
+import array
+import glob
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import audio_profili
+from dtmf_audio import leggi_intestazione
+
+PORTA_A = 15061
+PORTA_B = 15062
+
+# Impulsi: 1 kHz per 40 ms a -6 dBFS, uno al secondo
+TONO_HZ = 1000
+DURATA_IMPULSO = 0.04
+PERIODO_IMPULSI = 1.0
+AMPIEZZA = 16384
+
+# Campione oltre cui inizia un impulso, e silenzio minimo prima dell'inizio
+SOGLIA = 4096
+SILENZIO_MIN = 0.3
+
+INTERVALLO_LETTURA = 0.002
+ATTESA_CHIAMATA = 10
+
+
+def genera_impulsi(percorso, frequenza, durata):
+    """WAV mono 16 bit con un impulso al secondo, dopo un secondo di silenzio."""
+    campioni = array.array('h', bytes(2 * int(frequenza * (durata + 1))))
+    lunghezza = int(DURATA_IMPULSO * frequenza)
+    for inizio in range(frequenza, len(campioni) - lunghezza, int(PERIODO_IMPULSI * frequenza)):
+        for i in range(lunghezza):
+            campioni[inizio + i] = int(AMPIEZZA * math.sin(2 * math.pi * TONO_HZ * i / frequenza))
+    if sys.byteorder == 'big':
+        campioni.byteswap()
+    with wave.open(percorso, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(frequenza)
+        f.writeframes(campioni.tobytes())
+
+
+def scrivi_config(cartella, porta, utente, risposta, audio, moduli, profilo, codec,
+                  module_path, extra=''):
+    os.makedirs(cartella)
+    with open(os.path.join(cartella, 'accounts'), 'w') as f:
+        f.write(f"<sip:{utente}@127.0.0.1:{porta}>;regint=0;answermode={risposta}"
+                f"{audio_profili.parametri_account(profilo, codec)}\n")
+    moduli = list(moduli) + audio_profili.moduli(codec)
+    with open(os.path.join(cartella, 'config'), 'w') as f:
+        f.write(f"module_path {module_path}\n"
+                f"sip_listen 127.0.0.1:{porta}\n"
+                f"{audio}"
+                f"{audio_profili.config(profilo, codec)}"
+                + ''.join(f"module {modulo}.so\n" for modulo in moduli)
+                + extra)
+
+
+def tempo_cpu(pid):
+    """Secondi di CPU (utente + sistema) del processo."""
+    with open(f'/proc/{pid}/stat') as f:
+        campi = f.read().rpartition(')')[2].split()
+    return (int(campi[11]) + int(campi[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class Dump:
+    """Segue un dump WAV di sndfile e trova l'istante di inizio degli impulsi."""
+
+    def __init__(self, percorso):
+        self.percorso = percorso
+        self.f = open(percorso, 'rb')
+        self.frequenza = None
+        self.avanzo = b''
+        self.minimo = self.silenzio = 0  # campioni sotto soglia: minimo e di fila
+        self.impulsi = []  # time.monotonic() dell'inizio
+
+    def leggi(self):
+        if self.frequenza is None:
+            self.f.seek(0)
+            formato = leggi_intestazione(self.f)
+            if formato is None:
+                return
+            canali, self.frequenza, bit, _ = formato
+            if (canali, bit) != (1, 16):
+                raise SystemExit(f"{self.percorso}: atteso PCM mono a 16 bit")
+            self.minimo = self.silenzio = int(SILENZIO_MIN * self.frequenza)
+        ora = time.monotonic()
+        dati = self.avanzo + self.f.read()
+        utili = len(dati) - len(dati) % 2
+        dati, self.avanzo = dati[:utili], dati[utili:]
+        campioni = array.array('h', dati)
+        if sys.byteorder == 'big':
+            campioni.byteswap()
+        for i, campione in enumerate(campioni):
+            if abs(campione) < SOGLIA:
+                self.silenzio += 1
+                continue
+            if self.silenzio >= self.minimo:
+                # L'ultimo campione del file e' l'audio di adesso
+                self.impulsi.append(ora - (len(campioni) - i) / self.frequenza)
+            self.silenzio = 0
+
+    def chiudi(self):
+        self.f.close()
+
+
+def ritardi(inviati, ricevuti):
+    """Per ogni impulso ricevuto, secondi dall'ultimo inviato prima di lui."""
+    risultato = []
+    for t in ricevuti:
+        precedenti = [s for s in inviati if s <= t]
+        if precedenti and t - precedenti[-1] < PERIODO_IMPULSI:
+            risultato.append(t - precedenti[-1])
+    return risultato
+
+
+def percentile(valori, p):
+    ordinati = sorted(valori)
+    return ordinati[min(len(ordinati) - 1, int(p / 100 * len(ordinati)))]
+
+
+def _coda_log(cartella, righe=5):
+    """Ultime righe dei log dei due Baresip, per capire perche' non va."""
+    testo = []
+    for nome in ('a', 'b'):
+        with open(os.path.join(cartella, f'baresip-{nome}.log'), errors='replace') as f:
+            testo += [f"  {nome}: {riga.rstrip()}" for riga in f.readlines()[-righe:]]
+    return '\n'.join(testo)
+
+
+def termina(processo):
+    if processo.poll() is None:
+        processo.terminate()
+        try:
+            processo.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            processo.kill()
+            processo.wait()
+
+
+def misura(args, profilo, codec, cartella):
+    """Una chiamata da A a B con il profilo; ritorna (ritardi, cpu A, cpu B, secondi)."""
+    impulsi = os.path.join(cartella, 'impulsi.wav')
+    dump = os.path.join(cartella, 'dump')
+    os.makedirs(dump)
+    genera_impulsi(impulsi, codec.frequenza, args.durata + ATTESA_CHIAMATA)
+    scrivi_config(os.path.join(cartella, 'a'), PORTA_A, 'a', 'manual',
+                  f"audio_source aufile,{impulsi}\n"
+                  f"audio_player aufile,{os.path.join(cartella, 'ricevuto.wav')}\n",
+                  ('account', 'menu', 'aufile', 'sndfile'), profilo, codec,
+                  args.module_path, f"snd_path {dump}\n")
+    if args.scheda:
+        audio_b = f"audio_player alsa,{args.scheda}\naudio_source alsa,{args.scheda}\n"
+        moduli_b = ('account', 'alsa')
+    else:
+        audio_b = "audio_player aubridge,eco\naudio_source aubridge,eco\n"
+        moduli_b = ('account', 'aubridge')
+    scrivi_config(os.path.join(cartella, 'b'), PORTA_B, 'b', 'auto', audio_b, moduli_b,
+                  profilo, codec, args.module_path)
+
+    processi = []
+    dumps = []
+    try:
+        for nome, comandi in (('b', []), ('a', ['-e', f'/dial sip:b@127.0.0.1:{PORTA_B}'])):
+            with open(os.path.join(cartella, f'baresip-{nome}.log'), 'w') as log:
+                processi.append(subprocess.Popen(
+                    [args.baresip, '-f', os.path.join(cartella, nome)] + comandi,
+                    stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT))
+            time.sleep(1)
+        scadenza = time.monotonic() + ATTESA_CHIAMATA
+        while len(dumps) < 2:
+            if time.monotonic() > scadenza or any(p.poll() is not None for p in processi):
+                raise RuntimeError("chiamata non stabilita\n" + _coda_log(cartella))
+            trovati = [glob.glob(os.path.join(dump, f'*-{verso}.wav')) for verso in ('enc', 'dec')]
+            if all(trovati):
+                dumps = [Dump(p[0]) for p in trovati]
+            time.sleep(INTERVALLO_LETTURA)
+        inviati, ricevuti = dumps
+        cpu_inizio = [tempo_cpu(p.pid) for p in processi]
+        t_inizio = time.monotonic()
+        while time.monotonic() - t_inizio < args.durata:
+            for d in dumps:
+                d.leggi()
+            time.sleep(INTERVALLO_LETTURA)
+        secondi = time.monotonic() - t_inizio
+        cpu_b, cpu_a = (tempo_cpu(p.pid) - c for p, c in zip(processi, cpu_inizio))
+        return ritardi(inviati.impulsi, ricevuti.impulsi), cpu_a, cpu_b, secondi
+    finally:
+        for d in dumps:
+            d.chiudi()
+        for p in reversed(processi):
+            termina(p)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ritardo e CPU dei profili audio di Baresip")
+    parser.add_argument('-p', '--profilo', action='append', choices=sorted(audio_profili.PROFILI),
+                        help="profilo da misurare (ripetibile; default: tutti)")
+    parser.add_argument('-c', '--codec', default='g711', choices=sorted(audio_profili.CODEC))
+    parser.add_argument('-d', '--durata', type=float, default=20,
+                        help="secondi di misura per profilo (default 20)")
+    parser.add_argument('--scheda', help="dispositivo ALSA di B con uscita e ingresso "
+                                         "collegati, es. hw:1,0 (default: aubridge)")
+    parser.add_argument('--baresip', default='baresip')
+    parser.add_argument('--module-path', default='/usr/lib/baresip/modules')
+    args = parser.parse_args()
+
+    if shutil.which(args.baresip) is None:
+        sys.exit(f"{args.baresip} non trovato")
+    codec = audio_profili.CODEC[args.codec]
+    esito = 0
+    print(f"{'profilo':<14} {'impulsi':>7} {'a/r p50':>8} {'a/r p95':>8} "
+          f"{'bocca-orecchio':>15} {'CPU A':>6} {'CPU B':>6}")
+    for nome in args.profilo or audio_profili.PROFILI:
+        profilo = audio_profili.PROFILI[nome]
+        with tempfile.TemporaryDirectory(prefix='misura-audio-') as cartella:
+            try:
+                valori, cpu_a, cpu_b, secondi = misura(args, profilo, codec, cartella)
+            except RuntimeError as e:
+                print(f"{nome:<14} {e}")
+                esito = 1
+                continue
+        cpu = f"{100 * cpu_a / secondi:5.1f}% {100 * cpu_b / secondi:5.1f}%"
+        if not valori:
+            print(f"{nome:<14} {0:>7} nessun impulso tornato indietro {cpu}")
+            esito = 1
+            continue
+        p50 = 1000 * percentile(valori, 50)
+        print(f"{nome:<14} {len(valori):>7} {p50:6.0f}ms {1000 * percentile(valori, 95):6.0f}ms "
+              f"{p50 / 2:13.0f}ms {cpu}")
+    return esito
+
+
+if __name__ == '__main__':
+    sys.exit(main())
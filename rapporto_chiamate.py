@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Rapporti dal giornale degli eventi del citofono.
+
+    python3 rapporto_chiamate.py giorni                    # ultimi 30 giorni
+    python3 rapporto_chiamate.py giorni --da 2025-01-01 --a 2025-02-01
+    python3 rapporto_chiamate.py eventi --tipo chiamata --da 2025-01-15
+
+'giorni' riporta per ogni giorno suonerie, chiamate, tasso di risposta,
+mediana dalla suoneria alla risposta, chiamate in ingresso, aperture,
+timeout, codici errati e riavvii di Baresip, piu' il totale del periodo.
+'eventi' elenca gli eventi registrati. Il giornale e' GIORNALE_FILE di
+config.env, o quello indicato con --file; si puo' leggere con il
+servizio in esecuzione.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import time
+
+import configurazione
+import giornale
+
+GIORNI_DEFAULT = 30
+
+
+def _data(testo):
+    """'AAAA-MM-GG' o 'AAAA-MM-GG HH:MM' (ora locale) -> epoch."""
+    for formato in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(testo, formato))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"data non valida '{testo}' (AAAA-MM-GG [HH:MM])")
+
+
+def _percentuale(valore):
+    return '-' if valore is None else f"{valore * 100:.0f}%"
+
+
+def _secondi(valore):
+    return '-' if valore is None else f"{valore:.2f}s"
+
+
+def giorni(db, args):
+    da = args.da if args.da is not None else time.time() - GIORNI_DEFAULT * 86400
+    riepilogo = giornale.per_giorno(db, da, args.a)
+    if not riepilogo:
+        print("Nessun evento nel periodo")
+        return
+    colonne = ('suonerie', 'chiamate', 'risposte', 'ingresso', 'aperture', 'timeout',
+               'dtmf_errati', 'riavvii_baresip')
+    print(f"{'giorno':10} {'suon':>5} {'chiam':>5} {'risp':>5} {'tasso':>6} {'mediana':>8} "
+          f"{'ingr':>5} {'aper':>5} {'tout':>5} {'dtmf!':>5} {'riavv':>5}")
+    for g in riepilogo:
+        print(f"{g['giorno']:10} {g['suonerie']:5d} {g['chiamate']:5d} {g['risposte']:5d} "
+              f"{_percentuale(g['tasso_risposta']):>6} {_secondi(g['mediana_risposta']):>8} "
+              f"{g['ingresso']:5d} {g['aperture']:5d} {g['timeout']:5d} "
+              f"{g['dtmf_errati']:5d} {g['riavvii_baresip']:5d}")
+    totale = {c: sum(g[c] for g in riepilogo) for c in colonne}
+    # La mediana del periodo va ricalcolata sulle singole risposte
+    attese = [valore for _, _, _, _, valore, dettaglio
+              in giornale.eventi(db, da, args.a, giornale.CHIAMATA)
+              if dettaglio == 'risposta' and valore is not None]
+    tasso = totale['risposte'] / totale['chiamate'] if totale['chiamate'] else None
+    print(f"{'totale':10} {totale['suonerie']:5d} {totale['chiamate']:5d} "
+          f"{totale['risposte']:5d} {_percentuale(tasso):>6} "
+          f"{_secondi(statistics.median(attese) if attese else None):>8} "
+          f"{totale['ingresso']:5d} {totale['aperture']:5d} {totale['timeout']:5d} "
+          f"{totale['dtmf_errati']:5d} {totale['riavvii_baresip']:5d}")
+
+
+def elenca(db, args):
+    for ts, tipo, postazione, numero, valore, dettaglio in giornale.eventi(
+            db, args.da, args.a, args.tipo, args.limite):
+        campi = [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)), tipo,
+                 postazione or '-', numero or '-']
+        if valore is not None:
+            campi.append(f"{valore:.2f}")
+        if dettaglio:
+            campi.append(dettaglio)
+        print('  '.join(campi))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--file', help="database del giornale (default: GIORNALE_FILE)")
+    comandi = parser.add_subparsers(dest='comando', required=True)
+    for nome, aiuto in (('giorni', "riepilogo giornaliero"), ('eventi', "elenco degli eventi")):
+        p = comandi.add_parser(nome, help=aiuto)
+        p.add_argument('--da', type=_data, help="inizio del periodo (AAAA-MM-GG [HH:MM])")
+        p.add_argument('--a', type=_data, help="fine del periodo, esclusa")
+    p.add_argument('--tipo', choices=(giornale.SUONERIA, giornale.CHIAMATA, giornale.INGRESSO,
+                                      giornale.DTMF, giornale.APERTURA, giornale.RIAVVIO_BARESIP,
+                                      giornale.CENTRALINO))
+    p.add_argument('--limite', type=int, help="numero massimo di eventi")
+    args = parser.parse_args()
+
+    percorso = args.file
+    if percorso is None:
+        try:
+            percorso = configurazione.carica().GIORNALE_FILE
+        except (OSError, ValueError) as e:
+            sys.exit(f"Configurazione non valida: {e}")
+    if not percorso or not os.path.isfile(percorso):
+        sys.exit(f"Giornale non trovato: {percorso or '(GIORNALE_FILE vuoto)'}")
+    try:
+        db = giornale.apri_lettura(percorso)
+        if args.comando == 'giorni':
+            giorni(db, args)
+        else:
+            elenca(db, args)
+    except sqlite3.Error as e:
+        sys.exit(f"Errore del giornale {percorso}: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+RPi.GPIO simulato.
+
+Implementa il sottoinsieme di RPi.GPIO usato da citofono-voip.py
+mantenendo lo stato dei pin in memoria. Le callback di add_event_detect
+vengono eseguite su un unico thread, come nella libreria reale, con lo
+stesso bouncetime.
+
+Funzioni aggiuntive per i test:
+    simula_fronte(pin)          impulso LOW -> HIGH -> LOW sull'ingresso
+    imposta_ingresso(pin, val)  forza il livello di un ingresso
+    osservatori                 lista di callback(pin, valore, t_monotonic)
+                                chiamate a ogni GPIO.output()
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import queue
+import threading
+import time
+
+BCM = 11
+BOARD = 10
+IN = 1
+OUT = 0
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+RPI_INFO = {'TYPE': 'Simulato', 'P1_REVISION': 3}
+VERSION = '0.7.1-sim'
+
+osservatori = []
+
+_lock = threading.Lock()
+_modo = None
+_direzione = {}
+_livello = {}
+_rilevamento = {}  # pin -> [fronte, callback, bouncetime_ms, ultimo_ms]
+_eventi = queue.Queue()
+_dispatcher = None
+
+
+def setmode(modo):
+    global _modo
+    _modo = modo
+
+
+def getmode():
+    return _modo
+
+
+def setwarnings(flag):
+    pass
+
+
+def setup(pin, direzione, pull_up_down=PUD_OFF, initial=None):
+    if _modo is None:
+        raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) "
+                           "or GPIO.setmode(GPIO.BCM)")
+    with _lock:
+        _direzione[pin] = direzione
+        if direzione == OUT:
+            _livello[pin] = initial if initial is not None else LOW
+        else:
+            _livello.setdefault(pin, HIGH if pull_up_down == PUD_UP else LOW)
+
+
+def output(pin, valore):
+    with _lock:
+        if _direzione.get(pin) != OUT:
+            raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+        _livello[pin] = HIGH if valore else LOW
+    t = time.monotonic()
+    for osservatore in list(osservatori):
+        osservatore(pin, HIGH if valore else LOW, t)
+
+
+def input(pin):
+    with _lock:
+        if pin not in _direzione:
+            raise RuntimeError("You must setup() the GPIO channel first")
+        return _livello.get(pin, LOW)
+
+
+def add_event_detect(pin, fronte, callback=None, bouncetime=None):
+    global _dispatcher
+    with _lock:
+        if _direzione.get(pin) != IN:
+            raise RuntimeError("You must setup() the GPIO channel as an input first")
+        if pin in _rilevamento:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        _rilevamento[pin] = [fronte, callback, bouncetime or 0, None]
+        if _dispatcher is None:
+            _dispatcher = threading.Thread(target=_dispatch, name='gpio-sim', daemon=True)
+            _dispatcher.start()
+
+
+def remove_event_detect(pin):
+    with _lock:
+        _rilevamento.pop(pin, None)
+
+
+def add_event_callback(pin, callback):
+    with _lock:
+        _rilevamento[pin][1] = callback
+
+
+def cleanup(pin=None):
+    global _modo
+    with _lock:
+        pins = [pin] if pin is not None else list(_direzione)
+        for p in pins:
+            _direzione.pop(p, None)
+            _livello.pop(p, None)
+            _rilevamento.pop(p, None)
+        if pin is None:
+            _modo = None
+
+
+def _dispatch():
+    while True:
+        pin, fronte = _eventi.get()
+        with _lock:
+            rilevamento = _rilevamento.get(pin)
+            if rilevamento is None or rilevamento[0] not in (fronte, BOTH):
+                continue
+            _, callback, bouncetime, ultimo = rilevamento
+            ora = time.monotonic() * 1000
+            if ultimo is not None and ora - ultimo < bouncetime:
+                continue
+            rilevamento[3] = ora
+        if callback:
+            callback(pin)
+
+
+# ------------------------------------------------------------
+# Simulazione
+# ------------------------------------------------------------
+
+def imposta_ingresso(pin, valore):
+    """Forza il livello di un ingresso generando l'eventuale fronte."""
+    valore = HIGH if valore else LOW
+    with _lock:
+        precedente = _livello.get(pin, LOW)
+        _livello[pin] = valore
+    if precedente != valore:
+        _eventi.put((pin, RISING if valore == HIGH else FALLING))
+
+
+def simula_fronte(pin, durata=0.0):
+    """Impulso LOW -> HIGH -> LOW; ritorna l'istante del fronte di salita."""
+    imposta_ingresso(pin, LOW)
+    t = time.monotonic()
+    imposta_ingresso(pin, HIGH)
+    if durata:
+        time.sleep(durata)
+    imposta_ingresso(pin, LOW)
+    return t
@@ -0,0 +1,6 @@
+"""
+RPi simulato per eseguire il citofono senza Raspberry Pi.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
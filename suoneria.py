@@ -0,0 +1,120 @@
+"""
+Riconoscimento della suoneria dai fronti di salita dell'ingresso.
+
+Il segnale di suoneria del Terraneo, attraverso l'optoisolatore, e' un
+treno di impulsi: un disturbo isolato produce invece uno o due fronti.
+ClassificatoreSuoneria tiene i fronti recenti in una finestra scorrevole
+e riconosce la suoneria appena il treno raggiunge il numero di fronti
+configurato, senza attese fisse:
+
+- fronti piu' vicini di intervallo_min sono rimbalzi e non contano;
+- una pausa piu' lunga di intervallo_max interrompe il treno, che se
+  incompleto viene scartato come disturbo;
+- contano solo i fronti degli ultimi `finestra` secondi;
+- dopo una suoneria riconosciuta i fronti sono ignorati finche' l'ingresso
+  non resta fermo per `pausa` secondi (il resto dello stesso squillo).
+
+Con fronti=1 ogni fronte dopo la pausa e' una suoneria, come il vecchio
+debounce. Un treno fermo da piu' di intervallo_max si scarta anche senza
+attendere il fronte successivo, chiamando verifica() allo scadere di
+scadenza(): serve a chi ha gia' agito sul primo fronte (chiamata
+speculativa) e deve saperlo annullare subito.
+
+Le tracce dei fronti si registrano e si riproducono con traccia_suoneria.py;
+leggi_traccia() e scrivi_traccia() ne gestiscono il formato: una riga per
+fronte con l'istante in ns dall'inizio della registrazione, righe '#' di
+commento.
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+from collections import deque
+
+
+class ClassificatoreSuoneria:
+    """Riconosce la suoneria in una sequenza di istanti di fronte (ns).
+
+    Gli intervalli si passano in secondi; intervallo_max None = finestra.
+    """
+
+    def __init__(self, fronti=1, finestra=1.0, intervallo_min=0.0, intervallo_max=None,
+                 pausa=0.3):
+        if fronti < 1:
+            raise ValueError("servono almeno un fronte")
+        self.fronti = fronti
+        self.finestra = int(finestra * 1e9)
+        self.intervallo_min = int(intervallo_min * 1e9)
+        self.intervallo_max = int((finestra if intervallo_max is None else intervallo_max) * 1e9)
+        self.pausa = int(pausa * 1e9)
+        self.scartati = 0  # treni incompleti, contati al fronte successivo
+        self._treno = deque()
+        self._ultimo = None  # ultimo fronte visto, anche se ignorato
+        self._suonata = False
+
+    def fronte(self, t_ns):
+        """Elabora un fronte; ritorna l'istante del primo fronte della
+        suoneria appena riconosciuta, altrimenti None."""
+        ultimo, self._ultimo = self._ultimo, t_ns
+        if self._suonata:
+            if t_ns - ultimo <= self.pausa:
+                return None
+            self._suonata = False
+
+        treno = self._treno
+        if treno:
+            intervallo = t_ns - treno[-1]
+            if intervallo < self.intervallo_min:
+                return None
+            if intervallo > self.intervallo_max:
+                self.scartati += 1
+                treno.clear()
+        while treno and t_ns - treno[0] > self.finestra:
+            treno.popleft()
+        treno.append(t_ns)
+
+        if len(treno) < self.fronti:
+            return None
+        t_primo = treno[0]
+        treno.clear()
+        self._suonata = True
+        return t_primo
+
+    @property
+    def in_corso(self):
+        """True se un treno e' iniziato ma non ancora riconosciuto."""
+        return bool(self._treno)
+
+    def scadenza(self):
+        """Istante (ns) oltre il quale il treno in corso, senza altri
+        fronti, e' scartato; None senza treno."""
+        return self._treno[-1] + self.intervallo_max if self._treno else None
+
+    def verifica(self, t_ns):
+        """Scarta il treno in corso se all'istante t_ns e' scaduto;
+        ritorna True se l'ha scartato."""
+        if self._treno and t_ns > self._treno[-1] + self.intervallo_max:
+            self.scartati += 1
+            self._treno.clear()
+            return True
+        return False
+
+    def azzera(self):
+        self._treno.clear()
+        self._ultimo = None
+        self._suonata = False
+
+
+def leggi_traccia(percorso):
+    """Istanti dei fronti (ns) di una traccia registrata."""
+    with open(percorso) as f:
+        return [int(riga) for riga in (r.strip() for r in f) if riga and not riga.startswith('#')]
+
+
+def scrivi_traccia(percorso, istanti, intestazione=''):
+    """Scrive una traccia; gli istanti sono riportati al primo fronte."""
+    with open(percorso, 'w') as f:
+        for riga in intestazione.splitlines():
+            f.write(f"# {riga}\n")
+        t0 = istanti[0] if istanti else 0
+        for t_ns in istanti:
+            f.write(f"{t_ns - t0}\n")
@@ -0,0 +1,1047 @@
+#!/usr/bin/env python3
+"""
+Soak test end-to-end del citofono, senza Raspberry Pi ne' centralino.
+
+Esegue CitofonoVoIP cosi' com'e' con RPi.GPIO simulato (sim/RPi) e
+baresip finto (sim/baresip), poi ripete per migliaia di cicli
+suonerie, chiamate in ingresso, codici DTMF, riagganci e timeout.
+Alla fine riporta i percentili di latenza suoneria -> /dial e
+DTMF -> rele', e l'andamento di thread e RSS nel tempo.
+
+    python3 test_soak.py                     # 200 cicli, ctrl_tcp
+    python3 test_soak.py -n 5000 --controllo stdio
+
+Esce con codice 1 se qualche ciclo fallisce o se thread/RSS crescono
+oltre le soglie (--max-thread, --max-rss-kb).
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import argparse
+import asyncio
+import http.client
+import importlib.util
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import wave
+from array import array
+from collections import defaultdict
+
+import dtmf_audio
+
+QUI = os.path.dirname(os.path.abspath(__file__))
+SIM_DIR = os.path.join(QUI, 'sim')
+
+# Scenari e pesi relativi nel mix del soak
+SCENARI = (
+    ('suoneria', 6),   # suoneria, risposta, codice apertura, riaggancio remoto
+    ('ingresso', 2),   # chiamata in ingresso, risposta automatica, codice, riaggancio
+    ('timeout', 1),    # suoneria senza risposta, riaggancio per timeout
+    ('doppia', 1),     # suonerie prima della risposta (unite) e durante la chiamata (in coda)
+    ('parallelo', 1),  # suonerie su due postazioni, chiamate contemporanee (solo ctrl_tcp)
+    ('ventaglio', 1),  # piu' numeri in due ondate, vince la prima risposta (solo ctrl_tcp)
+    ('codici', 1),     # codici errati fino al blocco, anche dopo una pausa, riaggancio via DTMF
+    ('ricarica', 1),   # codice e pin di suoneria cambiati a caldo, poi una chiamata
+    ('disturbo', 1),   # fronti isolati sull'ingresso: nessuna chiamata
+    ('in_banda', 1),   # codice di apertura solo nell'audio della chiamata (con NumPy)
+    ('api', 1),        # apertura dall'API locale, evento sul flusso SSE, token
+    ('centralino', 1), # centralino principale muto o non registrato: chiamate dalla riserva
+)
+API_TOKEN = 'soak'
+CODICE_RIAGGANCIO = '*0'
+SOLO_CTRL_TCP = ('parallelo', 'ventaglio')
+# Postazioni aggiuntive con ctrl_tcp: 'cortile' per lo scenario parallelo,
+# 'scala' (due numeri, poi un terzo dopo INTERVALLO_ONDATE) per il ventaglio
+POSTAZIONI_EXTRA = {
+    'CORTILE': {'PIN_SUONERIA': '23', 'PIN_RELE': '24', 'NUMERO': '6401', 'CODICE': '92'},
+    'SCALA': {'PIN_SUONERIA': '5', 'PIN_RELE': '6', 'NUMERO': '6402,6403;6404',
+              'CODICE': '93', 'INTERVALLO_ONDATE': '0.3'},
+}
+# Suoneria simulata: treno di SUONERIA_FRONTI fronti a 20 ms (o la prima
+# suoneria di una traccia registrata con --traccia)
+SUONERIA = {'SUONERIA_FRONTI': '3', 'SUONERIA_FINESTRA_MS': '200',
+            'SUONERIA_INTERVALLO_MIN_MS': '5', 'SUONERIA_INTERVALLO_MAX_MS': '60'}
+# Con --crash-ogni N, ogni N cicli: crash di baresip e suoneria durante
+# il riavvio, che il supervisore deve richiamare appena registrato
+
+
+class ErroreCiclo(Exception):
+    pass
+
+
+class ControlloBaresip:
+    """Client del socket di controllo di sim/baresip."""
+
+    def __init__(self, percorso, timeout=10):
+        self.percorso = percorso
+        self.code = defaultdict(queue.Queue)
+        self._connetti(timeout)
+
+    def _connetti(self, timeout):
+        percorso = self.percorso
+        scadenza = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(percorso)
+                break
+            except OSError:
+                self.sock.close()
+                if time.monotonic() > scadenza:
+                    raise
+                time.sleep(0.02)
+        threading.Thread(target=self._leggi, args=(self.sock,), daemon=True).start()
+
+    def riconnetti(self, timeout=10):
+        """Si ricollega al socket di un nuovo processo baresip finto.
+
+        Subito dopo un crash il socket puo' essere ancora quello del
+        processo in uscita: la connessione e' valida solo quando arriva
+        la notifica 'avvio' del nuovo processo.
+        """
+        scadenza = time.monotonic() + timeout
+        self.sock.close()
+        while True:
+            self._connetti(max(0.1, scadenza - time.monotonic()))
+            try:
+                self.attendi('avvio', 0.5)
+                return
+            except ErroreCiclo:
+                self.sock.close()
+                if time.monotonic() > scadenza:
+                    raise
+
+    def _leggi(self, sock):
+        try:
+            with sock.makefile('r') as f:
+                for riga in f:
+                    parti = riga.split()
+                    if len(parti) >= 2:
+                        self.code[parti[0]].put((float(parti[1]), parti[2:]))
+        except OSError:
+            pass
+
+    def invia(self, comando):
+        self.sock.sendall(comando.encode() + b'\n')
+
+    def attendi(self, evento, timeout):
+        try:
+            return self.code[evento].get(timeout=timeout)
+        except queue.Empty:
+            raise ErroreCiclo(f"'{evento}' non ricevuto entro {timeout}s") from None
+
+    def svuota(self):
+        for q in self.code.values():
+            while not q.empty():
+                q.get_nowait()
+
+
+class CentralinoFinto:
+    """Risponde 200 OK alle SIP OPTIONS della sonda, finche' e' attivo."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.porta = self.sock.getsockname()[1]
+        self.attivo = True
+        threading.Thread(target=self._rispondi, daemon=True).start()
+
+    def _rispondi(self):
+        while True:
+            dati, mittente = self.sock.recvfrom(4096)
+            if not self.attivo or not dati.startswith(b'OPTIONS '):
+                continue
+            intestazioni = [riga for riga in dati.split(b'\r\n')
+                            if riga.split(b':', 1)[0] in (b'Via', b'From', b'To', b'Call-ID',
+                                                          b'CSeq')]
+            self.sock.sendto(b'\r\n'.join([b'SIP/2.0 200 OK'] + intestazioni)
+                             + b'\r\nContent-Length: 0\r\n\r\n', mittente)
+
+
+class ClienteAPI:
+    """Richieste all'API locale e lettura del flusso di eventi SSE."""
+
+    def __init__(self, porta, token):
+        self.porta = porta
+        self.token = token
+        self.eventi = queue.Queue()  # (istante di arrivo, evento)
+        self.ricevuti = []
+        self._risposta = None
+
+    def richiesta(self, metodo, percorso, token=True):
+        """Ritorna (codice HTTP, JSON)."""
+        connessione = http.client.HTTPConnection('127.0.0.1', self.porta, timeout=2)
+        try:
+            intestazioni = {'Authorization': f'Bearer {self.token}'} if token else {}
+            connessione.request(metodo, percorso, headers=intestazioni)
+            risposta = connessione.getresponse()
+            return risposta.status, json.loads(risposta.read())
+        finally:
+            connessione.close()
+
+    def ascolta(self):
+        connessione = http.client.HTTPConnection('127.0.0.1', self.porta, timeout=None)
+        connessione.request('GET', '/eventi/flusso',
+                            headers={'Authorization': f'Bearer {self.token}'})
+        self._risposta = connessione.getresponse()
+        if self._risposta.status != 200:
+            raise SystemExit(f"Flusso eventi dell'API: HTTP {self._risposta.status}")
+        threading.Thread(target=self._leggi, daemon=True).start()
+
+    def _leggi(self):
+        try:
+            for riga in self._risposta:
+                if riga.startswith(b'data: '):
+                    evento = json.loads(riga[6:])
+                    self.ricevuti.append(evento)
+                    self.eventi.put((time.monotonic(), evento))
+        except (OSError, ValueError):
+            pass
+
+    def attendi(self, tipo, timeout):
+        scadenza = time.monotonic() + timeout
+        while True:
+            try:
+                t, evento = self.eventi.get(timeout=max(0.0, scadenza - time.monotonic()))
+            except queue.Empty:
+                raise ErroreCiclo(f"evento '{tipo}' non arrivato sul flusso") from None
+            if evento['tipo'] == tipo:
+                return t, evento
+
+    def svuota(self):
+        while not self.eventi.empty():
+            self.eventi.get_nowait()
+
+
+def porta_libera():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for riga in f:
+            if riga.startswith('VmRSS:'):
+                return int(riga.split()[1])
+    return 0
+
+
+def fd_aperti():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def percentili(valori):
+    if not valori:
+        return "nessun campione"
+    v = sorted(valori)
+    p = lambda q: v[min(len(v) - 1, int(len(v) * q / 100))] * 1000
+    return (f"n={len(v)}  p50={p(50):.1f} ms  p90={p(90):.1f} ms  "
+            f"p99={p(99):.1f} ms  max={v[-1] * 1000:.1f} ms")
+
+
+def scrivi_annunci(cartella):
+    """Annunci brevi a 16 kHz stereo: il citofono li converte a 8 kHz mono."""
+    os.makedirs(cartella)
+    for indice, nome in enumerate(('attendere', 'porta_aperta', 'codice_errato', 'codici_bloccati')):
+        periodo = 20 + 4 * indice
+        campioni = array('h', (8000 if (i // 2) % periodo < periodo // 2 else -8000
+                               for i in range(2 * 2400)))
+        with wave.open(os.path.join(cartella, nome + '.wav'), 'wb') as f:
+            f.setnchannels(2)
+            f.setsampwidth(2)
+            f.setframerate(16000)
+            f.writeframes(campioni.tobytes())
+
+
+def prepara_ambiente(args, tmp, principale, riserva):
+    for percorso in (os.path.join(QUI, 'config.env'), '/etc/citofono-voip/config.env'):
+        if os.path.isfile(percorso):
+            print(f"ATTENZIONE: {percorso} sovrascrive le impostazioni del soak test")
+    os.environ.update({
+        'PATH': SIM_DIR + os.pathsep + os.environ.get('PATH', ''),
+        'SIP_PASSWORD': 'soak',
+        'SIP_DOMAIN': 'localhost',
+        'SIP_PORT': str(principale.porta),
+        'SIP_RISERVA': f'localhost:{riserva.porta}',
+        'SONDA_SIP': '0.1',
+        'SONDA_SIP_TIMEOUT': '0.2',
+        'BARESIP_DIR': os.path.join(tmp, 'baresip'),
+        'BARESIP_CONTROLLO': args.controllo,
+        'BARESIP_CTRL_PORT': str(porta_libera()),
+        'METRICHE_PORTA': str(porta_libera()),
+        'API_PORTA': str(porta_libera()),
+        'API_TOKEN': API_TOKEN,
+        'LOG_FILE': os.path.join(tmp, 'citofono-voip.log'),
+        'GIORNALE_FILE': os.path.join(tmp, 'giornale.db'),
+        'TRACCE_FILE': os.path.join(tmp, 'tracce.jsonl'),
+        'TRACCE_FORMATO': args.tracce,
+        'ANNUNCI_DIR': os.path.join(tmp, 'annunci'),
+        'DEBOUNCE_SUONERIA_MS': '50',
+        'RITARDO_POST_SUONERIA': '0',
+        'SUONERIA_SPECULATIVA': '1' if args.speculativa else '0',
+        **SUONERIA,
+        'DURATA_APERTURA': str(args.durata_apertura),
+        'TIMEOUT_CHIAMATA': str(args.timeout_chiamata),
+        'FAKE_BARESIP_CONTROLLO': os.path.join(tmp, 'controllo.sock'),
+        'FAKE_BARESIP_DTMF_GAP': '0.02',
+        'CODICI_DTMF': f'{CODICE_RIAGGANCIO}:riaggancia',
+        'DTMF_TIMEOUT_CIFRA': '0.5',
+        'DTMF_BLOCCO': '0.5',
+        'DTMF_AUDIO': '1' if dtmf_audio.disponibile() else '0',
+        # Registrazione lenta: la suoneria cade nella finestra di riavvio
+        'FAKE_BARESIP_RITARDO_REG': '1.0' if args.crash_ogni else '0.1',
+    })
+    if args.controllo == 'ctrl_tcp':
+        # In stdio gli eventi non hanno id: niente chiamate contemporanee
+        os.environ['POSTAZIONI'] = ','.join(['portone'] + [n.lower() for n in POSTAZIONI_EXTRA])
+        for nome, valori in POSTAZIONI_EXTRA.items():
+            os.environ.update({f'POSTAZIONE_{nome}_{k}': v for k, v in valori.items()})
+    scrivi_annunci(os.environ['ANNUNCI_DIR'])
+    sys.path.insert(0, SIM_DIR)
+
+
+def carica_citofono():
+    spec = importlib.util.spec_from_file_location(
+        'citofono_voip', os.path.join(QUI, 'citofono-voip.py'))
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+class Soak:
+
+    def __init__(self, args, citofono, gpio, principale):
+        self.args = args
+        self.citofono = citofono
+        self.gpio = gpio
+        self.principale = principale  # CentralinoFinto di SIP_DOMAIN
+        self.sistema = None
+        self.loop = None
+        self.controllo = None
+        self.api = None
+        self.rele = queue.Queue()  # (istante, pin) delle attivazioni dei rele'
+        self._t_rele = {}
+        self.latenze = defaultdict(list)
+        self.esiti = defaultdict(int)
+        self.errori = []
+        self.campioni = []
+        self.metriche_finali = None
+        self._t_fronte = {}  # pin -> ultimo fronte generato
+        self.treno = [i * 0.02 for i in range(int(SUONERIA['SUONERIA_FRONTI']))]
+
+    def _osserva_uscita(self, pin, valore, t):
+        if pin not in (p.pin_rele for p in self.citofono.CONFIG.POSTAZIONI):
+            return
+        if valore == self.gpio.HIGH:
+            self._t_rele[pin] = t
+            self.rele.put((t, pin))
+        elif pin in self._t_rele:
+            self.latenze['rele_attivo'].append(t - self._t_rele.pop(pin))
+
+    def _nel_loop(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _ricarica(self):
+        return self.sistema.ricarica()
+
+    def avvia(self):
+        self.gpio.osservatori.append(self._osserva_uscita)
+        # Il citofono gira sul proprio loop asyncio in un thread dedicato
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='citofono', daemon=True).start()
+        self.sistema = self.citofono.CitofonoVoIP()
+        t0 = time.monotonic()
+        if not self._nel_loop(self.sistema.avvia()):
+            raise SystemExit("Avvio CitofonoVoIP fallito")
+        print(f"Sistema avviato in {time.monotonic() - t0:.2f}s")
+        self.controllo = ControlloBaresip(os.environ['FAKE_BARESIP_CONTROLLO'])
+        self.api = ClienteAPI(self.citofono.CONFIG.API_PORTA, API_TOKEN)
+        self.api.ascolta()
+
+    def attendi_libero(self, timeout):
+        scadenza = time.monotonic() + timeout
+        while self.sistema.occupato:
+            if time.monotonic() > scadenza:
+                raise ErroreCiclo("chiamata ancora attiva a fine ciclo")
+            time.sleep(0.005)
+        # Un rele' ancora attivo verrebbe solo prolungato dal ciclo successivo
+        while self._t_rele:
+            if time.monotonic() > scadenza + self.args.durata_apertura:
+                raise ErroreCiclo("rele' ancora attivo a fine ciclo")
+            time.sleep(0.005)
+
+    def _svuota_rele(self):
+        while not self.rele.empty():
+            self.rele.get_nowait()
+
+    def usa_traccia(self, percorso):
+        """Suona con i fronti della prima suoneria riconosciuta nella traccia."""
+        import suoneria
+        c = self.citofono
+        classificatore = suoneria.ClassificatoreSuoneria(
+            c.SUONERIA_FRONTI, c.SUONERIA_FINESTRA_MS / 1000.0,
+            c.SUONERIA_INTERVALLO_MIN_MS / 1000.0, c.SUONERIA_INTERVALLO_MAX_MS / 1000.0,
+            c.DEBOUNCE_SUONERIA_MS / 1000.0)
+        istanti = suoneria.leggi_traccia(percorso)
+        for fine, t_ns in enumerate(istanti):
+            if classificatore.fronte(t_ns) is not None:
+                self.treno = [(t - istanti[0]) / 1e9 for t in istanti[:fine + 1]]
+                return
+        raise SystemExit(f"Nessuna suoneria riconosciuta nella traccia {percorso}")
+
+    def _suona(self, postazione=None, treno=None):
+        """Genera il treno di fronti; ritorna l'istante del primo."""
+        postazione = postazione or self.citofono.CONFIG.POSTAZIONI[0]
+        # Fronti entro DEBOUNCE_SUONERIA_MS dall'ultimo sono ancora lo squillo precedente
+        pausa = (self._t_fronte.get(postazione.pin_suoneria, 0) - time.monotonic()
+                 + self.citofono.CONFIG.DEBOUNCE_SUONERIA_MS / 1000.0)
+        if pausa > 0:
+            time.sleep(pausa + 0.005)
+        t0 = time.monotonic()
+        for offset in (self.treno if treno is None else treno):
+            ritardo = t0 + offset - time.monotonic()
+            if ritardo > 0:
+                time.sleep(ritardo)
+            self._t_fronte[postazione.pin_suoneria] = self.gpio.simula_fronte(postazione.pin_suoneria)
+        return t0
+
+    def _attendi_coda(self, lunghezza, timeout=1):
+        scadenza = time.monotonic() + timeout
+        while len(self.citofono.CODA) != lunghezza:
+            if time.monotonic() > scadenza:
+                raise ErroreCiclo(f"{len(self.citofono.CODA)} richieste in coda, attese {lunghezza}")
+            time.sleep(0.005)
+
+    def _toni(self, cifre, id_chiamata='', in_banda=False):
+        """Invia i toni e ritorna l'istante dell'ultimo."""
+        modo = 'audio' if in_banda else ''
+        self.controllo.invia(f"dtmf {cifre} {modo} {id_chiamata}".rstrip())
+        for _ in range(len(cifre) - 1):
+            self.controllo.attendi('dtmf', 2)
+        return self.controllo.attendi('dtmf', 2)[0]
+
+    def _nessuna_apertura(self, errore):
+        try:
+            self.rele.get(timeout=0.2)
+            raise ErroreCiclo(errore)
+        except queue.Empty:
+            pass
+
+    def _codice_apertura(self, postazione=None, id_chiamata='', in_banda=False):
+        postazione = postazione or self.citofono.CONFIG.POSTAZIONI[0]
+        t_dtmf = self._toni(postazione.codice, id_chiamata, in_banda)
+        try:
+            t_rele, pin = self.rele.get(timeout=2)
+        except queue.Empty:
+            raise ErroreCiclo("rele' non attivato dal codice DTMF") from None
+        if pin != postazione.pin_rele:
+            raise ErroreCiclo(f"codice di {postazione.nome} ha attivato il rele' GPIO{pin}")
+        self.latenze['dtmf_rele'].append(t_rele - t_dtmf)
+
+    def _verifica_annunci(self):
+        """Attesa al visitatore, poi conferma d'apertura nella chiamata e ritorno al microfono."""
+        _, (file,) = self.controllo.attendi('play', 1)
+        if file != 'attendere.wav':
+            raise ErroreCiclo(f"annuncio al visitatore {file}")
+        _, (sorgente,) = self.controllo.attendi('ausrc', 1)
+        if not (sorgente.startswith('aufile,') and sorgente.endswith('porta_aperta.wav')):
+            raise ErroreCiclo(f"sorgente audio dell'annuncio {sorgente}")
+        _, (sorgente,) = self.controllo.attendi('ausrc', 1)
+        if sorgente != f'alsa,{self.citofono.CONFIG.AUDIO_REC_DEVICE}':
+            raise ErroreCiclo(f"microfono non ripristinato: {sorgente}")
+
+    def ciclo(self, scenario):
+        attesa = 2 + self.citofono.CONFIG.RITARDO_POST_SUONERIA_SEC
+        self.controllo.svuota()
+        self._svuota_rele()
+
+        if scenario in ('suoneria', 'doppia'):
+            t_edge = self._suona()
+            t_dial, _ = self.controllo.attendi('dial', attesa)
+            self.latenze['suoneria_dial'].append(t_dial - t_edge)
+            if scenario == 'doppia':
+                # Il visitatore insiste mentre il telefono squilla: stessa visita
+                self._suona()
+                self._attendi_coda(1)
+            self.controllo.invia('answer')
+            if scenario == 'doppia':
+                self._attendi_coda(0)
+                # Un altro visitatore durante la conversazione: resta in coda
+                self._suona()
+                self._attendi_coda(1)
+            self._codice_apertura()
+            if scenario == 'suoneria':
+                self._verifica_annunci()
+            if scenario == 'doppia':
+                try:
+                    self.controllo.attendi('dial',
+                                           self.citofono.CONFIG.RITARDO_POST_SUONERIA_SEC + 0.2)
+                    raise ErroreCiclo("suoneria in coda servita durante la chiamata")
+                except ErroreCiclo as e:
+                    if 'durante' in str(e):
+                        raise
+            self.controllo.invia('hangup')
+            if scenario == 'doppia':
+                t_fine = time.monotonic()
+                t_dial, (_, id_chiamata) = self.controllo.attendi('dial', 1)
+                self.latenze['coda_dial'].append(t_dial - t_fine)
+                self.controllo.invia(f'hangup {id_chiamata}')
+                try:
+                    self.controllo.attendi('dial', 0.2)
+                    raise ErroreCiclo("suoneria unita richiamata dopo la risposta")
+                except ErroreCiclo as e:
+                    if 'unita' in str(e):
+                        raise
+
+        elif scenario == 'api':
+            # Apertura senza chiamata, come da un sistema domotico
+            self.api.svuota()
+            if self.api.richiesta('POST', '/apri', token=False)[0] != 401:
+                raise ErroreCiclo("API senza token non rifiutata")
+            t0 = time.monotonic()
+            codice, risposta = self.api.richiesta('POST', '/apri?rele=principale')
+            if codice != 200 or not risposta.get('aperto'):
+                raise ErroreCiclo(f"apertura dall'API: HTTP {codice} {risposta}")
+            try:
+                t_rele, pin = self.rele.get(timeout=1)
+            except queue.Empty:
+                raise ErroreCiclo("rele' non attivato dall'API") from None
+            if pin != self.citofono.CONFIG.POSTAZIONI[0].pin_rele:
+                raise ErroreCiclo(f"l'API ha attivato il rele' GPIO{pin}")
+            t_evento, evento = self.api.attendi('apertura', 1)
+            self.latenze['api_rele'].append(t_rele - t0)
+            self.latenze['rele_evento'].append(t_evento - t_rele)
+            codice, stato = self.api.richiesta('GET', '/stato')
+            if codice != 200 or not stato['postazioni'][0]['portone_aperto']:
+                raise ErroreCiclo(f"/stato non riporta il portone aperto: {stato}")
+
+        elif scenario == 'centralino':
+            principale, riserva = (a.aor for a in self.citofono.CENTRALINI.account)
+            riavvii = self.sistema.baresip.riavvii
+            # Il centralino principale smette di rispondere alla sonda
+            self.api.svuota()
+            self.principale.attivo = False
+            t0 = time.monotonic()
+            t_cambio, evento = self.api.attendi('centralino', 2)
+            if evento['aor'] != riserva:
+                raise ErroreCiclo(f"chiamate spostate su {evento['aor']}")
+            self.latenze['sonda_cambio'].append(t_cambio - t0)
+            self._suona()
+            _, (aor,) = self.controllo.attendi('uafind', attesa)
+            if aor != riserva:
+                raise ErroreCiclo(f"/uafind {aor} invece della riserva")
+            self.controllo.attendi('dial', 1)
+            self.controllo.invia('answer')
+            self._codice_apertura()
+            self.controllo.invia('hangup')
+            self.attendi_libero(2)
+            self.principale.attivo = True
+            if self.api.attendi('centralino', 2)[1]['aor'] != principale:
+                raise ErroreCiclo("chiamate non tornate al centralino principale")
+            # Registrazione persa solo sul principale: niente riavvio di Baresip
+            self.controllo.invia(f'reg 403 {principale}')
+            if self.api.attendi('centralino', 2)[1]['motivo'] != 'registrazione':
+                raise ErroreCiclo("cambio di centralino non dovuto alla registrazione")
+            self.controllo.invia(f'reg 200 {principale}')
+            self.api.attendi('centralino', 2)
+            self._suona()
+            _, (aor,) = self.controllo.attendi('uafind', attesa)
+            if aor != principale:
+                raise ErroreCiclo(f"/uafind {aor} invece del principale")
+            self.controllo.attendi('dial', 1)
+            self.controllo.invia('hangup')
+            if self.sistema.baresip.riavvii != riavvii:
+                raise ErroreCiclo("Baresip riavviato per un solo account non registrato")
+
+        elif scenario == 'in_banda':
+            # Nessun evento DTMF da baresip: il codice si trova solo nel dump
+            self._suona()
+            self.controllo.attendi('dial', attesa)
+            self.controllo.invia('answer')
+            self._codice_apertura(in_banda=True)
+            self.controllo.invia('hangup')
+
+        elif scenario == 'ingresso':
+            self.controllo.invia('incoming 101')
+            t0 = time.monotonic()
+            t_accept, _ = self.controllo.attendi('accept', attesa)
+            self.latenze['ingresso_accept'].append(t_accept - t0)
+            self._codice_apertura()
+            self.controllo.invia('hangup')
+
+        elif scenario == 'crash':
+            self.controllo.invia('crash')
+            t_crash, _ = self.controllo.attendi('crash', 2)
+            t_edge = self._suona()
+            self.controllo.riconnetti()
+            t_dial, _ = self.controllo.attendi(
+                'dial', self.citofono.CONFIG.TIMEOUT_AVVIO_BARESIP_SEC + attesa)
+            self.latenze['crash_dial'].append(t_dial - t_crash)
+            self.latenze['ripristino'].append(self.sistema.baresip.tempo_ripristino)
+            self.controllo.invia('answer')
+            self._codice_apertura()
+            self.controllo.invia('hangup')
+
+        elif scenario == 'parallelo':
+            # Due suonerie ravvicinate: due chiamate che non si bloccano
+            postazioni = self.citofono.CONFIG.POSTAZIONI[:2]
+            for postazione in postazioni:
+                self._suona(postazione)
+                time.sleep(0.01)
+            ids = {}
+            for _ in postazioni:
+                _, (numero, id_chiamata) = self.controllo.attendi('dial', attesa)
+                ids[numero] = id_chiamata
+            for postazione in reversed(postazioni):
+                self.controllo.invia(f"answer {ids[postazione.numero]}")
+            for postazione in reversed(postazioni):
+                self._codice_apertura(postazione, ids[postazione.numero])
+            for postazione in postazioni:
+                self.controllo.invia(f"hangup {ids[postazione.numero]}")
+
+        elif scenario == 'ventaglio':
+            scala = self.citofono.CONFIG.POSTAZIONI[2]
+            t_edge = self._suona(scala)
+            ids = {}
+            for _ in range(3):
+                t_dial, (numero, id_chiamata) = self.controllo.attendi('dial', attesa)
+                ids[numero] = id_chiamata
+                if len(ids) == 1:
+                    self.latenze['suoneria_dial'].append(t_dial - t_edge)
+            if sorted(ids) != ['6402', '6403', '6404']:
+                raise ErroreCiclo(f"numeri chiamati: {sorted(ids)}")
+            self.controllo.invia(f"answer {ids['6403']}")
+            chiuse = {self.controllo.attendi('hangup', 2)[1][0] for _ in range(2)}
+            if chiuse != {ids['6402'], ids['6404']}:
+                raise ErroreCiclo(f"gambe chiuse {chiuse}, attese {ids['6402']} e {ids['6404']}")
+            self._codice_apertura(scala, ids['6403'])
+            self.controllo.invia(f"hangup {ids['6403']}")
+
+        elif scenario == 'codici':
+            # Una cifra sola aprirebbe, o azzererebbe i tentativi errati, a ogni tono
+            codici = os.environ['CODICI_DTMF']
+            os.environ['CODICI_DTMF'] = codici + ',9:apri'
+            try:
+                if self._nel_loop(self._ricarica()):
+                    raise ErroreCiclo("accettato un codice DTMF di una cifra")
+            finally:
+                os.environ['CODICI_DTMF'] = codici
+            self._suona()
+            self.controllo.attendi('dial', attesa)
+            self.controllo.invia('answer')
+            config = self.citofono.CONFIG
+            codice = config.POSTAZIONI[0].codice
+            tentativi = config.DTMF_TENTATIVI_MAX
+            # Tentativi errati tranne uno, una cifra e una pausa: il primo
+            # tono del codice giusto chiude l'ultimo tentativo e blocca
+            prima = self.metriche()
+            self._toni('50' * (tentativi - 1) + '5')
+            time.sleep(config.DTMF_TIMEOUT_CIFRA_SEC + 0.2)
+            self._toni(codice)
+            self._nessuna_apertura("codice accettato dopo il tentativo che blocca")
+            dopo = self.metriche()
+            if dopo['citofono_dtmf_blocchi_total'] != prima['citofono_dtmf_blocchi_total'] + 1:
+                raise ErroreCiclo("la pausa dopo l'ultimo tentativo non ha bloccato i codici")
+            self.controllo.invia('hangup')
+            self.attendi_libero(2)
+            # Il tono che ha bloccato non deve restare come cifra del tentativo dopo
+            time.sleep(config.DTMF_BLOCCO_SEC)
+            self._suona()
+            self.controllo.attendi('dial', attesa)
+            self.controllo.invia('answer')
+            self._codice_apertura()
+            if self.metriche()['citofono_dtmf_errati_total'] != dopo['citofono_dtmf_errati_total']:
+                raise ErroreCiclo("tentativo errato contato dopo la fine del blocco")
+            # Tre tentativi errati: il codice giusto subito dopo e' ignorato
+            self._toni('50' * tentativi)
+            self._toni(codice)
+            self._nessuna_apertura("codice accettato durante il blocco")
+            time.sleep(config.DTMF_BLOCCO_SEC)
+            self._codice_apertura()
+            self._toni(CODICE_RIAGGANCIO)
+            self.controllo.attendi('hangup', 2)
+
+        elif scenario == 'ricarica':
+            # Portone alternato tra due codici e due pin di suoneria
+            vecchia = self.citofono.CONFIG.POSTAZIONI[0]
+            os.environ.update({
+                'DTMF_APRI_PORTONE': '94' if vecchia.codice == '91' else '91',
+                'PIN_SUONERIA': '16' if vecchia.pin_suoneria == 17 else '17',
+            })
+            if not self._nel_loop(self._ricarica()):
+                raise ErroreCiclo("configurazione ricaricata scartata")
+            postazione = self.citofono.CONFIG.POSTAZIONI[0]
+            self._suona(vecchia)
+            try:
+                self.controllo.attendi('dial', self.citofono.CONFIG.RITARDO_POST_SUONERIA_SEC + 0.2)
+                raise ErroreCiclo("suoneria sul pin rilasciato dopo la ricarica")
+            except ErroreCiclo as e:
+                if 'rilasciato' in str(e):
+                    raise
+            self._suona(postazione)
+            self.controllo.attendi('dial', attesa)
+            self.controllo.invia('answer')
+            self._toni(vecchia.codice)
+            self._nessuna_apertura("codice precedente accettato dopo la ricarica")
+            self._codice_apertura(postazione)
+            self.controllo.invia('hangup')
+
+        elif scenario == 'disturbo' and self.citofono.CONFIG.SUONERIA_SPECULATIVA:
+            # La chiamata partita al primo fronte va chiusa quando il treno scade
+            self._suona(treno=self.treno[:-1])
+            self.controllo.attendi('dial', attesa)
+            self.controllo.attendi('hangup', 1)
+            self.attendi_libero(1)
+            # Rifiutata (486) prima che il treno sia confermato: la conferma
+            # non deve richiamare. Fronti larghi, per chiudere prima dell'ultimo
+            config = self.citofono.CONFIG
+            confermate = self.metriche()['citofono_chiamate_speculative_confermate_total']
+            pin = config.POSTAZIONI[0].pin_suoneria
+            passo = 0.9 * config.SUONERIA_INTERVALLO_MAX_MS / 1000.0
+            t0 = self._suona(treno=[0])
+            self.controllo.attendi('dial', attesa)
+            self.controllo.invia('reject')
+            for i in range(1, len(self.treno)):
+                while self.sistema.occupato and time.monotonic() < t0 + i * passo:
+                    time.sleep(0.002)
+                time.sleep(max(t0 + i * passo - time.monotonic(), 0))
+                self._t_fronte[pin] = self.gpio.simula_fronte(pin)
+            try:
+                self.controllo.attendi('dial', 0.3)
+                raise ErroreCiclo("suoneria richiamata dopo la chiamata speculativa rifiutata")
+            except ErroreCiclo as e:
+                if 'rifiutata' in str(e):
+                    raise
+            if (self.metriche()['citofono_chiamate_speculative_confermate_total']
+                    != confermate + 1):
+                raise ErroreCiclo("suoneria dopo la chiamata speculativa rifiutata non confermata")
+
+        elif scenario == 'disturbo':
+            # Un treno troppo corto non e' una suoneria
+            self._suona(treno=self.treno[:-1])
+            try:
+                self.controllo.attendi('dial', 0.3)
+                raise ErroreCiclo("disturbo scambiato per suoneria")
+            except ErroreCiclo as e:
+                if 'disturbo' in str(e):
+                    raise
+            time.sleep(self.citofono.CONFIG.SUONERIA_INTERVALLO_MAX_MS / 1000.0)
+
+        elif scenario == 'timeout':
+            t_edge = self._suona()
+            t_dial, _ = self.controllo.attendi('dial', attesa)
+            self.latenze['suoneria_dial'].append(t_dial - t_edge)
+            t_hangup, _ = self.controllo.attendi('hangup', self.args.timeout_chiamata + 2)
+            self.latenze['timeout_effettivo'].append(t_hangup - t_dial)
+
+        self.attendi_libero(self.args.timeout_chiamata + 2)
+
+    def campiona(self, indice, t_inizio):
+        self.campioni.append((indice, time.monotonic() - t_inizio,
+                              threading.active_count(), rss_kb(), fd_aperti()))
+
+    def esegui(self):
+        sequenza = [nome for nome, peso in SCENARI for _ in range(peso)
+                    if (nome not in SOLO_CTRL_TCP or self.args.controllo == 'ctrl_tcp')
+                    and (nome != 'in_banda' or dtmf_audio.disponibile())]
+        t_inizio = time.monotonic()
+        # Un giro a vuoto per stabilizzare thread e allocazioni prima della base
+        self.ciclo('suoneria')
+        self.campiona(0, t_inizio)
+        for i in range(1, self.args.cicli + 1):
+            scenario = sequenza[i % len(sequenza)]
+            if self.args.crash_ogni and i % self.args.crash_ogni == 0:
+                scenario = 'crash'
+            try:
+                self.ciclo(scenario)
+                self.esiti[scenario] += 1
+            except ErroreCiclo as e:
+                self.errori.append((i, scenario, str(e)))
+                self.esiti[scenario + '_fallito'] += 1
+                try:
+                    self.controllo.invia('hangup')
+                    self.attendi_libero(self.args.timeout_chiamata + 2)
+                except ErroreCiclo:
+                    pass
+            if i % self.args.campione == 0 or i == self.args.cicli:
+                self.campiona(i, t_inizio)
+                if not self.args.silenzioso:
+                    _, t, thread, rss, fd = self.campioni[-1]
+                    print(f"  ciclo {i:6d}  {t:8.1f}s  thread={thread:3d}  "
+                          f"rss={rss:7d} kB  fd={fd:3d}  errori={len(self.errori)}")
+        # Lascia terminare i thread dell'ultimo ciclo prima del campione finale
+        time.sleep(self.citofono.CONFIG.RITARDO_POST_SUONERIA_SEC + 0.5)
+        self.campiona(self.args.cicli, t_inizio)
+        self.metriche_finali = self.metriche()
+
+    def termina(self):
+        if self.sistema and self.sistema.running:
+            self._nel_loop(self.sistema.termina())
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def metriche(self):
+        """Legge l'endpoint delle metriche; ritorna {nome: valore} senza i bucket."""
+        url = f"http://127.0.0.1:{self.citofono.CONFIG.METRICHE_PORTA}/metrics"
+        with urllib.request.urlopen(url, timeout=2) as risposta:
+            testo = risposta.read().decode()
+        valori = {}
+        for riga in testo.splitlines():
+            if riga and not riga.startswith('#') and '_bucket' not in riga:
+                nome, valore = riga.rsplit(' ', 1)
+                valori[nome] = float(valore)
+        return valori
+
+    def verifica_giornale(self):
+        """Confronta il giornale (scritto a fine arresto) con le metriche."""
+        if not self.metriche_finali:
+            return True
+        giornale = self.citofono.giornale
+        db = giornale.apri_lettura(self.citofono.CONFIG.GIORNALE_FILE)
+        try:
+            tipi = dict(db.execute("SELECT tipo, COUNT(*) FROM eventi GROUP BY tipo"))
+            suonerie = len(giornale.eventi(db, tipo=giornale.SUONERIA))
+            aperture = sum(1 for e in giornale.eventi(db, tipo=giornale.APERTURA)
+                           if e[5] != 'prolungata')
+            riepilogo = giornale.per_giorno(db)
+        finally:
+            db.close()
+        self.chiamate_giornale = tipi.get(giornale.CHIAMATA, 0) + tipi.get(giornale.INGRESSO, 0)
+        print("Giornale:", dict(sorted(tipi.items())))
+        for giorno in riepilogo:
+            print(f"  {giorno['giorno']}: {giorno['chiamate']} chiamate, "
+                  f"risposta {giorno['tasso_risposta'] or 0:.0%}, "
+                  f"mediana suoneria -> risposta {giorno['mediana_risposta'] or 0:.2f}s")
+        ok = True
+        for nome, registrati in (('citofono_suonerie_total', suonerie),
+                                 ('citofono_aperture_portone_total', aperture),
+                                 ('citofono_cambi_centralino_total',
+                                  tipi.get(giornale.CENTRALINO, 0))):
+            if registrati != self.metriche_finali.get(nome, 0):
+                ok = False
+                print(f"ERRORE: giornale {registrati} eventi, {nome} {self.metriche_finali[nome]:g}")
+        return ok
+
+    def leggi_tracce(self):
+        """Tracce scritte dal citofono come record json: [{id, esito, fasi}]."""
+        tracce = []
+        with open(self.citofono.CONFIG.TRACCE_FILE, encoding='utf-8') as f:
+            for riga in f:
+                voce = json.loads(riga)
+                if self.args.tracce == 'json':
+                    tracce.append(voce)
+                    continue
+                # OTLP: uno span per riga, un evento per fase
+                span = voce['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+                attributi = {a['key']: a['value']['stringValue'] for a in span['attributes']}
+                t0 = int(span['startTimeUnixNano'])
+                tracce.append({'id': span['spanId'], 'esito': attributi.get('citofono.esito'),
+                               'direzione': attributi['citofono.direzione'],
+                               'fasi': [{'fase': e['name'],
+                                         'ms': (int(e['timeUnixNano']) - t0) / 1e6}
+                                        for e in span['events']]})
+        return tracce
+
+    def verifica_tracce(self):
+        """Una traccia per chiamata del giornale, fasi complete e id nel log."""
+        if not self.metriche_finali:
+            return True
+        tracce = self.leggi_tracce()
+        ok = True
+        if len(tracce) != self.chiamate_giornale:
+            ok = False
+            print(f"ERRORE: {len(tracce)} tracce, {self.chiamate_giornale} chiamate nel giornale")
+        attese = {'chiamata': ('fronte', 'dial', 'risposta', 'fine'),
+                  'ingresso': ('ingresso', 'risposta', 'fine')}
+        if self.args.controllo == 'ctrl_tcp':
+            attese['chiamata'] += ('squillo',)
+        fasi = defaultdict(list)
+        incomplete = 0
+        for traccia in tracce:
+            nomi = {f['fase'] for f in traccia['fasi']}
+            if traccia['esito'] == 'risposta' and not set(attese[traccia['direzione']]) <= nomi:
+                incomplete += 1
+            if sum(f['fase'] == 'rele_on' for f in traccia['fasi']) and 'rele_off' not in nomi:
+                incomplete += 1
+            if traccia['direzione'] == 'chiamata' and traccia['esito'] == 'risposta':
+                # Primo istante di ogni fase, in ms dal fronte della suoneria
+                primi = {}
+                for fase in traccia['fasi']:
+                    primi.setdefault(fase['fase'], fase['ms'])
+                for nome, ms in primi.items():
+                    fasi[nome].append(ms)
+        if incomplete:
+            ok = False
+            print(f"ERRORE: {incomplete} tracce senza tutte le fasi attese")
+        with open(self.citofono.CONFIG.LOG_FILE, encoding='utf-8') as f:
+            log = f.read()
+        mancanti = sum(1 for t in tracce if t['id'] not in log)
+        if mancanti:
+            ok = False
+            print(f"ERRORE: {mancanti} id di traccia assenti dal log")
+        print(f"Tracce ({self.args.tracce}): {len(tracce)}; fasi delle chiamate con risposta, "
+              "ms dal fronte (p50):")
+        mediane = sorted((sorted(valori)[len(valori) // 2], nome) for nome, valori in fasi.items())
+        print("  " + "  ".join(f"{nome} {ms:.1f}" for ms, nome in mediane))
+        return ok
+
+    def verifica_eventi(self):
+        """Confronta gli eventi ricevuti sul flusso SSE con le metriche."""
+        if not self.metriche_finali:
+            return True
+        ricevuti = self.api.ricevuti
+        tipi = defaultdict(int)
+        for evento in ricevuti:
+            tipi[evento['tipo']] += 1
+        print("Flusso eventi API:", dict(sorted(tipi.items())))
+        ok = True
+        aperture = sum(1 for e in ricevuti if e['tipo'] == 'apertura' and not e['prolungata'])
+        if aperture != self.metriche_finali.get('citofono_aperture_portone_total', 0):
+            ok = False
+            print(f"ERRORE: {aperture} eventi apertura sul flusso, "
+                  f"{self.metriche_finali['citofono_aperture_portone_total']:g} nelle metriche")
+        ids = [e['id'] for e in ricevuti]
+        if ids != sorted(set(ids)):
+            ok = False
+            print("ERRORE: eventi del flusso duplicati o fuori ordine")
+        return ok
+
+    def verifica_dump(self):
+        """A soak finito non devono restare dump audio su tmpfs."""
+        cartella = self.citofono.annunci.cartella_tmpfs('audio')
+        rimasti = os.listdir(cartella) if os.path.isdir(cartella) else []
+        if rimasti:
+            print(f"ERRORE: {len(rimasti)} dump audio rimasti in {cartella}")
+            return False
+        return True
+
+    def rapporto(self):
+        print()
+        print("=" * 60)
+        print("RISULTATI SOAK")
+        print("=" * 60)
+        print("Esiti:", dict(sorted(self.esiti.items())))
+        print()
+        print("Suoneria -> /dial:       ", percentili(self.latenze['suoneria_dial']))
+        print("Ingresso -> /accept:     ", percentili(self.latenze['ingresso_accept']))
+        print("Riaggancio -> /dial coda:", percentili(self.latenze['coda_dial']))
+        print("DTMF -> rele':           ", percentili(self.latenze['dtmf_rele']))
+        print("API -> rele':            ", percentili(self.latenze['api_rele']))
+        print("Rele' -> evento SSE:     ", percentili(self.latenze['rele_evento']))
+        print("Sonda muta -> riserva:   ", percentili(self.latenze['sonda_cambio']))
+        print("Rele' attivo:            ", percentili(self.latenze['rele_attivo']),
+              f"(atteso {self.args.durata_apertura * 1000:.0f} ms)")
+        print("Timeout effettivo:       ", percentili(self.latenze['timeout_effettivo']))
+        if self.latenze['ripristino']:
+            print("Ripristino baresip:      ", percentili(self.latenze['ripristino']))
+            print("Crash -> /dial richiamato:", percentili(self.latenze['crash_dial']))
+        if self.metriche_finali:
+            print()
+            print("Metriche:")
+            for nome, valore in sorted(self.metriche_finali.items()):
+                print(f"  {nome:45s} {valore:g}")
+        print()
+        print(f"{'ciclo':>7} {'tempo':>9} {'thread':>7} {'rss kB':>9} {'fd':>5}")
+        for indice, t, thread, rss, fd in self.campioni:
+            print(f"{indice:7d} {t:8.1f}s {thread:7d} {rss:9d} {fd:5d}")
+
+        ok = True
+        if self.errori:
+            ok = False
+            print()
+            print(f"{len(self.errori)} cicli falliti (primi 10):")
+            for i, scenario, errore in self.errori[:10]:
+                print(f"  ciclo {i} [{scenario}]: {errore}")
+        base, fine = self.campioni[0], self.campioni[-1]
+        delta_thread = fine[2] - base[2]
+        delta_rss = fine[3] - base[3]
+        delta_fd = fine[4] - base[4]
+        print()
+        print(f"Variazione thread: {delta_thread:+d}  RSS: {delta_rss:+d} kB  fd: {delta_fd:+d}")
+        if not self.verifica_giornale():
+            ok = False
+        if not self.verifica_tracce():
+            ok = False
+        if not self.verifica_eventi():
+            ok = False
+        if not self.verifica_dump():
+            ok = False
+        if delta_thread > self.args.max_thread:
+            ok = False
+            print(f"ERRORE: thread cresciuti oltre la soglia ({self.args.max_thread})")
+        if delta_rss > self.args.max_rss_kb:
+            ok = False
+            print(f"ERRORE: RSS cresciuta oltre la soglia ({self.args.max_rss_kb} kB)")
+        if delta_fd > self.args.max_thread:
+            ok = False
+            print(f"ERRORE: file descriptor aperti in crescita ({delta_fd:+d})")
+        print("ESITO:", "OK" if ok else "FALLITO")
+        return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-n', '--cicli', type=int, default=200, help="numero di cicli (default 200)")
+    parser.add_argument('--controllo', choices=('ctrl_tcp', 'stdio'), default='ctrl_tcp',
+                        help="modalita' di controllo di baresip")
+    parser.add_argument('--timeout-chiamata', type=int, default=1,
+                        help="TIMEOUT_CHIAMATA usato nello scenario timeout (secondi)")
+    parser.add_argument('--durata-apertura', type=float, default=0.2,
+                        help="DURATA_APERTURA del rele' (secondi, default 0.2)")
+    parser.add_argument('--campione', type=int, default=50,
+                        help="cicli tra due campioni di thread/RSS")
+    parser.add_argument('--max-thread', type=int, default=2,
+                        help="crescita massima ammessa di thread e fd")
+    parser.add_argument('--max-rss-kb', type=int, default=4096,
+                        help="crescita massima ammessa della RSS (kB)")
+    parser.add_argument('--traccia', help="suona con una traccia di traccia_suoneria.py")
+    parser.add_argument('--speculativa', action='store_true',
+                        help="SUONERIA_SPECULATIVA=1: chiama al primo fronte")
+    parser.add_argument('--tracce', choices=('json', 'otlp'), default='json',
+                        help="TRACCE_FORMATO del file delle tracce")
+    parser.add_argument('--crash-ogni', type=int, default=0,
+                        help="ogni N cicli fa terminare baresip e suona durante il riavvio")
+    parser.add_argument('-v', '--verbose', action='store_true', help="mostra il log del citofono")
+    parser.add_argument('-q', '--silenzioso', action='store_true', help="nessun avanzamento")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='citofono-soak-') as tmp:
+        principale, riserva = CentralinoFinto(), CentralinoFinto()
+        prepara_ambiente(args, tmp, principale, riserva)
+        citofono = carica_citofono()
+        # Annunci decodificati nella cartella del soak invece che in /run
+        citofono.annunci.cartella_tmpfs = lambda nome='annunci': os.path.join(tmp, 'ram', nome)
+        import RPi.GPIO as GPIO
+
+        if not args.verbose:
+            # La console e' uno degli handler del thread di scrittura del log
+            scrittore = citofono.scrittore_log
+            scrittore.handlers = [h for h in scrittore.handlers
+                                  if type(h) is not logging.StreamHandler]
+
+        soak = Soak(args, citofono, GPIO, principale)
+        if args.traccia:
+            soak.usa_traccia(args.traccia)
+        try:
+            soak.avvia()
+            print(f"Soak: {args.cicli} cicli, controllo {args.controllo}, log in {os.environ['LOG_FILE']}")
+            soak.esegui()
+        except KeyboardInterrupt:
+            print("\nInterrotto")
+        finally:
+            soak.termina()
+        ok = soak.rapporto()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Tracce delle chiamate: un id per chiamata e l'istante di ogni sua fase.
+
+Ogni chiamata di una postazione riceve un id al fronte della suoneria o
+all'arrivo della chiamata in ingresso. L'id e' il valore di CHIAMATA,
+una variabile di contesto: le callback del loop e i task creati durante
+la chiamata la ereditano, e FiltroChiamata la copia in ogni record di
+log, cosi' le righe di suoneria, Baresip e rele' di una stessa chiamata
+si ritrovano con un grep.
+
+Le fasi sono istanti time.monotonic_ns(), lo stesso orologio dei fronti
+GPIO:
+
+    fronte      primo fronte della suoneria
+    suoneria    suoneria riconosciuta dal classificatore
+    coda        suoneria servita dalla coda (vedi coda_chiamate.py)
+    ingresso    chiamata in ingresso ricevuta
+    dial        /dial inviato a Baresip (numero)
+    dial_ok     /dial confermato da Baresip (numero)
+    squillo     il telefono chiamato squilla, 180/183 (numero)
+    risposta    chiamata stabilita (numero)
+    dtmf        tono DTMF ricevuto (origine: sip o banda; la cifra no)
+    rele_on     rele' attivato o prolungato (rele)
+    rele_off    rele' rilasciato (rele)
+    fine        chiamata chiusa (esito)
+
+A fine chiamata la traccia diventa una riga del file delle tracce,
+scritta da un thread dedicato come il giornale. Se il rele' aperto
+durante la chiamata e' ancora attivo, la riga attende che si chiuda.
+Formati:
+
+    json   un oggetto per chiamata: id, postazione, direzione, esito,
+           inizio (epoch), durata_ms e fasi, ognuna con i ms dalla prima
+    otlp   una ExportTraceServiceRequest OTLP/JSON per chiamata: uno span
+           con un evento per fase, leggibile dal ricevitore otlpjsonfile
+           dell'OpenTelemetry Collector
+
+Oltre la dimensione massima il file viene rinominato in .1 (uno solo).
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import secrets
+import time
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+JSON = 'json'
+OTLP = 'otlp'
+FORMATI = (JSON, OTLP)
+
+FRONTE = 'fronte'
+SUONERIA = 'suoneria'
+CODA = 'coda'
+INGRESSO = 'ingresso'
+DIAL = 'dial'
+DIAL_OK = 'dial_ok'
+SQUILLO = 'squillo'
+RISPOSTA = 'risposta'
+DTMF = 'dtmf'
+RELE_ON = 'rele_on'
+RELE_OFF = 'rele_off'
+FINE = 'fine'
+
+# Numero massimo di tracce scritte per lotto
+LOTTO_MAX = 64
+
+SERVIZIO = 'citofono-voip'
+
+# Id della chiamata a cui appartiene il codice in esecuzione (None fuori
+# da una chiamata)
+CHIAMATA = contextvars.ContextVar('chiamata', default=None)
+
+
+class FiltroChiamata(logging.Filter):
+    """Aggiunge a ogni record l'attributo chiamata (id o None).
+
+    Va installato sull'handler che mette i record in coda: gira nel
+    thread e nel contesto di chi registra.
+    """
+
+    def filter(self, record):
+        record.chiamata = CHIAMATA.get()
+        return True
+
+
+class Traccia:
+    """Fasi di una chiamata; id: 16 cifre esadecimali."""
+
+    def __init__(self, postazione, direzione):
+        self.id = secrets.token_hex(8)
+        self.postazione = postazione
+        self.direzione = direzione
+        self.fasi = []  # (fase, t_ns, attributi)
+        self.esito = None
+        self.chiusa = False
+        # Per riportare gli istanti monotoni all'ora di sistema
+        self._scarto_ns = time.time_ns() - time.monotonic_ns()
+
+    def fase(self, nome, t_ns=None, **attributi):
+        """Registra una fase, ora o all'istante t_ns (monotonic_ns)."""
+        if t_ns is None:
+            t_ns = time.monotonic_ns()
+        self.fasi.append((nome, t_ns, attributi))
+
+    def chiudi(self, esito):
+        self.fase(FINE, esito=esito)
+        self.esito = esito
+        self.chiusa = True
+
+    def record(self):
+        """Record JSON della traccia."""
+        fasi = sorted(self.fasi, key=lambda f: f[1])
+        t0 = fasi[0][1] if fasi else 0
+        return {
+            'id': self.id,
+            'postazione': self.postazione,
+            'direzione': self.direzione,
+            'esito': self.esito,
+            'inizio': round((t0 + self._scarto_ns) / 1e9, 3),
+            'durata_ms': round((fasi[-1][1] - t0) / 1e6, 1) if fasi else 0,
+            'fasi': [{'fase': nome, 'ms': round((t_ns - t0) / 1e6, 1), **attributi}
+                     for nome, t_ns, attributi in fasi],
+        }
+
+    def otlp(self):
+        """ExportTraceServiceRequest OTLP/JSON con uno span per la chiamata."""
+        fasi = sorted(self.fasi, key=lambda f: f[1])
+        unix = [str(t_ns + self._scarto_ns) for _, t_ns, _ in fasi] or ['0']
+        span = {
+            'traceId': self.id.rjust(32, '0'),
+            'spanId': self.id,
+            'name': f'chiamata {self.postazione}',
+            'kind': 2,  # SPAN_KIND_SERVER
+            'startTimeUnixNano': unix[0],
+            'endTimeUnixNano': unix[-1],
+            'attributes': _attributi({'citofono.postazione': self.postazione,
+                                      'citofono.direzione': self.direzione,
+                                      'citofono.esito': self.esito}),
+            'events': [{'timeUnixNano': t, 'name': nome, 'attributes': _attributi(attributi)}
+                       for t, (nome, _, attributi) in zip(unix, fasi)],
+        }
+        return {'resourceSpans': [{
+            'resource': {'attributes': _attributi({'service.name': SERVIZIO})},
+            'scopeSpans': [{'scope': {'name': SERVIZIO}, 'spans': [span]}],
+        }]}
+
+
+def _attributi(valori):
+    """Attributi OTLP/JSON; i valori None sono omessi."""
+    attributi = []
+    for chiave, valore in valori.items():
+        if valore is None:
+            continue
+        if isinstance(valore, bool):
+            tipizzato = {'boolValue': valore}
+        elif isinstance(valore, int):
+            tipizzato = {'intValue': str(valore)}
+        elif isinstance(valore, float):
+            tipizzato = {'doubleValue': valore}
+        else:
+            tipizzato = {'stringValue': str(valore)}
+        attributi.append({'key': chiave, 'value': tipizzato})
+    return attributi
+
+
+class ScrittoreTracce:
+    """Coda delle tracce chiuse e thread che le scrive nel file.
+
+    Con percorso vuoto le tracce non vengono scritte e registra() non fa
+    nulla. max_mb: dimensione oltre la quale il file ruota (0 = nessun
+    limite).
+    """
+
+    def __init__(self, percorso, formato=JSON, max_mb=0):
+        self.percorso = percorso
+        self.formato = formato
+        self.max_byte = int(max_mb * 1024 * 1024)
+        self.coda = queue.SimpleQueue()
+        self.attivo = False
+        self._file = None
+        self._thread = None
+
+    def avvia(self):
+        """Apre il file e avvia il thread di scrittura."""
+        if not self.percorso:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.percorso) or '.', exist_ok=True)
+            self._file = open(self.percorso, 'a', encoding='utf-8')
+        except OSError as e:
+            logger.error("File delle tracce %s non disponibile: %s", self.percorso, e)
+            return
+        self.attivo = True
+        self._thread = Thread(target=self._scrivi, name='tracce', daemon=True)
+        self._thread.start()
+        logger.info("Tracce delle chiamate: %s (%s)", self.percorso, self.formato)
+
+    def registra(self, traccia):
+        """Mette in coda una traccia chiusa; non attende mai il file."""
+        if self.attivo:
+            self.coda.put(traccia)
+
+    def _scrivi(self):
+        while True:
+            lotto = [self.coda.get()]
+            try:
+                while len(lotto) < LOTTO_MAX:
+                    lotto.append(self.coda.get_nowait())
+            except queue.Empty:
+                pass
+            tracce = [t for t in lotto if t is not None]
+            try:
+                for traccia in tracce:
+                    voce = traccia.otlp() if self.formato == OTLP else traccia.record()
+                    self._file.write(json.dumps(voce, ensure_ascii=False) + '\n')
+                self._file.flush()
+                if self.max_byte and self._file.tell() > self.max_byte:
+                    self._ruota()
+            except OSError as e:
+                logger.error("Scrittura delle tracce fallita, %d tracce perse: %s",
+                             len(tracce), e)
+            if None in lotto:
+                return
+
+    def _ruota(self):
+        os.replace(self.percorso, self.percorso + '.1')
+        self._file.close()
+        self._file = open(self.percorso, 'a', encoding='utf-8')
+
+    def ferma(self):
+        """Scrive le tracce ancora in coda e chiude il file."""
+        if not self.attivo:
+            return
+        self.attivo = False
+        self.coda.put(None)
+        self._thread.join(timeout=5)
+        self._file.close()
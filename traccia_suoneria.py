@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Registra e riproduce tracce dei fronti della suoneria.
+
+    sudo python3 traccia_suoneria.py registra squillo.txt --durata 30
+    python3 traccia_suoneria.py riproduci squillo.txt
+    python3 traccia_suoneria.py riproduci squillo.txt --fronti 4 --intervallo-max 80
+
+La registrazione salva ogni fronte di salita dell'ingresso della
+suoneria, senza debounce (fermare prima il servizio: il pin deve essere
+libero). La riproduzione passa la traccia al classificatore con le
+impostazioni di config.env, o con quelle indicate, e riporta le
+suonerie riconosciute, il tempo di decisione e i treni scartati: serve a
+scegliere SUONERIA_FRONTI e gli intervalli sul segnale reale.
+Le tracce si riproducono anche nel soak test (test_soak.py --traccia).
+
+Copyright (C) 2025 Simone
+License: GPL-2.0-or-later (vedi LICENSE)
+"""
+import argparse
+import sys
+import threading
+import time
+
+import configurazione
+import suoneria
+
+
+def registra(args, config):
+    import gpio_backend
+    pin = args.pin or config.POSTAZIONI[0].pin_suoneria
+    gpio = gpio_backend.crea_backend(config.GPIO_BACKEND, config.GPIO_CHIP)
+    istanti = []
+    lock = threading.Lock()
+
+    def on_fronte(t_ns):
+        with lock:
+            istanti.append(t_ns)
+
+    gpio.setup_ingresso(pin, pull_up=True)
+    gpio.osserva_fronti(pin, on_fronte, 0)
+    print(f"Registro i fronti di GPIO{pin} per {args.durata:g}s - Ctrl+C per fermare")
+    try:
+        time.sleep(args.durata)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gpio.cleanup()
+    with lock:
+        istanti = sorted(istanti)
+    suoneria.scrivi_traccia(args.traccia, istanti, (
+        f"GPIO{pin}, backend {gpio.nome}, {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+        f"{len(istanti)} fronti"))
+    print(f"{len(istanti)} fronti scritti in {args.traccia}")
+
+
+def riproduci(args, config):
+    def valore(opzione, default):
+        return default if opzione is None else opzione
+
+    classificatore = suoneria.ClassificatoreSuoneria(
+        fronti=valore(args.fronti, config.SUONERIA_FRONTI),
+        finestra=valore(args.finestra, config.SUONERIA_FINESTRA_MS) / 1000.0,
+        intervallo_min=valore(args.intervallo_min, config.SUONERIA_INTERVALLO_MIN_MS) / 1000.0,
+        intervallo_max=valore(args.intervallo_max, config.SUONERIA_INTERVALLO_MAX_MS) / 1000.0,
+        pausa=valore(args.pausa, config.DEBOUNCE_SUONERIA_MS) / 1000.0,
+    )
+    istanti = suoneria.leggi_traccia(args.traccia)
+    decisioni = []
+    for t_ns in istanti:
+        t_primo = classificatore.fronte(t_ns)
+        if t_primo is not None:
+            decisioni.append((t_ns - t_primo) / 1e6)
+            print(f"  {t_primo / 1e9:10.3f}s  suoneria, decisa in {decisioni[-1]:.1f} ms")
+    print(f"{len(istanti)} fronti: {len(decisioni)} suonerie, "
+          f"{classificatore.scartati} treni scartati come disturbo")
+    if decisioni:
+        decisioni.sort()
+        print(f"Decisione: min {decisioni[0]:.1f} ms  "
+              f"mediana {decisioni[len(decisioni) // 2]:.1f} ms  max {decisioni[-1]:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    comandi = parser.add_subparsers(dest='comando', required=True)
+    p = comandi.add_parser('registra', help="registra i fronti dell'ingresso della suoneria")
+    p.add_argument('traccia', help="file da scrivere")
+    p.add_argument('--pin', type=int, help="GPIO BCM (default: suoneria della prima postazione)")
+    p.add_argument('--durata', type=float, default=60, help="secondi di registrazione (default 60)")
+    p = comandi.add_parser('riproduci', help="passa una traccia al classificatore")
+    p.add_argument('traccia', help="file registrato")
+    p.add_argument('--fronti', type=int, help="SUONERIA_FRONTI")
+    p.add_argument('--finestra', type=int, help="SUONERIA_FINESTRA_MS")
+    p.add_argument('--intervallo-min', type=int, help="SUONERIA_INTERVALLO_MIN_MS")
+    p.add_argument('--intervallo-max', type=int, help="SUONERIA_INTERVALLO_MAX_MS")
+    p.add_argument('--pausa', type=int, help="DEBOUNCE_SUONERIA_MS")
+    args = parser.parse_args()
+
+    try:
+        config = configurazione.carica()
+    except (OSError, ValueError) as e:
+        sys.exit(f"Configurazione non valida: {e}")
+    if args.comando == 'registra':
+        registra(args, config)
+    else:
+        riproduci(args, config)
+
+
+if __name__ == "__main__":
+    main()